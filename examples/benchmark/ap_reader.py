@@ -0,0 +1,75 @@
+import os
+import socket
+import threading
+import time
+
+from librespot.core import Session
+from librespot.crypto import CipherPair
+
+
+class RecvConnection:
+    """
+    The reader as it was before: one recv per field, three per packet
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.reads = 0
+        self.__socket = sock
+
+    def read(self, length: int) -> bytes:
+        self.reads += 1
+        return self.__socket.recv(length)
+
+
+class SocketWriter:
+
+    def __init__(self, sock: socket.socket):
+        self.__chunks = []
+        self.__socket = sock
+
+    def flush(self) -> None:
+        self.__socket.sendall(b"".join(self.__chunks))
+        self.__chunks = []
+
+    def write(self, data: bytes) -> None:
+        self.__chunks.append(data)
+
+
+def bench(name: str, payload_size: int, packets: int, connect) -> None:
+    send_key = os.urandom(32)
+    receive_key = os.urandom(32)
+    server, client = socket.socketpair()
+    sender = CipherPair(receive_key, send_key)
+    receiver = CipherPair(send_key, receive_key)
+    payload = os.urandom(payload_size)
+
+    def send():
+        writer = SocketWriter(server)
+        for _ in range(packets):
+            sender.send_encoded(writer, b"\x09", payload)
+        server.close()
+
+    connection = connect(client)
+    thread = threading.Thread(target=send)
+    start = time.perf_counter()
+    thread.start()
+    for _ in range(packets):
+        assert receiver.receive_encoded(connection).payload == payload
+    seconds = time.perf_counter() - start
+    thread.join()
+    client.close()
+    reads = (connection.reads if isinstance(connection, RecvConnection) else
+             connection.stats()["reads"])
+    print("{:<18} {:>6} B {:>10.0f} packets/s {:>6.2f} reads/packet".format(
+        name, payload_size, packets / seconds, reads / packets))
+
+
+def main():
+    for payload_size, packets in [(64, 5000), (1024, 2000)]:
+        bench("recv per field", payload_size, packets, RecvConnection)
+        bench("ConnectionHolder", payload_size, packets,
+              Session.ConnectionHolder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""
+Base62 and TrackId conversion timings. Run from the repository root with
+PYTHONPATH=. python examples/benchmark/base62.py
+"""
+import os
+import timeit
+
+from librespot.metadata import TrackId
+from librespot.util import Base62
+
+base62 = Base62.create_instance_with_inverted_character_set()
+
+
+def bench(name: str, statement, number: int, items: int = 1):
+    seconds = min(timeit.repeat(statement, number=number, repeat=3))
+    print("{:<32} {:>10.2f} us/id".format(
+        name, seconds / (number * items) * 1000000))
+
+
+def main():
+    gids = [os.urandom(16) for _ in range(10000)]
+    ids = [base62.encode(gid, 22).decode() for gid in gids]
+    encoded = [i.encode() for i in ids]
+    bench("Base62.encode", lambda: base62.encode(gids[0], 22), 20000)
+    bench("Base62.decode", lambda: base62.decode(encoded[0], 16), 20000)
+    bench("Base62.encode_all", lambda: base62.encode_all(gids, 22), 10,
+          len(gids))
+    bench("Base62.decode_all", lambda: base62.decode_all(ids, 16), 10,
+          len(ids))
+    bench("TrackId.from_base62", lambda: TrackId.from_base62(ids[0]), 20000)
+    track_id = TrackId.from_base62(ids[0])
+    bench("TrackId.to_spotify_uri", track_id.to_spotify_uri, 20000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import io
+import os
+import time
+
+from Cryptodome.Cipher import AES
+from Cryptodome.Util import Counter
+
+from librespot.audio.decrypt import AesAudioDecrypt
+from librespot.audio.storage import ChannelManager
+
+
+class ReferenceAudioDecrypt:
+    """
+    Chunk decryption as it was before the single CTR stream, one cipher per
+    4 KiB block. Kept here to check the output stays identical
+    """
+    iv_diff = 0x100
+
+    def __init__(self, key: bytes):
+        self.key = key
+
+    def decrypt_chunk(self, chunk_index: int, buffer: bytes) -> bytes:
+        new_buffer = io.BytesIO()
+        iv = AesAudioDecrypt.iv_int + int(
+            ChannelManager.chunk_size * chunk_index / 16)
+        for i in range(0, len(buffer), 4096):
+            cipher = AES.new(key=self.key,
+                             mode=AES.MODE_CTR,
+                             counter=Counter.new(128, initial_value=iv))
+            count = min(4096, len(buffer) - i)
+            new_buffer.write(cipher.decrypt(buffer[i:i + count]))
+            iv += self.iv_diff
+        new_buffer.seek(0)
+        return new_buffer.read()
+
+
+def bench(name: str, decrypt, chunks) -> float:
+    start = time.perf_counter()
+    for index, chunk in enumerate(chunks):
+        decrypt.decrypt_chunk(index, chunk)
+    seconds = time.perf_counter() - start
+    throughput = sum(len(chunk) for chunk in chunks) / seconds / 1024 / 1024
+    print("{:<18} {:>8.1f} MB/s".format(name, throughput))
+    return throughput
+
+
+def main():
+    key = os.urandom(16)
+    chunks = [os.urandom(ChannelManager.chunk_size) for _ in range(64)]
+    chunks.append(os.urandom(ChannelManager.chunk_size // 3 + 5))
+    reference = ReferenceAudioDecrypt(key)
+    decrypt = AesAudioDecrypt(key)
+    for index, chunk in enumerate(chunks):
+        assert (reference.decrypt_chunk(index, chunk) == decrypt.decrypt_chunk(
+            index, chunk))
+    print("output matches the per-block reference")
+    before = bench("per 4 KiB block", reference, chunks)
+    after = bench("AesAudioDecrypt", decrypt, chunks)
+    print("{:>32.1f}x".format(after / before))
+
+
+if __name__ == "__main__":
+    main()
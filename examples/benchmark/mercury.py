@@ -0,0 +1,111 @@
+import asyncio
+import heapq
+import io
+import struct
+import threading
+import time
+
+from librespot.crypto import Packet
+from librespot.mercury import MercuryClient
+from librespot.mercury import RawMercuryRequest
+from librespot.proto import Mercury_pb2 as Mercury
+
+
+class LocalAccessPoint:
+    """
+    Stand-in for the access point side of a session: answers every Mercury
+    request after a fixed round trip time, splitting the response over two
+    packets like the real AP does for larger payloads
+    """
+
+    def __init__(self, latency: float, payload_size: int = 2048):
+        self.client = None
+        self.latency = latency
+        self.payload = b"\x00" * payload_size
+        self.__condition = threading.Condition()
+        self.__queue = []
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def send(self, cmd: bytes, payload: bytes) -> None:
+        buffer = io.BytesIO(payload)
+        buffer.read(2)
+        seq = struct.unpack(">i", buffer.read(4))[0]
+        buffer.read(3)
+        size = struct.unpack(">H", buffer.read(2))[0]
+        header = Mercury.Header()
+        header.ParseFromString(buffer.read(size))
+        with self.__condition:
+            heapq.heappush(self.__queue,
+                           (time.monotonic() + self.latency, seq, cmd,
+                            header.uri))
+            self.__condition.notify()
+
+    def __respond(self, seq: int, cmd: bytes, uri: str) -> None:
+        header = Mercury.Header(uri=uri, status_code=200).SerializeToString()
+        half = len(self.payload) // 2
+        for flags, parts in [(b"\x00", [header, self.payload[:half]]),
+                             (b"\x01", [self.payload[half:]])]:
+            out = io.BytesIO()
+            out.write(struct.pack(">H", 4))
+            out.write(struct.pack(">i", seq))
+            out.write(flags)
+            out.write(struct.pack(">H", len(parts)))
+            for part in parts:
+                out.write(struct.pack(">H", len(part)))
+                out.write(part)
+            self.client.dispatch(Packet(cmd, out.getvalue()))
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                while not self.__queue or self.__queue[0][0] > time.monotonic():
+                    self.__condition.wait(None if not self.__queue else
+                                          self.__queue[0][0] -
+                                          time.monotonic())
+                _, seq, cmd, uri = heapq.heappop(self.__queue)
+            self.__respond(seq, cmd, uri)
+
+
+def requests(count: int):
+    return [
+        RawMercuryRequest.get("hm://metadata/4/track/{:032x}".format(i))
+        for i in range(count)
+    ]
+
+
+def bench(name: str, count: int, fn) -> None:
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    print("{:<32} {:>8.3f} s {:>10.1f} req/s".format(name, seconds,
+                                                    count / seconds))
+
+
+def main():
+    count = 300
+    ap = LocalAccessPoint(latency=0.02)
+    client = MercuryClient(ap)
+    ap.client = client
+
+    def sequential():
+        for request in requests(count):
+            client.send_sync(request)
+
+    def pipelined():
+        futures = [client.send_future(request) for request in requests(count)]
+        for future in futures:
+            future.result()
+
+    async def gathered():
+        await asyncio.gather(
+            *[client.send_async(request) for request in requests(count)])
+
+    bench("send_sync, one at a time", count, sequential)
+    bench("send_future, pipelined", count, pipelined)
+    bench("send_async, gathered", count, lambda: asyncio.run(gathered()))
+    print("pending after run: {}".format(client.pending()))
+    client.close()
+
+
+if __name__ == "__main__":
+    main()
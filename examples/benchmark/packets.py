@@ -0,0 +1,44 @@
+import re
+import time
+
+from librespot.crypto import Packet
+from librespot.crypto import PacketTable
+
+
+def regex_parse(val: bytes):
+    for cmd in [
+            Packet.Type.__dict__[attr] for attr in Packet.Type.__dict__
+            if re.search("__.+?__", attr) is None
+            and type(Packet.Type.__dict__[attr]) is bytes
+    ]:
+        if cmd == val:
+            return cmd
+    return None
+
+
+def bench(name: str, count: int, fn) -> None:
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    print("{:<32} {:>12.0f} packets/s".format(name, count / seconds))
+
+
+def main():
+    count = 200000
+    cmds = [
+        Packet.Type.stream_chunk_res, Packet.Type.mercury_req,
+        Packet.Type.aes_key, Packet.Type.ping
+    ]
+    packets = [Packet(cmds[i % len(cmds)], b"") for i in range(count)]
+    table = PacketTable()
+    table.register(cmds, lambda packet: None)
+    bench("regex scan of Packet.Type", count,
+          lambda: [regex_parse(packet.cmd) for packet in packets])
+    bench("Packet.Type.parse", count,
+          lambda: [Packet.Type.parse(packet.cmd) for packet in packets])
+    bench("PacketTable.dispatch", count,
+          lambda: [table.dispatch(packet) for packet in packets])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import io
+import os
+import struct
+import time
+
+from librespot.core import DealerClient
+from librespot.crypto import Packet
+from librespot.mercury import MercuryClient
+from librespot.proto import Mercury_pb2 as Mercury
+from librespot.structure import MessageListener
+from librespot.structure import SubListener
+from librespot.util import Base62
+from librespot.util import PrefixTrie
+
+base62 = Base62.create_instance_with_inverted_character_set()
+
+
+class CountingListener(MessageListener, SubListener):
+
+    def __init__(self):
+        self.count = 0
+
+    def event(self, resp: MercuryClient.Response) -> None:
+        self.count += 1
+
+    def on_message(self, uri: str, headers, payload: bytes) -> None:
+        self.count += 1
+
+
+def playlist_uris(count: int):
+    return [
+        "hm://playlist/v2/playlist/{}".format(
+            base62.encode(os.urandom(16), 22).decode()) for _ in range(count)
+    ]
+
+
+def event_packet(uri: str) -> Packet:
+    header = Mercury.Header(uri=uri, status_code=200).SerializeToString()
+    out = io.BytesIO()
+    out.write(struct.pack(">H", 4))
+    out.write(struct.pack(">i", 0))
+    out.write(b"\x01")
+    out.write(struct.pack(">H", 2))
+    for part in [header, b"\x00" * 64]:
+        out.write(struct.pack(">H", len(part)))
+        out.write(part)
+    return Packet(Packet.Type.mercury_event, out.getvalue())
+
+
+def bench(name: str, count: int, fn) -> None:
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    print("{:<40} {:>10.0f} events/s".format(name, count / seconds))
+
+
+def main():
+    listeners = 5000
+    events = 20000
+    uris = playlist_uris(listeners)
+    targets = [uris[i % listeners] + "/changes" for i in range(events)]
+    listener = CountingListener()
+
+    trie = PrefixTrie()
+    for uri in uris:
+        trie.add(uri, listener)
+    bench("linear startswith scan", events, lambda: [[
+        uri for uri in uris if target.startswith(uri)
+    ] for target in targets])
+    bench("PrefixTrie.match", events,
+          lambda: [trie.match(target) for target in targets])
+
+    mercury = MercuryClient(None)
+    for uri in uris:
+        mercury.interested_in(uri, listener)
+    packets = [event_packet(target) for target in targets]
+    bench("MercuryClient.dispatch", events,
+          lambda: [mercury.dispatch(packet) for packet in packets])
+
+    dealer = DealerClient(None)
+    for uri in uris:
+        dealer.add_message_listener(CountingListener(), [uri])
+    messages = [{
+        "uri": target,
+        "headers": {
+            "Content-Type": "application/json"
+        },
+        "payloads": []
+    } for target in targets]
+    bench("DealerClient.handle_message", events,
+          lambda: [dealer.handle_message(message) for message in messages])
+    dealer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import logging
+import os
+import random
+import threading
+import time
+
+from requests.structures import CaseInsensitiveDict
+
+from librespot.audio import CdnManager
+from librespot.audio import ChunkFetchScheduler
+from librespot.audio import StreamId
+from librespot.audio.format import SuperAudioFormat
+from librespot.audio.storage import ChannelManager
+from librespot.core import Session
+from librespot.proto import Metadata_pb2 as Metadata
+from librespot.structure import NoopAudioDecrypt
+
+
+class FakeResponse:
+
+    def __init__(self, status_code: int, content: bytes, headers: dict):
+        self.status_code = status_code
+        self.content = content
+        self.headers = CaseInsensitiveDict(headers)
+
+    def close(self) -> None:
+        pass
+
+    def iter_content(self, chunk_size: int):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+class FakeCdn:
+    """
+    Serves range requests for in-memory files after a random latency and
+    fails a share of them, either with a 503 or by raising
+    """
+
+    def __init__(self, files: dict, latency: float, failure_rate: float):
+        self.failures = 0
+        self.files = files
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.__lock = threading.Lock()
+
+    def get(self, url: str, headers: CaseInsensitiveDict = None, **kwargs):
+        with self.__lock:
+            self.requests += 1
+            failed = random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+        time.sleep(random.uniform(0, 2 * self.latency))
+        if failed:
+            if random.random() < 0.5:
+                raise ConnectionError("Injected connection failure")
+            return FakeResponse(503, b"", {})
+        data = self.files[url.rsplit("/", 1)[1]]
+        start, end = headers["Range"][len("bytes="):].split("-")
+        start = int(start)
+        end = min(int(end), len(data) - 1)
+        return FakeResponse(
+            206, data[start:end + 1],
+            {"Content-Range": "bytes {}-{}/{}".format(start, end, len(data))})
+
+
+class FakeSession:
+    logger = logging.getLogger("Librespot:Session")
+
+    def __init__(self, cdn: FakeCdn):
+        self.__cdn = cdn
+        self.__configuration = Session.Configuration.Builder() \
+            .set_cache_enabled(False) \
+            .set_retry_on_chunk_error(True) \
+            .build()
+
+    def client(self) -> FakeCdn:
+        return self.__cdn
+
+    def configuration(self) -> Session.Configuration:
+        return self.__configuration
+
+
+def read_stream(cdn_manager: CdnManager, session: FakeSession, name: str,
+                expected: bytes, errors: list) -> None:
+    try:
+        streamer = CdnManager.Streamer(
+            session,
+            StreamId(file=Metadata.AudioFile(file_id=os.urandom(20))),
+            SuperAudioFormat.VORBIS,
+            CdnManager.CdnUrl(cdn_manager, None, [
+                "https://audio-{}.example/{}".format(host, name)
+                for host in ["a", "b"]
+            ]), None, NoopAudioDecrypt(), None)
+        stream = streamer.stream()
+        received = bytearray()
+        while True:
+            data = stream.read(random.randint(1, 3) * 4096)
+            if len(data) == 0:
+                break
+            received += data
+        stream.close()
+        if received != expected:
+            errors.append("{}: content mismatch".format(name))
+    except Exception as ex:
+        errors.append("{}: {!r}".format(name, ex))
+
+
+def main():
+    # Injected failures are logged as warnings by every layer
+    logging.disable(logging.WARNING)
+    streams = 50
+    files = {
+        "file{}".format(i): os.urandom(
+            random.randint(8, 24) * ChannelManager.chunk_size +
+            random.randint(0, ChannelManager.chunk_size))
+        for i in range(streams)
+    }
+    cdn = FakeCdn(files, latency=0.01, failure_rate=0.05)
+    session = FakeSession(cdn)
+    cdn_manager = CdnManager(session)
+    errors = []
+    threads = [
+        threading.Thread(target=read_stream,
+                         args=(cdn_manager, session, name, data, errors))
+        for name, data in files.items()
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    total = sum(len(data) for data in files.values())
+    print("{} streams, {:.1f} MB in {:.2f} s ({:.1f} MB/s)".format(
+        streams, total / 1024 / 1024, seconds, total / seconds / 1024 / 1024))
+    print("{} requests, {} injected failures, {} failed streams".format(
+        cdn.requests, cdn.failures, len(errors)))
+    for error in errors:
+        print("  " + error)
+    stats = CdnManager.Streamer.scheduler.stats()
+    for name in ChunkFetchScheduler.priority_names:
+        print("{:<12} {}".format(name, stats[name]))
+
+
+if __name__ == "__main__":
+    main()
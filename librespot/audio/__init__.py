@@ -9,11 +9,12 @@ from librespot.metadata import EpisodeId, PlayableId, TrackId
 from librespot.proto import Metadata_pb2 as Metadata, StorageResolve_pb2 as StorageResolve
 from librespot.structure import AudioDecrypt, AudioQualityPicker, Closeable, FeederException, GeneralAudioStream, GeneralWritableStream, HaltListener, NoopAudioDecrypt, PacketsReceiver
 from requests.structures import CaseInsensitiveDict
+import collections
 import concurrent.futures
 import io
 import logging
 import math
-import queue
+import os
 import random
 import struct
 import threading
@@ -26,15 +27,17 @@ if typing.TYPE_CHECKING:
 
 
 class AbsChunkedInputStream(io.BytesIO, HaltListener):
-    chunk_exception = None
     closed = False
     max_chunk_tries = 128
     preload_ahead = 3
     preload_chunk_retries = 2
+    priority: int
+    read_ahead: ReadAhead
     retries: typing.List[int]
     retry_on_chunk_error: bool
-    wait_lock: threading.Condition = threading.Condition()
-    wait_for_chunk = -1
+    wait_lock: threading.Condition
+    __chunk_events: typing.List[threading.Event]
+    __chunk_exceptions: typing.List[typing.Union[Exception, None]]
     __decoded_length = 0
     __mark = 0
     __pos = 0
@@ -43,6 +46,11 @@ class AbsChunkedInputStream(io.BytesIO, HaltListener):
         super().__init__()
         self.retries = [0] * self.chunks()
         self.retry_on_chunk_error = retry_on_chunk_error
+        self.priority = ChunkFetchScheduler.READ_AHEAD
+        self.read_ahead = AbsChunkedInputStream.ReadAhead(self.preload_ahead)
+        self.wait_lock = threading.Condition()
+        self.__chunk_events = [threading.Event() for _ in range(self.chunks())]
+        self.__chunk_exceptions = [None] * self.chunks()
 
     def is_closed(self) -> bool:
         return self.closed
@@ -53,10 +61,17 @@ class AbsChunkedInputStream(io.BytesIO, HaltListener):
     def size(self) -> int:
         raise NotImplementedError()
 
+    def head(self) -> bytes:
+        """
+        Decrypted prefix of chunk 0 that can be read before the chunk itself
+        is available, see Session.Configuration.fast_start
+        """
+        return b""
+
     def close(self) -> None:
         self.closed = True
-        with self.wait_lock:
-            self.wait_lock.notify_all()
+        for event in self.__chunk_events:
+            event.set()
 
     def available(self):
         return self.size() - self.__pos
@@ -79,7 +94,8 @@ class AbsChunkedInputStream(io.BytesIO, HaltListener):
         if self.closed:
             raise IOError("Stream is closed!")
         self.__pos = where
-        self.check_availability(int(self.__pos / (128 * 1024)), False, False)
+        self.check_availability(self.__pos // ChannelManager.chunk_size, False,
+                                False)
 
     def skip(self, n: int) -> int:
         if n < 0:
@@ -90,7 +106,7 @@ class AbsChunkedInputStream(io.BytesIO, HaltListener):
         if n < k:
             k = n
         self.__pos += k
-        chunk = int(self.__pos / (128 * 1024))
+        chunk = self.__pos // ChannelManager.chunk_size
         self.check_availability(chunk, False, False)
         return k
 
@@ -106,6 +122,20 @@ class AbsChunkedInputStream(io.BytesIO, HaltListener):
     def request_chunk_from_stream(self, index: int) -> None:
         raise NotImplementedError()
 
+    def promote_chunk(self, index: int) -> None:
+        """
+        Called when a reader blocks on a chunk that was already requested,
+        implementations may move its pending download up the queue
+        """
+        pass
+
+    def set_priority(self, priority: int) -> None:
+        """
+        Change the priority of future chunk requests, implementations may
+        also move requests already queued
+        """
+        self.priority = priority
+
     def should_retry(self, chunk: int) -> bool:
         if self.retries[chunk] < 1:
             return True
@@ -116,102 +146,160 @@ class AbsChunkedInputStream(io.BytesIO, HaltListener):
     def check_availability(self, chunk: int, wait: bool, halted: bool) -> None:
         if halted and not wait:
             raise TypeError()
-        if not self.requested_chunks()[chunk]:
-            self.request_chunk_from_stream(chunk)
-            self.requested_chunks()[chunk] = True
-        for i in range(chunk + 1,
-                       min(self.chunks() - 1, chunk + self.preload_ahead) + 1):
-            if (self.requested_chunks()[i]
-                    and self.retries[i] < self.preload_chunk_retries):
-                self.request_chunk_from_stream(i)
-                self.requested_chunks()[chunk] = True
+        with self.wait_lock:
+            indices = []
+            if not self.requested_chunks()[chunk]:
+                indices.append(chunk)
+            window = self.read_ahead.window()
+            for i in range(chunk + 1,
+                           min(self.chunks() - 1, chunk + window) + 1):
+                if (not self.requested_chunks()[i]
+                        and self.retries[i] < self.preload_chunk_retries):
+                    indices.append(i)
+            self.__request(indices, self.priority, chunk if wait else -1)
         if wait:
             if self.available_chunks()[chunk]:
                 return
-            retry = False
-            with self.wait_lock:
-                if not halted:
-                    self.stream_read_halted(chunk, int(time.time() * 1000))
-                self.chunk_exception = None
-                self.wait_for_chunk = chunk
-                self.wait_lock.wait_for(lambda: self.available_chunks()[chunk])
+            self.promote_chunk(chunk)
+            if not halted:
+                self.stream_read_halted(chunk, int(time.time() * 1000))
+            while not self.available_chunks()[chunk]:
+                self.__chunk_events[chunk].wait()
                 if self.closed:
                     return
-                if self.chunk_exception is not None:
-                    if self.should_retry(chunk):
-                        retry = True
-                    else:
-                        raise AbsChunkedInputStream.ChunkException
-                if not retry:
-                    self.stream_read_halted(chunk, int(time.time() * 1000))
-            if retry:
-                time.sleep(math.log10(self.retries[chunk]))
-                self.check_availability(chunk, True, True)
-
-    def read(self, __size: int = 0) -> bytes:
+                exception = self.__chunk_exceptions[chunk]
+                if exception is not None:
+                    if not self.should_retry(chunk):
+                        raise AbsChunkedInputStream.ChunkException(exception)
+                    time.sleep(math.log10(self.retries[chunk]))
+                    self.check_availability(chunk, True, True)
+                    return
+            self.stream_read_resumed(chunk, int(time.time() * 1000))
+
+    def request_all_chunks(self,
+                           priority: int = None,
+                           limit: int = None) -> None:
+        """
+        Request every chunk that hasn't been requested yet, e.g. to fill the
+        cache in the background
+        Args:
+            priority: ChunkFetchScheduler priority, BACKGROUND by default
+            limit: Only consider the first limit chunks
+        """
+        if priority is None:
+            priority = ChunkFetchScheduler.BACKGROUND
+        end = self.chunks() if limit is None else min(limit, self.chunks())
+        with self.wait_lock:
+            self.__request([
+                i for i in range(end) if not self.requested_chunks()[i]
+            ], priority)
+
+    def request_chunks_from_stream(self, index: int, count: int,
+                                   priority: int) -> None:
+        """
+        Request a run of contiguous chunks, implementations may fetch them
+        with a single request
+        """
+        for i in range(index, index + count):
+            self.request_chunk_from_stream(i)
+
+    def __request(self, indices: typing.List[int], priority: int,
+                  blocking: int = -1) -> None:
+        for i in indices:
+            self.__mark_requested(i)
+        start = 0
+        for i in range(1, len(indices) + 1):
+            if i == len(indices) or indices[i] != indices[i - 1] + 1:
+                first = indices[start]
+                count = i - start
+                if first == blocking:
+                    # Only the chunk the reader waits for jumps the queue,
+                    # the read-ahead behind it keeps its own priority
+                    self.request_chunks_from_stream(
+                        first, 1, ChunkFetchScheduler.BLOCKING)
+                    first += 1
+                    count -= 1
+                if count > 0:
+                    self.request_chunks_from_stream(first, count, priority)
+                start = i
+
+    def __mark_requested(self, index: int) -> None:
+        if not self.available_chunks()[index]:
+            self.__chunk_exceptions[index] = None
+            self.__chunk_events[index].clear()
+        self.requested_chunks()[index] = True
+
+    def read(self, __size: int = 0) -> typing.Union[bytes, memoryview]:
+        """
+        Read up to __size bytes, or everything left if __size <= 0
+        Reads contained in a single chunk return a view over that chunk,
+        anything else is gathered into one preallocated buffer. Views are
+        read-only, chunks are shared with other readers and the cache.
+        """
         if self.closed:
             raise IOError("Stream is closed!")
-        if __size <= 0:
-            if self.__pos == self.size():
-                return b""
-            buffer = io.BytesIO()
-            total_size = self.size()
-            chunk = int(self.__pos / (128 * 1024))
-            chunk_off = int(self.__pos % (128 * 1024))
-            chunk_total = int(math.ceil(total_size / (128 * 1024)))
-            self.check_availability(chunk, True, False)
-            buffer.write(self.buffer()[chunk][chunk_off:])
-            chunk += 1
-            if chunk != chunk_total:
-                while chunk <= chunk_total - 1:
-                    self.check_availability(chunk, True, False)
-                    buffer.write(self.buffer()[chunk])
-                    chunk += 1
-            buffer.seek(0)
-            self.__pos += buffer.getbuffer().nbytes
-            return buffer.read()
-        buffer = io.BytesIO()
-        chunk = int(self.__pos / (128 * 1024))
-        chunk_off = int(self.__pos % (128 * 1024))
-        chunk_end = int(__size / (128 * 1024))
-        chunk_end_off = int(__size % (128 * 1024))
-        if chunk_end > self.size():
-            chunk_end = int(self.size() / (128 * 1024))
-            chunk_end_off = int(self.size() % (128 * 1024))
+        remaining = self.size() - self.__pos
+        if __size <= 0 or __size > remaining:
+            __size = remaining
+        if __size == 0:
+            return b""
+        chunk, chunk_off = divmod(self.__pos, ChannelManager.chunk_size)
+        if chunk_off + __size <= ChannelManager.chunk_size:
+            view = memoryview(self.__chunk_buffer(
+                chunk, chunk_off + __size))[chunk_off:chunk_off + __size]
+            self.__pos += len(view)
+            self.read_ahead.on_read(len(view))
+            return view.toreadonly()
+        buffer = bytearray(__size)
+        return memoryview(buffer)[:self.readinto(buffer)].toreadonly()
+
+    def readinto(self, buffer: typing.Union[bytearray, memoryview]) -> int:
+        """
+        Read into a writable buffer without intermediate copies
+        Args:
+            buffer: Destination buffer
+        Returns:
+            Number of bytes read
+        """
+        if self.closed:
+            raise IOError("Stream is closed!")
+        view = memoryview(buffer).cast("B")
+        total = min(len(view), self.size() - self.__pos)
+        written = 0
+        while written < total:
+            chunk, chunk_off = divmod(self.__pos, ChannelManager.chunk_size)
+            data = self.__chunk_buffer(chunk,
+                                       chunk_off + total - written)
+            length = min(len(data) - chunk_off, total - written)
+            if length <= 0:
+                break
+            view[written:written + length] = \
+                memoryview(data)[chunk_off:chunk_off + length]
+            written += length
+            self.__pos += length
+        self.read_ahead.on_read(written)
+        return written
+
+    def __chunk_buffer(self, chunk: int, end: int) -> bytes:
+        if chunk == 0 and not self.available_chunks()[0]:
+            head = self.head()
+            if end <= len(head):
+                return head
         self.check_availability(chunk, True, False)
-        if chunk_off + __size > len(self.buffer()[chunk]):
-            buffer.write(self.buffer()[chunk][chunk_off:])
-            chunk += 1
-            while chunk <= chunk_end:
-                self.check_availability(chunk, True, False)
-                if chunk == chunk_end:
-                    buffer.write(self.buffer()[chunk][:chunk_end_off])
-                else:
-                    buffer.write(self.buffer()[chunk])
-                chunk += 1
-        else:
-            buffer.write(self.buffer()[chunk][chunk_off:chunk_off + __size])
-        buffer.seek(0)
-        self.__pos += buffer.getbuffer().nbytes
-        return buffer.read()
+        return self.buffer()[chunk]
 
     def notify_chunk_available(self, index: int) -> None:
         self.available_chunks()[index] = True
         self.__decoded_length += len(self.buffer()[index])
-        with self.wait_lock:
-            if index == self.wait_for_chunk and not self.closed:
-                self.wait_for_chunk = -1
-                self.wait_lock.notify_all()
+        self.__chunk_events[index].set()
 
     def notify_chunk_error(self, index: int, ex):
-        self.available_chunks()[index] = False
-        self.requested_chunks()[index] = False
-        self.retries[index] += 1
         with self.wait_lock:
-            if index == self.wait_for_chunk and not self.closed:
-                self.chunk_exception = ex
-                self.wait_for_chunk = -1
-                self.wait_lock.notify_all()
+            self.available_chunks()[index] = False
+            self.requested_chunks()[index] = False
+            self.retries[index] += 1
+            self.__chunk_exceptions[index] = ex
+            self.__chunk_events[index].set()
 
     def decoded_length(self):
         return self.__decoded_length
@@ -223,23 +311,132 @@ class AbsChunkedInputStream(io.BytesIO, HaltListener):
             return AbsChunkedInputStream \
                 .ChunkException("Failed due to stream error, code: {}".format(stream_error))
 
+    class ReadAhead:
+        """
+        Sizes the read-ahead window from the measured chunk download latency
+        and the rate at which the consumer reads. The window never drops
+        below the initial one and never buffers more than max_buffer_size
+        per stream, a static cap rather than a reaction to the memory
+        actually available.
+        """
+        alpha = 0.3
+        max_buffer_size = 8 * 1024 * 1024
+        max_window = 32
+        min_window = 1
+        sample_interval = 0.5
+        __latency: typing.Union[float, None] = None
+        __lock: threading.Lock
+        __read_bytes = 0
+        __read_rate: typing.Union[float, None] = None
+        __read_start: typing.Union[float, None] = None
+        __initial_window: int
+        __throughput: typing.Union[float, None] = None
+        __window: int
+
+        def __init__(self, initial_window: int):
+            self.__initial_window = initial_window
+            self.__lock = threading.Lock()
+            self.__window = initial_window
+
+        def window(self) -> int:
+            return self.__window
+
+        def latency(self) -> float:
+            """
+            Smoothed chunk download latency in seconds, -1 if unknown
+            """
+            return -1 if self.__latency is None else self.__latency
+
+        def throughput(self) -> float:
+            """
+            Smoothed download throughput in bytes per second, -1 if unknown
+            """
+            return -1 if self.__throughput is None else self.__throughput
+
+        def read_rate(self) -> float:
+            """
+            Smoothed consumer read rate in bytes per second, -1 if unknown
+            """
+            return -1 if self.__read_rate is None else self.__read_rate
+
+        def on_chunk_downloaded(self, length: int, elapsed: float) -> None:
+            with self.__lock:
+                self.__latency = self.__smooth(self.__latency, elapsed)
+                if elapsed > 0:
+                    self.__throughput = self.__smooth(self.__throughput,
+                                                      length / elapsed)
+                self.__update()
+
+        def on_read(self, length: int) -> None:
+            now = time.monotonic()
+            with self.__lock:
+                if self.__read_start is None:
+                    self.__read_start = now
+                    self.__read_bytes = 0
+                self.__read_bytes += length
+                elapsed = now - self.__read_start
+                if elapsed < self.sample_interval:
+                    return
+                self.__read_rate = self.__smooth(self.__read_rate,
+                                                 self.__read_bytes / elapsed)
+                self.__read_start = None
+                self.__update()
+
+        def __smooth(self, current: typing.Union[float, None],
+                     sample: float) -> float:
+            if current is None:
+                return sample
+            return self.alpha * sample + (1 - self.alpha) * current
+
+        def __update(self) -> None:
+            if self.__latency is None or self.__read_rate is None:
+                return
+            if self.__throughput is not None \
+                    and self.__throughput < self.__read_rate:
+                # The link is slower than the consumer, buffer as much as allowed
+                window = self.max_window
+            else:
+                window = math.ceil(self.__read_rate * self.__latency /
+                                   ChannelManager.chunk_size) + 1
+            limit = min(self.max_window,
+                        self.max_buffer_size // ChannelManager.chunk_size)
+            self.__window = max(self.min_window,
+                                min(max(window, self.__initial_window),
+                                    limit))
+
 
 class AudioKeyManager(PacketsReceiver, Closeable):
     audio_key_request_timeout = 20
     logger = logging.getLogger("Librespot:AudioKeyManager")
-    __callbacks: typing.Dict[int, Callback] = {}
+    packet_types = (Packet.Type.aes_key, Packet.Type.aes_key_error)
+    __callbacks: typing.Dict[int, Callback]
     __seq_holder = 0
-    __seq_holder_lock = threading.Condition()
+    __seq_holder_lock: threading.Lock
     __session: Session
+    __single_flight: util.SingleFlight
     __zero_short = b"\x00\x00"
 
     def __init__(self, session: Session):
+        self.__callbacks = {}
+        self.__seq_holder_lock = threading.Lock()
         self.__session = session
+        self.__single_flight = util.SingleFlight()
+
+    def close(self) -> None:
+        with self.__seq_holder_lock:
+            callbacks = list(self.__callbacks.values())
+            self.__callbacks.clear()
+        for callback in callbacks:
+            callback.cancel()
+
+    def coalescing_stats(self) -> typing.Dict[str, int]:
+        return self.__single_flight.stats()
 
     def dispatch(self, packet: Packet) -> None:
         payload = io.BytesIO(packet.payload)
         seq = struct.unpack(">i", payload.read(4))[0]
-        callback = self.__callbacks.get(seq)
+        with self.__seq_holder_lock:
+            callback = self.__callbacks.pop(seq, None)
         if callback is None:
             self.logger.warning(
                 "Couldn't find callback for seq: {}".format(seq))
@@ -259,27 +456,119 @@ class AudioKeyManager(PacketsReceiver, Closeable):
                       gid: bytes,
                       file_id: bytes,
                       retry: bool = True) -> bytes:
-        seq: int
+        future = self.request_audio_key(gid, file_id)
+        try:
+            return self.__wait(future)
+        except (AudioKeyManager.AesKeyException,
+                concurrent.futures.TimeoutError) as ex:
+            if retry:
+                return self.get_audio_key(gid, file_id, False)
+            raise RuntimeError(
+                "Failed fetching audio key! gid: {}, fileId: {}".format(
+                    util.bytes_to_hex(gid),
+                    util.bytes_to_hex(file_id))) from ex
+
+    def get_audio_keys(
+        self,
+        items: typing.Iterable[typing.Tuple[bytes, bytes]],
+        retry: bool = True,
+    ) -> typing.List[typing.Union[bytes, None]]:
+        """
+        Request the keys of many files at once and wait for all of them
+        Args:
+            items: (gid, file_id) pairs
+            retry: Request failed keys a second time
+        Returns:
+            The keys in the same order, None for keys that couldn't be fetched
+        """
+        items = list(items)
+        keys = []
+        for future in self.request_audio_keys(items):
+            try:
+                keys.append(self.__wait(future))
+            except (AudioKeyManager.AesKeyException,
+                    concurrent.futures.TimeoutError):
+                keys.append(None)
+        failed = [i for i, key in enumerate(keys) if key is None]
+        if retry and len(failed) > 0:
+            retried = self.get_audio_keys([items[i] for i in failed], False)
+            for i, key in zip(failed, retried):
+                keys[i] = key
+        elif len(failed) > 0:
+            self.logger.warning("Failed fetching {} of {} audio keys".format(
+                len(failed), len(items)))
+        return keys
+
+    def request_audio_key(self, gid: bytes,
+                          file_id: bytes) -> concurrent.futures.Future:
+        """
+        Send a key request without waiting for the response, received keys
+        are stored in the session's audio key cache. Requests for a key
+        already in flight share its future.
+        Args:
+            gid: Track or episode gid
+            file_id: Audio file id
+        Returns:
+            A future resolving to the key, or failing with AesKeyException
+        """
+        return self.__single_flight.share(
+            (gid, file_id), lambda: self.__request_audio_key(gid, file_id))
+
+    def request_audio_keys(
+        self, items: typing.Iterable[typing.Tuple[bytes, bytes]]
+    ) -> typing.List[concurrent.futures.Future]:
+        """
+        Send key requests for many (gid, file_id) pairs back to back
+        """
+        return [
+            self.request_audio_key(gid, file_id) for gid, file_id in items
+        ]
+
+    def __request_audio_key(self, gid: bytes,
+                            file_id: bytes) -> concurrent.futures.Future:
+        callback = AudioKeyManager.FutureCallback()
         with self.__seq_holder_lock:
             seq = self.__seq_holder
             self.__seq_holder += 1
+            self.__callbacks[seq] = callback
+        callback.future.add_done_callback(
+            lambda future: self.__on_done(seq, gid, file_id, future))
         out = io.BytesIO()
         out.write(file_id)
         out.write(gid)
         out.write(struct.pack(">i", seq))
         out.write(self.__zero_short)
         out.seek(0)
-        self.__session.send(Packet.Type.request_key, out.read())
-        callback = AudioKeyManager.SyncCallback(self)
-        self.__callbacks[seq] = callback
-        key = callback.wait_response()
-        if key is None:
-            if retry:
-                return self.get_audio_key(gid, file_id, False)
-            raise RuntimeError(
-                "Failed fetching audio key! gid: {}, fileId: {}".format(
-                    util.bytes_to_hex(gid), util.bytes_to_hex(file_id)))
-        return key
+        try:
+            self.__session.send(Packet.Type.request_key, out.read())
+        except Exception as ex:
+            callback.future.set_exception(ex)
+        return callback.future
+
+    def __on_done(self, seq: int, gid: bytes, file_id: bytes,
+                  future: concurrent.futures.Future) -> None:
+        with self.__seq_holder_lock:
+            self.__callbacks.pop(seq, None)
+        if not future.cancelled() and future.exception() is None:
+            self.__session.cache().audio_keys().put(gid, file_id,
+                                                    future.result())
+
+    def __wait(self, future: concurrent.futures.Future) -> bytes:
+        # Every caller waits on a future of its own, giving up on it only
+        # cancels the shared request once no other caller waits for it
+        done, _ = concurrent.futures.wait([future],
+                                          self.audio_key_request_timeout)
+        if len(done) == 0:
+            future.cancel()
+            raise concurrent.futures.TimeoutError()
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            # The manager was closed
+            raise concurrent.futures.TimeoutError()
+
+    class AesKeyException(IOError):
+        pass
 
     class Callback:
 
@@ -289,38 +578,328 @@ class AudioKeyManager(PacketsReceiver, Closeable):
         def error(self, code: int) -> None:
             raise NotImplementedError
 
-    class SyncCallback(Callback):
-        __audio_key_manager: AudioKeyManager
-        __reference = queue.Queue()
-        __reference_lock = threading.Condition()
+        def cancel(self) -> None:
+            pass
+
+    class FutureCallback(Callback):
+        future: concurrent.futures.Future
 
-        def __init__(self, audio_key_manager: AudioKeyManager):
-            self.__audio_key_manager = audio_key_manager
+        def __init__(self):
+            self.future = concurrent.futures.Future()
 
         def key(self, key: bytes) -> None:
-            with self.__reference_lock:
-                self.__reference.put(key)
-                self.__reference_lock.notify_all()
+            if self.future.set_running_or_notify_cancel():
+                self.future.set_result(key)
 
         def error(self, code: int) -> None:
-            self.__audio_key_manager.logger.fatal(
+            AudioKeyManager.logger.error(
                 "Audio key error, code: {}".format(code))
-            with self.__reference_lock:
-                self.__reference.put(None)
-                self.__reference_lock.notify_all()
+            if self.future.set_running_or_notify_cancel():
+                self.future.set_exception(
+                    AudioKeyManager.AesKeyException(
+                        "Audio key error, code: {}".format(code)))
+
+        def cancel(self) -> None:
+            self.future.cancel()
+
+
+class ChunkFetchScheduler:
+    """
+    Process-wide queue for chunk downloads. Jobs are dispatched by priority,
+    round-robin between streams of the same priority, and never run more
+    than max_per_host requests against one CDN host at a time. Every request
+    of a job takes a host slot through acquire, hedges and failovers to
+    other hosts included. Blocking jobs ignore the host limit, a stalled
+    reader shouldn't wait for other streams' read-ahead to drain.
+    """
+    BLOCKING = 0
+    READ_AHEAD = 1
+    PRELOAD = 2
+    BACKGROUND = 3
+    logger = logging.getLogger("Librespot:ChunkFetchScheduler")
+    max_per_host: int
+    max_workers: int
+    priority_names = ["blocking", "read_ahead", "preload", "background"]
+    __active: typing.Dict[str, int]
+    __completed: typing.List[int]
+    __idle = 0
+    __lock: threading.Condition
+    __max_wait_time: typing.List[float]
+    __promoted: typing.List[int]
+    __queues: typing.List[typing.Dict[typing.Any, typing.Deque[Job]]]
+    __wait_time: typing.List[float]
+    __workers = 0
+
+    def __init__(self, max_workers: int = None, max_per_host: int = 6):
+        self.max_per_host = max_per_host
+        self.max_workers = max_workers if max_workers is not None \
+            else min(32, (os.cpu_count() or 1) + 4)
+        self.__active = {}
+        self.__completed = [0] * len(self.priority_names)
+        self.__lock = threading.Condition()
+        self.__max_wait_time = [0.0] * len(self.priority_names)
+        self.__promoted = [0] * len(self.priority_names)
+        self.__queues = [
+            collections.OrderedDict() for _ in self.priority_names
+        ]
+        self.__wait_time = [0.0] * len(self.priority_names)
+
+    def submit(self, stream: typing.Any, host: str, priority: int,
+               index: int, count: int,
+               fn: typing.Callable[[ChunkFetchScheduler.Job], None]) -> None:
+        """
+        Queue the download of a run of chunks
+        Args:
+            stream: Owner of the job, used for fair sharing and cancellation
+            host: CDN host the job will most likely hit
+            priority: One of BLOCKING, READ_AHEAD, PRELOAD or BACKGROUND
+            index: First chunk of the run
+            count: Number of chunks in the run
+            fn: Called as fn(job) on a worker thread
+        """
+        job = ChunkFetchScheduler.Job(stream, host, priority, index, count,
+                                      fn)
+        with self.__lock:
+            self.__queues[priority].setdefault(stream,
+                                               collections.deque()).append(job)
+            if self.__idle == 0 and self.__workers < self.max_workers:
+                self.__workers += 1
+                threading.Thread(target=self.__run,
+                                 name="chunk-fetch-{}".format(self.__workers),
+                                 daemon=True).start()
+            self.__lock.notify()
+
+    def promote(self, stream: typing.Any, index: int,
+                priority: int = BLOCKING) -> bool:
+        """
+        Move the fetch of a queued chunk up to a higher priority, the rest
+        of its run stays where it was
+        Returns:
+            Whether a queued job was found
+        """
+        with self.__lock:
+            for current in range(priority + 1, len(self.__queues)):
+                jobs = self.__queues[current].get(stream)
+                if jobs is None:
+                    continue
+                for position, job in enumerate(jobs):
+                    if job.index <= index < job.index + job.count:
+                        # Split the run, only the chunk itself moves up
+                        del jobs[position]
+                        for first, last in [(index + 1,
+                                             job.index + job.count),
+                                            (job.index, index)]:
+                            if first < last:
+                                jobs.insert(
+                                    position,
+                                    job.split(first, last - first, current))
+                        if len(jobs) == 0:
+                            del self.__queues[current][stream]
+                        self.__queues[priority].setdefault(
+                            stream, collections.deque()).appendleft(
+                                job.split(index, 1, priority))
+                        self.__lock.notify()
+                        return True
+        return False
+
+    def reprioritize(self, stream: typing.Any, priority: int) -> int:
+        """
+        Move every queued job of a stream with a lower priority up to
+        priority, keeping their order
+        Returns:
+            The number of moved jobs
+        """
+        moved = 0
+        with self.__lock:
+            target = self.__queues[priority].setdefault(
+                stream, collections.deque())
+            for current in range(priority + 1, len(self.__queues)):
+                jobs = self.__queues[current].pop(stream, None)
+                if jobs is None:
+                    continue
+                for job in jobs:
+                    job.priority = priority
+                    target.append(job)
+                moved += len(jobs)
+            if len(target) == 0:
+                del self.__queues[priority][stream]
+            elif moved > 0:
+                self.__lock.notify(moved)
+        return moved
+
+    def acquire(self,
+                host: str,
+                job: typing.Union[Job, None] = None,
+                wait: bool = True) -> bool:
+        """
+        Take a slot on host before sending a request, release it once the
+        response has been read
+        Args:
+            host: Host of the request
+            job: The job sending it, None counts as BLOCKING
+            wait: Wait for a free slot rather than giving up
+        Returns:
+            Whether a slot was taken
+        """
+        with self.__lock:
+            if job is not None and job.reserved is not None:
+                reserved = job.reserved
+                job.reserved = None
+                if reserved == host:
+                    # Taken when the job was dispatched
+                    return True
+                # The job went to another host than expected
+                self.__release(reserved)
+            limited = job is not None and job.priority != self.BLOCKING
+            while limited and self.__active.get(host,
+                                                0) >= self.max_per_host:
+                if not wait:
+                    return False
+                self.__lock.wait()
+            self.__active[host] = self.__active.get(host, 0) + 1
+            return True
+
+    def release(self, host: str) -> None:
+        with self.__lock:
+            self.__release(host)
+
+    def cancel(self, stream: typing.Any) -> int:
+        """
+        Drop every queued job of a stream, running jobs are left alone
+        Returns:
+            The number of dropped jobs
+        """
+        dropped = 0
+        with self.__lock:
+            for queue_ in self.__queues:
+                jobs = queue_.pop(stream, None)
+                if jobs is not None:
+                    dropped += len(jobs)
+        return dropped
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        """
+        Returns:
+            Per priority a job was submitted at: queue depth, completed
+            jobs, how many of them were promoted, average and max queue wait
+            time in seconds. Plus the requests running per host.
+        """
+        with self.__lock:
+            stats = {
+                "active": dict(self.__active),
+                "workers": self.__workers,
+            }
+            for priority, name in enumerate(self.priority_names):
+                completed = self.__completed[priority]
+                stats[name] = {
+                    "queued": sum(
+                        len(jobs)
+                        for jobs in self.__queues[priority].values()),
+                    "completed": completed,
+                    "promoted": self.__promoted[priority],
+                    "wait_time": 0.0 if completed == 0 else
+                    self.__wait_time[priority] / completed,
+                    "max_wait_time": self.__max_wait_time[priority],
+                }
+            return stats
+
+    def __next_job(self) -> typing.Union[Job, None]:
+        for priority, queue_ in enumerate(self.__queues):
+            for stream, jobs in queue_.items():
+                for job in jobs:
+                    if priority == self.BLOCKING or self.__active.get(
+                            job.host, 0) < self.max_per_host:
+                        jobs.remove(job)
+                        if len(jobs) == 0:
+                            del queue_[stream]
+                        else:
+                            queue_.move_to_end(stream)
+                        return job
+        return None
 
-        def wait_response(self) -> bytes:
-            with self.__reference_lock:
-                self.__reference_lock.wait(
-                    AudioKeyManager.audio_key_request_timeout)
-                return self.__reference.get(block=False)
+    def __run(self) -> None:
+        while True:
+            with self.__lock:
+                job = self.__next_job()
+                while job is None:
+                    self.__idle += 1
+                    self.__lock.wait()
+                    self.__idle -= 1
+                    job = self.__next_job()
+                # Counted by the priority the job was submitted at, a
+                # promoted job still waited as the lower one
+                wait_time = time.monotonic() - job.queued_at
+                self.__completed[job.submitted_priority] += 1
+                if job.priority < job.submitted_priority:
+                    self.__promoted[job.submitted_priority] += 1
+                self.__wait_time[job.submitted_priority] += wait_time
+                self.__max_wait_time[job.submitted_priority] = max(
+                    self.__max_wait_time[job.submitted_priority], wait_time)
+                self.__active[job.host] = self.__active.get(job.host, 0) + 1
+                job.reserved = job.host
+            try:
+                job.fn(job)
+            except Exception as ex:
+                self.logger.error("Chunk fetch job failed: {}".format(ex))
+            finally:
+                with self.__lock:
+                    if job.reserved is not None:
+                        self.__release(job.reserved)
+                        job.reserved = None
+
+    def __release(self, host: str) -> None:
+        self.__active[host] -= 1
+        if self.__active[host] == 0:
+            del self.__active[host]
+        self.__lock.notify_all()
+
+    class Job:
+        count: int
+        fn: typing.Callable[[ChunkFetchScheduler.Job], None]
+        host: str
+        index: int
+        priority: int
+        queued_at: float
+        reserved: typing.Union[str, None] = None
+        stream: typing.Any
+        submitted_priority: int
+
+        def __init__(self, stream: typing.Any, host: str, priority: int,
+                     index: int, count: int,
+                     fn: typing.Callable[[ChunkFetchScheduler.Job], None]):
+            self.stream = stream
+            self.host = host
+            self.priority = priority
+            self.submitted_priority = priority
+            self.index = index
+            self.count = count
+            self.fn = fn
+            self.queued_at = time.monotonic()
+
+        def split(self, index: int, count: int,
+                  priority: int) -> ChunkFetchScheduler.Job:
+            """
+            Part of the run as a job of its own, queued since this one was
+            """
+            job = ChunkFetchScheduler.Job(self.stream, self.host, priority,
+                                          index, count, self.fn)
+            job.queued_at = self.queued_at
+            job.submitted_priority = self.submitted_priority
+            return job
 
 
 class CdnFeedHelper:
     _LOGGER: logging = logging.getLogger(__name__)
 
     @staticmethod
-    def get_url(resp: StorageResolve.StorageResolveResponse) -> str:
+    def get_url(resp: StorageResolve.StorageResolveResponse,
+                session: Session = None) -> str:
+        """
+        Pick the best url of a storage-resolve response by the session's
+        host scores, or any non-fallback url without a session
+        """
+        if session is not None:
+            return session.cdn().scoreboard.rank(resp.cdnurl)[0]
         selected_url = random.choice(resp.cdnurl)
         while "audio4-gm-fb" in selected_url or "audio-gm-fb" in selected_url:
             selected_url = random.choice(resp.cdnurl)
@@ -331,17 +910,29 @@ class CdnFeedHelper:
             session: Session, track: Metadata.Track, file: Metadata.AudioFile,
             resp_or_url: typing.Union[StorageResolve.StorageResolveResponse,
                                       str], preload: bool,
-            halt_listener: HaltListener) -> LoadedStream:
+            halt_listener: HaltListener,
+            key: typing.Union[bytes, concurrent.futures.Future, None] = None,
+            stage_times: typing.Dict[str, int] = None) -> LoadedStream:
         if type(resp_or_url) is str:
             url = resp_or_url
         else:
-            url = CdnFeedHelper.get_url(resp_or_url)
-        start = int(time.time() * 1000)
-        key = session.audio_key().get_audio_key(track.gid, file.file_id)
-        audio_key_time = int(time.time() * 1000) - start
+            url = list(resp_or_url.cdnurl)
+        if stage_times is None:
+            stage_times = {}
+        preloaded_audio_key = False
+        if key is None:
+            key = session.cache().audio_keys().get(track.gid, file.file_id)
+            preloaded_audio_key = key is not None
+        if key is None:
+            start = int(time.time() * 1000)
+            key = session.audio_key().get_audio_key(track.gid, file.file_id)
+            stage_times["audio_key"] = int(time.time() * 1000) - start
 
         streamer = session.cdn().stream_file(file, key, url, halt_listener)
+        stage_times["first_chunk"] = streamer.first_chunk_time
         input_stream = streamer.stream()
+        if preload:
+            input_stream.priority = ChunkFetchScheduler.PRELOAD
         normalization_data = NormalizationData.read(input_stream)
         if input_stream.skip(0xA7) != 0xA7:
             raise IOError("Couldn't skip 0xa7 bytes!")
@@ -349,7 +940,8 @@ class CdnFeedHelper:
             track,
             streamer,
             normalization_data,
-            file.file_id, preload, audio_key_time
+            file.file_id, preloaded_audio_key, stage_times.get("audio_key", -1),
+            stage_times
         )
 
     @staticmethod
@@ -382,17 +974,29 @@ class CdnFeedHelper:
         resp_or_url: typing.Union[StorageResolve.StorageResolveResponse, str],
         preload: bool,
         halt_listener: HaltListener,
+        key: typing.Union[bytes, concurrent.futures.Future, None] = None,
+        stage_times: typing.Dict[str, int] = None,
     ) -> LoadedStream:
         if type(resp_or_url) is str:
             url = resp_or_url
         else:
-            url = CdnFeedHelper.get_url(resp_or_url)
-        start = int(time.time() * 1000)
-        key = session.audio_key().get_audio_key(episode.gid, file.file_id)
-        audio_key_time = int(time.time() * 1000) - start
+            url = list(resp_or_url.cdnurl)
+        if stage_times is None:
+            stage_times = {}
+        preloaded_audio_key = False
+        if key is None:
+            key = session.cache().audio_keys().get(episode.gid, file.file_id)
+            preloaded_audio_key = key is not None
+        if key is None:
+            start = int(time.time() * 1000)
+            key = session.audio_key().get_audio_key(episode.gid, file.file_id)
+            stage_times["audio_key"] = int(time.time() * 1000) - start
 
         streamer = session.cdn().stream_file(file, key, url, halt_listener)
+        stage_times["first_chunk"] = streamer.first_chunk_time
         input_stream = streamer.stream()
+        if preload:
+            input_stream.priority = ChunkFetchScheduler.PRELOAD
         normalization_data = NormalizationData.read(input_stream)
         if input_stream.skip(0xA7) != 0xA7:
             raise IOError("Couldn't skip 0xa7 bytes!")
@@ -400,16 +1004,21 @@ class CdnFeedHelper:
             episode,
             streamer,
             normalization_data,
-            file.file_id, preload, audio_key_time
+            file.file_id, preloaded_audio_key, stage_times.get("audio_key", -1),
+            stage_times
         )
 
 
 class CdnManager:
     logger: logging = logging.getLogger("Librespot:CdnManager")
+    resolve_cache: StorageResolveCache
+    scoreboard: HostScoreboard
     __session: Session
 
     def __init__(self, session: Session):
         self.__session = session
+        self.resolve_cache = CdnManager.StorageResolveCache(self)
+        self.scoreboard = CdnManager.HostScoreboard()
 
     def get_head(self, file_id: bytes):
         response = self.__session.client() \
@@ -435,7 +1044,8 @@ class CdnManager:
             halt_listener,
         )
 
-    def stream_file(self, file: Metadata.AudioFile, key: bytes, url: str,
+    def stream_file(self, file: Metadata.AudioFile, key: bytes,
+                    url: typing.Union[str, typing.List[str]],
                     halt_listener: HaltListener):
         return CdnManager.Streamer(
             self.__session,
@@ -447,27 +1057,274 @@ class CdnManager:
             halt_listener,
         )
 
-    def get_audio_url(self, file_id: bytes):
-        response = self.__session.api()\
-            .send("GET", "/storage-resolve/files/audio/interactive/{}".format(util.bytes_to_hex(file_id)), None, None)
-        if response.status_code != 200:
-            raise IOError(response.status_code)
-        body = response.content
-        if body is None:
-            raise IOError("Response body is empty!")
-        proto = StorageResolve.StorageResolveResponse()
-        proto.ParseFromString(body)
+    def get_audio_url(self, file_id: bytes) -> str:
+        return self.scoreboard.rank(self.get_audio_urls(file_id))[0]
+
+    def get_audio_urls(self, file_id: bytes) -> typing.List[str]:
+        proto = self.resolve_storage(file_id)
         if proto.result == StorageResolve.StorageResolveResponse.Result.CDN:
-            url = random.choice(proto.cdnurl)
-            self.logger.debug("Fetched CDN url for {}: {}".format(
-                util.bytes_to_hex(file_id), url))
-            return url
+            self.logger.debug("Fetched CDN urls for {}: {}".format(
+                util.bytes_to_hex(file_id), proto.cdnurl))
+            return list(proto.cdnurl)
         raise CdnManager.CdnException(
             "Could not retrieve CDN url! result: {}".format(proto.result))
 
+    def resolve_storage(
+            self,
+            file_id: bytes,
+            preload: bool = False) -> StorageResolve.StorageResolveResponse:
+        """
+        Resolve a file through the storage-resolve cache
+        """
+        return self.resolve_cache.resolve(file_id, preload)
+
+    def fetch_storage_resolve(
+            self, file_id: bytes,
+            preload: bool) -> StorageResolve.StorageResolveResponse:
+        resp = self.__session.api().send(
+            "GET",
+            (PlayableContentFeeder.storage_resolve_interactive_prefetch
+             if preload else
+             PlayableContentFeeder.storage_resolve_interactive).format(
+                 util.bytes_to_hex(file_id)),
+            None,
+            None,
+            coalesce=True,
+        )
+        if resp.status_code != 200:
+            raise RuntimeError(resp.status_code)
+        body = resp.content
+        if body is None:
+            raise RuntimeError("Response body is empty!")
+        storage_resolve_response = StorageResolve.StorageResolveResponse()
+        storage_resolve_response.ParseFromString(body)
+        return storage_resolve_response
+
     class CdnException(Exception):
         pass
 
+    class ExpiredUrlException(CdnException):
+        """
+        The CDN refused a url with 401 or 403, its token has expired
+        """
+        pass
+
+    class StorageResolveCache:
+        """
+        Storage-resolve responses by file_id. Entries are served until
+        shortly before their CDN urls expire and are refreshed in the
+        background once they get within refresh_margin of the expiration.
+        """
+        default_ttl = 10 * 60 * 1000
+        executor_service = concurrent.futures.ThreadPoolExecutor()
+        expiry_margin = 60 * 1000
+        max_entries = 1024
+        refresh_margin = 5 * 60 * 1000
+        __cdn_manager: CdnManager
+        __entries: typing.OrderedDict[bytes, typing.Tuple[
+            StorageResolve.StorageResolveResponse, int]]
+        __hits = 0
+        __lock: threading.Lock
+        __misses = 0
+        __refreshes = 0
+        __refreshing: typing.Set[bytes]
+
+        def __init__(self, cdn_manager: CdnManager):
+            self.__cdn_manager = cdn_manager
+            self.__entries = collections.OrderedDict()
+            self.__lock = threading.Lock()
+            self.__refreshing = set()
+
+        def resolve(
+            self,
+            file_id: bytes,
+            preload: bool = False,
+            wait: bool = True
+        ) -> typing.Union[StorageResolve.StorageResolveResponse, None]:
+            """
+            Args:
+                file_id: Audio file id
+                preload: Use the prefetch endpoint on a miss
+                wait: Resolve synchronously on a miss, otherwise only start
+                    a background refresh and return None
+            """
+            now = int(time.time() * 1000)
+            with self.__lock:
+                entry = self.__entries.get(file_id)
+                if entry is not None and now < entry[1] - self.expiry_margin:
+                    self.__entries.move_to_end(file_id)
+                    self.__hits += 1
+                    if now >= entry[1] - self.refresh_margin:
+                        self.__refresh_async(file_id)
+                    return entry[0]
+                self.__misses += 1
+                if not wait:
+                    self.__refresh_async(file_id)
+                    return None
+            return self.__fetch(file_id, preload)
+
+        def invalidate(self, file_id: bytes) -> None:
+            with self.__lock:
+                self.__entries.pop(file_id, None)
+
+        def stats(self) -> typing.Dict[str, int]:
+            with self.__lock:
+                return {
+                    "hits": self.__hits,
+                    "misses": self.__misses,
+                    "refreshes": self.__refreshes,
+                    "entries": len(self.__entries),
+                }
+
+        def __fetch(
+                self, file_id: bytes,
+                preload: bool) -> StorageResolve.StorageResolveResponse:
+            response = self.__cdn_manager.fetch_storage_resolve(
+                file_id, preload)
+            if response.result != StorageResolve.StorageResolveResponse.Result.CDN \
+                    or len(response.cdnurl) == 0:
+                return response
+            expirations = [
+                expiration for expiration in map(
+                    CdnManager.CdnUrl.parse_expiration, response.cdnurl)
+                if expiration != -1
+            ]
+            expiration = min(expirations) if len(expirations) > 0 \
+                else int(time.time() * 1000) + self.default_ttl
+            with self.__lock:
+                self.__entries[file_id] = (response, expiration)
+                self.__entries.move_to_end(file_id)
+                while len(self.__entries) > self.max_entries:
+                    self.__entries.popitem(last=False)
+            return response
+
+        def __refresh(self, file_id: bytes) -> None:
+            try:
+                self.__fetch(file_id, False)
+            except Exception as ex:
+                CdnManager.logger.warning(
+                    "Failed refreshing CDN urls for {}: {}".format(
+                        util.bytes_to_hex(file_id), ex))
+            finally:
+                with self.__lock:
+                    self.__refreshing.discard(file_id)
+
+        def __refresh_async(self, file_id: bytes) -> None:
+            if file_id in self.__refreshing:
+                return
+            self.__refreshing.add(file_id)
+            self.__refreshes += 1
+            self.executor_service.submit(self.__refresh, file_id)
+
+    class HostScoreboard:
+        """
+        Tracks time to first byte, throughput and error rate per CDN host
+        and ranks candidate urls by their expected chunk fetch time
+        """
+        alpha = 0.3
+        error_penalty = 4.0
+        fallback_hosts = ["audio4-gm-fb", "audio-gm-fb"]
+        hedge_default_delay = 1.0
+        hedge_factor = 3.0
+        hedge_min_delay = 0.1
+        __hosts: typing.Dict[str, typing.Dict[str, float]]
+        __lock: threading.Lock
+
+        def __init__(self):
+            self.__hosts = {}
+            self.__lock = threading.Lock()
+
+        @staticmethod
+        def host(url: str) -> str:
+            return urllib.parse.urlparse(url).netloc
+
+        def hedge_delay(self, url: str) -> float:
+            """
+            Time to wait for the first byte before hedging against another host
+            """
+            ttfb = self.ttfb(url)
+            if ttfb < 0:
+                return self.hedge_default_delay
+            return max(self.hedge_min_delay, self.hedge_factor * ttfb)
+
+        def rank(self, urls: typing.Iterable[str]) -> typing.List[str]:
+            """
+            Sort urls from best to worst, unknown hosts are tried first and
+            fallback hosts are only used as a last resort
+            """
+            urls = list(urls)
+            if len(urls) == 0:
+                raise CdnManager.CdnException("No CDN url available!")
+            random.shuffle(urls)
+            return sorted(urls, key=lambda url: (any(
+                fb in url for fb in self.fallback_hosts), self.score(url)))
+
+        def record_error(self, url: str) -> None:
+            with self.__lock:
+                stats = self.__stats(url)
+                stats["errors"] += 1
+                stats["error_rate"] = self.__smooth(stats["error_rate"], 1)
+
+        def record_transfer(self, url: str, length: int,
+                            elapsed: float) -> None:
+            with self.__lock:
+                stats = self.__stats(url)
+                if elapsed > 0:
+                    stats["throughput"] = self.__smooth(stats["throughput"],
+                                                        length / elapsed)
+
+        def record_ttfb(self, url: str, ttfb: float) -> None:
+            with self.__lock:
+                stats = self.__stats(url)
+                stats["requests"] += 1
+                stats["ttfb"] = self.__smooth(stats["ttfb"], ttfb)
+                stats["error_rate"] = self.__smooth(stats["error_rate"], 0)
+
+        def score(self, url: str) -> float:
+            """
+            Expected seconds to fetch a chunk from the host, 0 if unknown
+            """
+            with self.__lock:
+                stats = self.__hosts.get(self.host(url))
+                if stats is None:
+                    return 0
+                cost = max(stats["ttfb"], 0)
+                if stats["throughput"] > 0:
+                    cost += ChannelManager.chunk_size / stats["throughput"]
+                return cost * (1 + self.error_penalty * stats["error_rate"]) \
+                    + self.error_penalty * stats["error_rate"]
+
+        def stats(self) -> typing.Dict[str, typing.Dict[str, float]]:
+            with self.__lock:
+                return {
+                    host: dict(stats)
+                    for host, stats in self.__hosts.items()
+                }
+
+        def ttfb(self, url: str) -> float:
+            with self.__lock:
+                stats = self.__hosts.get(self.host(url))
+                return -1 if stats is None else stats["ttfb"]
+
+        def __smooth(self, current: float, sample: float) -> float:
+            if current < 0:
+                return sample
+            return self.alpha * sample + (1 - self.alpha) * current
+
+        def __stats(self, url: str) -> typing.Dict[str, float]:
+            host = self.host(url)
+            stats = self.__hosts.get(host)
+            if stats is None:
+                stats = {
+                    "requests": 0,
+                    "errors": 0,
+                    "error_rate": 0,
+                    "ttfb": -1,
+                    "throughput": -1,
+                }
+                self.__hosts[host] = stats
+            return stats
+
     class InternalResponse:
         buffer: bytes
         headers: CaseInsensitiveDict[str, str]
@@ -481,85 +1338,150 @@ class CdnManager:
         __file_id: bytes
         __expiration: int
         url: str
+        urls: typing.List[str]
 
         def __init__(self, cdn_manager, file_id: typing.Union[bytes, None],
-                     url: str):
+                     url: typing.Union[str, typing.List[str]]):
             self.__cdn_manager: CdnManager = cdn_manager
             self.__file_id = file_id
             self.set_url(url)
 
-        def url(self):
-            if self.__expiration == -1:
-                return self.url
-            if self.__expiration <= int(time.time() * 1000) + 5 * 60 * 1000:
-                self.url = self.__cdn_manager.get_audio_url(self.__file_id)
-            return self.url
+        def candidates(self) -> typing.List[str]:
+            """
+            All known urls for the file, best first
+            """
+            self.__refresh_if_expiring()
+            return self.scoreboard().rank(self.urls)
+
+        def refresh(self, urls: typing.List[str]) -> bool:
+            """
+            Replace urls the CDN rejected as expired with freshly resolved
+            ones, dropping the storage-resolve cache entry that held them
+            Args:
+                urls: The urls that were rejected, nothing is resolved if
+                    they were already replaced meanwhile
+            Returns:
+                Whether there are other urls to try
+            """
+            if self.__file_id is None:
+                return False
+            if self.urls != urls:
+                return True
+            cache = self.__cdn_manager.resolve_cache
+            cache.invalidate(self.__file_id)
+            response = cache.resolve(self.__file_id)
+            if len(response.cdnurl) == 0:
+                return False
+            self.set_url(list(response.cdnurl))
+            return True
+
+        def scoreboard(self) -> CdnManager.HostScoreboard:
+            return self.__cdn_manager.scoreboard
 
-        def set_url(self, url: str):
-            self.url = url
+        def set_url(self, url: typing.Union[str, typing.List[str]]):
+            self.urls = [url] if type(url) is str else list(url)
+            self.url = self.scoreboard().rank(self.urls)[0]
             if self.__file_id is not None:
-                token_url = urllib.parse.urlparse(url)
-                token_query = urllib.parse.parse_qs(token_url.query)
-                token_list = token_query.get("__token__")
-                try:
-                    token_str = str(token_list[0])
-                except TypeError:
-                    token_str = ""
-                expires_list = token_query.get("Expires")
-                try:
-                    expires_str = str(expires_list[0])
-                except TypeError:
-                    expires_str = ""
-                if token_str != "None" and len(token_str) != 0:
-                    expire_at = None
-                    split = token_str.split("~")
-                    for s in split:
+                self.__expiration = CdnManager.CdnUrl.parse_expiration(
+                    self.url)
+            else:
+                self.__expiration = -1
+
+        def __refresh_if_expiring(self) -> None:
+            """
+            Swap in urls from the storage-resolve cache once ours get close
+            to expiring. The cache refreshes them in the background, the
+            fetch only blocks if the urls are about to expire.
+            """
+            if self.__expiration == -1 or self.__file_id is None:
+                return
+            cache = self.__cdn_manager.resolve_cache
+            now = int(time.time() * 1000)
+            if now < self.__expiration - cache.refresh_margin:
+                return
+            response = cache.resolve(
+                self.__file_id,
+                wait=now >= self.__expiration - cache.expiry_margin)
+            if response is not None and len(response.cdnurl) > 0 \
+                    and list(response.cdnurl) != self.urls:
+                self.set_url(list(response.cdnurl))
+
+        @staticmethod
+        def parse_expiration(url: str) -> int:
+            """
+            Extract the expiration of a CDN url
+            Returns:
+                Expiration in milliseconds since epoch, -1 if unknown
+            """
+            token_url = urllib.parse.urlparse(url)
+            token_query = urllib.parse.parse_qs(token_url.query)
+            token_list = token_query.get("__token__")
+            try:
+                token_str = str(token_list[0])
+            except TypeError:
+                token_str = ""
+            expires_list = token_query.get("Expires")
+            try:
+                expires_str = str(expires_list[0])
+            except TypeError:
+                expires_str = ""
+            if token_str != "None" and len(token_str) != 0:
+                expire_at = None
+                split = token_str.split("~")
+                for s in split:
+                    try:
+                        i = s.index("=")
+                    except ValueError:
+                        continue
+                    if s[:i] == "exp":
                         try:
-                            i = s.index("=")
-                        except ValueError:
-                            continue
-                        if s[:i] == "exp":
                             expire_at = int(s[i + 1:])
-                            break
-                    if expire_at is None:
-                        self.__expiration = -1
-                        self.__cdn_manager.logger.warning(
-                            "Invalid __token__ in CDN url: {}".format(url))
-                        return
-                    self.__expiration = expire_at * 1000
-                elif expires_str != "None" and len(expires_str) != 0:
-                    expires_at = None
-                    expires_str = expires_str.split("~")[0]
+                        except ValueError:
+                            pass
+                        break
+                if expire_at is None:
+                    CdnManager.logger.warning(
+                        "Invalid __token__ in CDN url: {}".format(url))
+                    return -1
+                return expire_at * 1000
+            elif expires_str != "None" and len(expires_str) != 0:
+                expires_str = expires_str.split("~")[0]
+                try:
                     expires_at = int(expires_str)
-                    if expires_at is None:
-                        self.__expiration = -1
-                        self.__cdn_manager.logger.warning("Invalid Expires param in CDN url: {}".format(url))
-                        return
-                    self.__expiration = expires_at * 1000
-                else:
-                    try:
-                        i = token_url.query.index("_")
-                    except ValueError:
-                        self.__expiration = -1
-                        self.__cdn_manager.logger \
-                            .warning("Couldn't extract expiration, invalid parameter in CDN url: {}".format(url))
-                        return
-                    self.__expiration = int(token_url.query[:i]) * 1000
-
+                except ValueError:
+                    CdnManager.logger.warning("Invalid Expires param in CDN url: {}".format(url))
+                    return -1
+                return expires_at * 1000
             else:
-                self.__expiration = -1
+                try:
+                    i = token_url.query.index("_")
+                    return int(token_url.query[:i]) * 1000
+                except ValueError:
+                    CdnManager.logger \
+                        .warning("Couldn't extract expiration, invalid parameter in CDN url: {}".format(url))
+                    return -1
 
     class Streamer(GeneralAudioStream, GeneralWritableStream):
         available: typing.List[bool]
         buffer: typing.List[bytes]
         chunks: int
         executor_service = concurrent.futures.ThreadPoolExecutor()
+        fast_start_size = 16 * 1024
+        first_chunk_time = -1
         halt_listener: HaltListener
+        head = b""
+        hedge_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=4, thread_name_prefix="cdn-hedge")
+        hedge_requests = True
+        max_chunks_per_request = 8
         requested: typing.List[bool]
+        scheduler = ChunkFetchScheduler()
         size: int
         __audio_format: SuperAudioFormat
         __audio_decrypt: AudioDecrypt
+        __cache_handler: typing.Union[CacheManager.Handler, None]
         __cdn_url: CdnManager.CdnUrl
+        __head_raw = b""
         __internal_stream: InternalStream
         __session: Session
         __stream_id: StreamId
@@ -574,22 +1496,56 @@ class CdnManager:
             self.__audio_decrypt = audio_decrypt
             self.__cdn_url = cdn_url
             self.halt_listener = halt_listener
-            response = self.request(range_start=0,
-                                    range_end=ChannelManager.chunk_size - 1)
-            content_range = response.headers.get("Content-Range")
-            if content_range is None:
-                raise IOError("Missing Content-Range header!")
-            split = content_range.split("/")
-            self.size = int(split[1])
+            self.__cache_handler = None if cache is None else cache.get_handler(
+                stream_id)
+            first_chunk = None
+            size_header = None
+            if self.__cache_handler is not None:
+                size_header = self.__cache_handler.get_header(
+                    CacheManager.header_size)
+                first_chunk = self.__cache_handler.read_chunk(0)
+            from_cache = first_chunk is not None and size_header is not None
+            if from_cache:
+                self.size = struct.unpack(">I", size_header)[0]
+            else:
+                head_size = self.fast_start_size \
+                    if session.configuration().fast_start \
+                    else ChannelManager.chunk_size
+                start = time.monotonic()
+                response = self.request(range_start=0,
+                                        range_end=head_size - 1)
+                self.first_chunk_time = int(
+                    (time.monotonic() - start) * 1000)
+                content_range = response.headers.get("Content-Range")
+                if content_range is None:
+                    raise IOError("Missing Content-Range header!")
+                split = content_range.split("/")
+                self.size = int(split[1])
+                first_chunk = response.buffer
+                if len(first_chunk) < min(ChannelManager.chunk_size,
+                                          self.size):
+                    # Fast start, the rest of the chunk is fetched later
+                    self.__head_raw = first_chunk
+                    first_chunk = None
+                if self.__cache_handler is not None:
+                    self.__cache_handler.set_header(
+                        CacheManager.header_size, struct.pack(">I", self.size))
+                    if first_chunk is not None:
+                        self.__cache_handler.write_chunk(first_chunk, 0)
             self.chunks = int(math.ceil(self.size / ChannelManager.chunk_size))
-            first_chunk = response.buffer
             self.available = [False for _ in range(self.chunks)]
             self.requested = [False for _ in range(self.chunks)]
             self.buffer = [b"" for _ in range(self.chunks)]
             self.__internal_stream = CdnManager.Streamer.InternalStream(
-                self, False)
+                self, session.configuration().retry_on_chunk_error)
             self.requested[0] = True
-            self.write_chunk(first_chunk, 0, False)
+            if first_chunk is None:
+                self.head = self.__audio_decrypt.decrypt_chunk(
+                    0, self.__head_raw)
+                self.__internal_stream.request_chunks_from_stream(
+                    0, 1, ChunkFetchScheduler.READ_AHEAD)
+            else:
+                self.write_chunk(first_chunk, 0, from_cache)
 
         def write_chunk(self, chunk: bytes, chunk_index: int,
                         cached: bool) -> None:
@@ -617,9 +1573,262 @@ class CdnManager:
         def decrypt_time_ms(self) -> int:
             return self.__audio_decrypt.decrypt_time_ms()
 
+        def fill_cache(self) -> None:
+            """
+            Download every remaining chunk at background priority so the
+            whole file ends up in the cache
+            """
+            if self.__cache_handler is not None:
+                self.__internal_stream.request_all_chunks(
+                    ChunkFetchScheduler.BACKGROUND)
+
+        def host(self) -> str:
+            return self.__cdn_url.scoreboard().host(self.__cdn_url.url)
+
         def request_chunk(self, index: int) -> None:
-            response = self.request(index)
-            self.write_chunk(response.buffer, index, False)
+            self.request_chunks(index, 1)
+
+        def request_chunks(
+                self,
+                index: int,
+                count: int,
+                job: typing.Union[ChunkFetchScheduler.Job, None] = None
+        ) -> None:
+            """
+            Fetch a run of contiguous chunks, serving cached ones from disk and
+            each contiguous run of the rest with one range request, splitting
+            the body as it arrives
+            Args:
+                index: First chunk
+                count: Number of chunks
+                job: The scheduler job fetching them, its requests take host
+                    slots at its priority
+            """
+            missing = []
+            for i in range(index, index + count):
+                chunk = None if self.__cache_handler is None \
+                    else self.__cache_handler.read_chunk(i)
+                if chunk is None:
+                    missing.append(i)
+                else:
+                    self.write_chunk(chunk, i, True)
+            start = 0
+            for i in range(1, len(missing) + 1):
+                if i == len(missing) or missing[i] != missing[i - 1] + 1:
+                    self.__fetch_chunks(missing[start], missing[i - 1], job)
+                    start = i
+
+        def __fetch_chunks(
+                self, first: int, last: int,
+                job: typing.Union[ChunkFetchScheduler.Job, None]) -> None:
+            self.__with_fresh_urls(self.__race, first, last, job)
+
+        def __with_fresh_urls(self, fn: typing.Callable, *args):
+            """
+            Call fn, resolving the urls again and calling it once more if
+            the CDN rejects them as expired
+            """
+            urls = list(self.__cdn_url.urls)
+            try:
+                return fn(*args)
+            except CdnManager.ExpiredUrlException:
+                if not self.__cdn_url.refresh(urls):
+                    raise
+                CdnManager.logger.info(
+                    "CDN urls of {} expired, resolved them again".format(
+                        self.describe()))
+            return fn(*args)
+
+        def __open(self, range_start: int,
+                   range_end: int) -> typing.Tuple[typing.Any, str]:
+            """
+            Open a streamed range request on the best host, failing over to
+            the next ones
+            """
+            headers = CaseInsensitiveDict(
+                {"Range": "bytes={}-{}".format(range_start, range_end)})
+            error = None
+            for url in self.__cdn_url.candidates():
+                host = CdnManager.HostScoreboard.host(url)
+                self.scheduler.acquire(host)
+                try:
+                    response = self.__get(url, headers)
+                except Exception as ex:
+                    self.scheduler.release(host)
+                    # An expired url is reported over other failures, it is
+                    # the one a retry can fix
+                    if not isinstance(error, CdnManager.ExpiredUrlException):
+                        error = ex
+                    CdnManager.logger.warning(
+                        "CDN request to {} failed: {}".format(host, ex))
+                    continue
+                # The caller releases the slot once the body has been read
+                self.__cdn_url.url = url
+                return response, url
+            raise error
+
+        def __race(self, first: int, last: int,
+                   job: typing.Union[ChunkFetchScheduler.Job, None]) -> None:
+            """
+            Fetch a run of chunks from the best host. The request runs on
+            the calling thread, if it has no response within the host's
+            hedge delay a hedge against the next host is started on
+            hedge_executor and whichever responds first delivers the
+            chunks. Failing hosts are skipped. Every request takes a host
+            slot from the scheduler.
+            """
+            # Only the part of chunk 0 past the fast start head is missing
+            head = self.__head_raw if first == 0 else b""
+            headers = CaseInsensitiveDict({
+                "Range":
+                "bytes={}-{}".format(
+                    first * ChannelManager.chunk_size + len(head),
+                    min((last + 1) * ChannelManager.chunk_size, self.size) -
+                    1)
+            })
+            race = CdnManager.Streamer.Race(self.__cdn_url.candidates())
+            start = time.monotonic()
+            if self.hedge_requests and race.remaining() > 1:
+                race.arm_hedge()
+                self.hedge_executor.submit(
+                    self.__hedge, race, headers, first, last, head, job,
+                    start, start +
+                    self.__cdn_url.scoreboard().hedge_delay(race.first_url))
+            while True:
+                url = race.next_url()
+                if url is None:
+                    break
+                host = CdnManager.HostScoreboard.host(url)
+                self.scheduler.acquire(host, job)
+                try:
+                    try:
+                        response = self.__get(url, headers)
+                    except Exception as ex:
+                        race.fail(ex)
+                        CdnManager.logger.warning(
+                            "CDN request to {} failed: {}".format(host, ex))
+                        continue
+                    if not race.claim():
+                        # The hedge won, it delivers the chunks
+                        response.close()
+                        break
+                    self.__transfer(race, response, url, first, last, head,
+                                    start)
+                    return
+                finally:
+                    self.scheduler.release(host)
+            race.wait()
+
+        def __hedge(self, race: CdnManager.Streamer.Race,
+                    headers: CaseInsensitiveDict, first: int, last: int,
+                    head: bytes,
+                    job: typing.Union[ChunkFetchScheduler.Job, None],
+                    start: float, due: float) -> None:
+            try:
+                if not race.wait_hedge(due):
+                    return
+                url = race.next_url()
+                if url is None:
+                    return
+                host = CdnManager.HostScoreboard.host(url)
+                if not self.scheduler.acquire(host, job, wait=False):
+                    # A hedge is only worth it while the host has room
+                    race.put_back(url)
+                    return
+                try:
+                    CdnManager.logger.debug(
+                        "Hedging {} of {} against {}".format(
+                            headers["Range"], self.describe(), host))
+                    try:
+                        response = self.__get(url, headers)
+                    except Exception as ex:
+                        race.fail(ex)
+                        return
+                    if not race.claim():
+                        response.close()
+                        return
+                    try:
+                        self.__transfer(race, response, url, first, last,
+                                        head, start)
+                    except Exception:
+                        # Reported by the thread waiting on the race
+                        pass
+                finally:
+                    self.scheduler.release(host)
+            finally:
+                race.hedge_done()
+
+        def __transfer(self, race: CdnManager.Streamer.Race, response,
+                       url: str, first: int, last: int, head: bytes,
+                       start: float) -> None:
+            transfer_start = time.monotonic()
+            try:
+                pending = bytearray(head)
+                current = first
+                for data in response.iter_content(ChannelManager.chunk_size):
+                    pending += data
+                    while current <= last:
+                        length = min(ChannelManager.chunk_size,
+                                     self.size -
+                                     current * ChannelManager.chunk_size)
+                        if len(pending) < length:
+                            break
+                        chunk = bytes(pending[:length])
+                        del pending[:length]
+                        self.__store_chunk(chunk, current)
+                        current += 1
+                if current <= last:
+                    raise IOError("Response body is too short!")
+                self.__internal_stream.read_ahead.on_chunk_downloaded(
+                    ChannelManager.chunk_size,
+                    (time.monotonic() - start) / (last - first + 1))
+                self.__cdn_url.scoreboard().record_transfer(
+                    url, (current - first) * ChannelManager.chunk_size,
+                    time.monotonic() - transfer_start)
+                self.__cdn_url.url = url
+            except Exception as ex:
+                self.__cdn_url.scoreboard().record_error(url)
+                race.finish(ex)
+                raise
+            finally:
+                response.close()
+            race.finish()
+
+        def __get(self, url: str, headers: CaseInsensitiveDict):
+            scoreboard = self.__cdn_url.scoreboard()
+            start = time.monotonic()
+            try:
+                response = self.__session.client().get(url,
+                                                       headers=headers,
+                                                       stream=True)
+            except Exception:
+                scoreboard.record_error(url)
+                raise
+            if response.status_code in (401, 403):
+                # Not the host's fault, the token in the url has expired
+                response.close()
+                raise CdnManager.ExpiredUrlException(response.status_code)
+            if response.status_code != 206:
+                response.close()
+                scoreboard.record_error(url)
+                raise IOError(response.status_code)
+            scoreboard.record_ttfb(url, time.monotonic() - start)
+            return response
+
+        def __store_chunk(self, chunk: bytes, index: int) -> None:
+            if self.__cache_handler is not None:
+                try:
+                    self.__cache_handler.write_chunk(chunk, index)
+                except OSError as ex:
+                    self.__session.logger.warning(
+                        "Failed writing chunk {} to cache: {}".format(index, ex))
+            self.write_chunk(chunk, index, False)
+
+        def close(self) -> None:
+            self.scheduler.cancel(self)
+            if self.__cache_handler is not None:
+                self.__cache_handler.close()
+                self.__cache_handler = None
 
         def request(self, chunk: int = None, range_start: int = None, range_end: int = None)\
                 -> CdnManager.InternalResponse:
@@ -628,19 +1837,122 @@ class CdnManager:
             if chunk is not None:
                 range_start = ChannelManager.chunk_size * chunk
                 range_end = (chunk + 1) * ChannelManager.chunk_size - 1
-            response = self.__session.client().get(
-                self.__cdn_url.url,
-                headers=CaseInsensitiveDict({
-                    "Range": "bytes={}-{}".format(range_start, range_end)
-                }),
-            )
-            if response.status_code != 206:
-                raise IOError(response.status_code)
-            body = response.content
+            response, url = self.__with_fresh_urls(self.__open, range_start,
+                                                   range_end)
+            start = time.monotonic()
+            try:
+                body = response.content
+            except Exception:
+                self.__cdn_url.scoreboard().record_error(url)
+                raise
+            finally:
+                response.close()
+                self.scheduler.release(CdnManager.HostScoreboard.host(url))
             if body is None:
                 raise IOError("Response body is empty!")
+            self.__cdn_url.scoreboard().record_transfer(
+                url, len(body), time.monotonic() - start)
             return CdnManager.InternalResponse(body, response.headers)
 
+        class Race:
+            """
+            A range request and its hedge, the first response to claim the
+            race delivers the chunks
+            """
+            first_url: str
+            __claimed = False
+            __cond: threading.Condition
+            __error: typing.Union[Exception, None] = None
+            __failure: typing.Union[Exception, None] = None
+            __finished = False
+            __hedges = 0
+            __urls: typing.List[str]
+
+            def __init__(self, urls: typing.List[str]):
+                self.__cond = threading.Condition()
+                self.__urls = list(urls)
+                self.first_url = self.__urls[0]
+
+            def arm_hedge(self) -> None:
+                with self.__cond:
+                    self.__hedges += 1
+
+            def claim(self) -> bool:
+                with self.__cond:
+                    if self.__claimed:
+                        return False
+                    self.__claimed = True
+                    self.__cond.notify_all()
+                    return True
+
+            def fail(self, ex: Exception) -> None:
+                with self.__cond:
+                    # An expired url is reported over other failures, it is
+                    # the one a retry can fix
+                    if not isinstance(self.__error,
+                                      CdnManager.ExpiredUrlException):
+                        self.__error = ex
+
+            def finish(self, ex: Exception = None) -> None:
+                with self.__cond:
+                    self.__finished = True
+                    self.__failure = ex
+                    self.__cond.notify_all()
+
+            def hedge_done(self) -> None:
+                with self.__cond:
+                    self.__hedges -= 1
+                    self.__cond.notify_all()
+
+            def put_back(self, url: str) -> None:
+                with self.__cond:
+                    self.__urls.insert(0, url)
+                    self.__cond.notify_all()
+
+            def next_url(self) -> typing.Union[str, None]:
+                with self.__cond:
+                    if self.__claimed or len(self.__urls) == 0:
+                        return None
+                    url = self.__urls.pop(0)
+                    self.__cond.notify_all()
+                    return url
+
+            def remaining(self) -> int:
+                with self.__cond:
+                    return len(self.__urls)
+
+            def wait(self) -> None:
+                """
+                Wait until the chunks have been delivered, or every request
+                has failed
+                """
+                with self.__cond:
+                    while not self.__finished and (self.__claimed
+                                                   or self.__hedges > 0):
+                        self.__cond.wait()
+                    if self.__finished:
+                        if self.__failure is not None:
+                            raise self.__failure
+                        return
+                    raise self.__error if self.__error is not None \
+                        else IOError("No CDN url left")
+
+            def wait_hedge(self, due: float) -> bool:
+                """
+                Wait until the hedge is due
+                Args:
+                    due: time.monotonic() at which to hedge
+                Returns:
+                    False if a response arrived or no url is left meanwhile
+                """
+                with self.__cond:
+                    while not self.__claimed and len(self.__urls) > 0:
+                        timeout = due - time.monotonic()
+                        if timeout <= 0:
+                            return True
+                        self.__cond.wait(timeout)
+                    return False
+
         class InternalStream(AbsChunkedInputStream):
             streamer: CdnManager.Streamer
 
@@ -654,9 +1966,13 @@ class CdnManager:
             def size(self) -> int:
                 return self.streamer.size
 
+            def head(self) -> bytes:
+                return self.streamer.head
+
             def close(self) -> None:
                 super().close()
                 del self.streamer.buffer
+                self.streamer.close()
 
             def requested_chunks(self) -> typing.List[bool]:
                 return self.streamer.requested
@@ -668,8 +1984,36 @@ class CdnManager:
                 return self.streamer.chunks
 
             def request_chunk_from_stream(self, index: int) -> None:
-                self.streamer.executor_service \
-                    .submit(lambda: self.streamer.request_chunk(index))
+                self.request_chunks_from_stream(index, 1, self.priority)
+
+            def request_chunks_from_stream(self, index: int, count: int,
+                                           priority: int) -> None:
+                step = max(1, self.streamer.max_chunks_per_request)
+                host = self.streamer.host()
+                for i in range(index, index + count, step):
+                    self.streamer.scheduler.submit(
+                        self.streamer, host, priority, i,
+                        min(step, index + count - i), self.__request_chunks)
+
+            def promote_chunk(self, index: int) -> None:
+                self.streamer.scheduler.promote(self.streamer, index)
+
+            def set_priority(self, priority: int) -> None:
+                super().set_priority(priority)
+                self.streamer.scheduler.reprioritize(self.streamer, priority)
+
+            def __request_chunks(self, job: ChunkFetchScheduler.Job) -> None:
+                index = job.index
+                count = job.count
+                try:
+                    self.streamer.request_chunks(index, count, job)
+                except Exception as ex:
+                    CdnManager.logger.warning(
+                        "Failed requesting chunks {}-{}: {}".format(
+                            index, index + count - 1, ex))
+                    for i in range(index, index + count):
+                        if not self.available_chunks()[i]:
+                            self.notify_chunk_error(i, ex)
 
             def stream_read_halted(self, chunk: int, _time: int) -> None:
                 if self.streamer.halt_listener is not None:
@@ -723,6 +2067,7 @@ class NormalizationData:
 
 
 class PlayableContentFeeder:
+    executor_service = concurrent.futures.ThreadPoolExecutor()
     logger = logging.getLogger("Librespot:PlayableContentFeeder")
     storage_resolve_interactive = "/storage-resolve/files/audio/interactive/{}"
     storage_resolve_interactive_prefetch = "/storage-resolve/files/audio/interactive_prefetch/{}"
@@ -742,20 +2087,47 @@ class PlayableContentFeeder:
                                      preload, halt_listener)
         raise TypeError("Unknown content: {}".format(playable_id))
 
-    def load_stream(self, file: Metadata.AudioFile, track: Metadata.Track,
-                    episode: Metadata.Episode, preload: bool,
-                    halt_lister: HaltListener):
+    def load_stream(self,
+                    file: Metadata.AudioFile,
+                    track: Metadata.Track,
+                    episode: Metadata.Episode,
+                    preload: bool,
+                    halt_lister: HaltListener,
+                    stage_times: typing.Dict[str, int] = None):
+        """
+        Resolve the storage and fetch the audio key concurrently, the first
+        chunk is downloaded as soon as the CDN url is known and only waits
+        for the key when it gets decrypted
+        """
         if track is None and episode is None:
             raise RuntimeError("No content passed!")
         elif file is None:
             raise RuntimeError("Content has no audio file!")
-        response = self.resolve_storage_interactive(file.file_id, preload)
+        if stage_times is None:
+            stage_times = {}
+        gid = track.gid if track is not None else episode.gid
+        key = None
+        if not self.__session.cache().audio_keys().contains(gid, file.file_id):
+            key = self.executor_service.submit(self.__get_audio_key, gid,
+                                               file.file_id, stage_times)
+        start = time.monotonic()
+        try:
+            response = self.resolve_storage_interactive(file.file_id, preload)
+        except Exception:
+            if key is not None:
+                key.cancel()
+            raise
+        stage_times["storage_resolve"] = int((time.monotonic() - start) * 1000)
         if response.result == StorageResolve.StorageResolveResponse.Result.CDN:
             if track is not None:
                 return CdnFeedHelper.load_track(self.__session, track, file,
-                                                response, preload, halt_lister)
+                                                response, preload, halt_lister,
+                                                key, stage_times)
             return CdnFeedHelper.load_episode(self.__session, episode, file,
-                                              response, preload, halt_lister)
+                                              response, preload, halt_lister,
+                                              key, stage_times)
+        if key is not None:
+            key.cancel()
         if response.result == StorageResolve.StorageResolveResponse.Result.STORAGE:
             if track is None:
                 pass
@@ -769,7 +2141,9 @@ class PlayableContentFeeder:
     def load_episode(self, episode_id: EpisodeId,
                      audio_quality_picker: AudioQualityPicker, preload: bool,
                      halt_listener: HaltListener) -> LoadedStream:
+        start = time.monotonic()
         episode = self.__session.api().get_metadata_4_episode(episode_id)
+        stage_times = {"metadata": int((time.monotonic() - start) * 1000)}
         if episode.external_url:
             return CdnFeedHelper.load_episode_external(self.__session, episode,
                                                        halt_listener)
@@ -779,15 +2153,21 @@ class PlayableContentFeeder:
                 "Couldn't find any suitable audio file, available: {}".format(
                     episode.audio))
             raise FeederException("Cannot find suitable audio file")
-        return self.load_stream(file, None, episode, preload, halt_listener)
+        stream = self.load_stream(file, None, episode, preload, halt_listener,
+                                  stage_times)
+        stage_times["total"] = int((time.monotonic() - start) * 1000)
+        return stream
 
     def load_track(self, track_id_or_track: typing.Union[TrackId,
                                                          Metadata.Track],
                    audio_quality_picker: AudioQualityPicker, preload: bool,
                    halt_listener: HaltListener):
+        start = time.monotonic()
+        stage_times = {}
         if type(track_id_or_track) is TrackId:
             original = self.__session.api().get_metadata_4_track(
                 track_id_or_track)
+            stage_times["metadata"] = int((time.monotonic() - start) * 1000)
             track = self.pick_alternative_if_necessary(original)
             if track is None:
                 raise RuntimeError("Cannot get alternative track")
@@ -799,7 +2179,10 @@ class PlayableContentFeeder:
                 "Couldn't find any suitable audio file, available: {}".format(
                     track.file))
             raise FeederException("Cannot find suitable audio file")
-        return self.load_stream(file, track, None, preload, halt_listener)
+        stream = self.load_stream(file, track, None, preload, halt_listener,
+                                  stage_times)
+        stage_times["total"] = int((time.monotonic() - start) * 1000)
+        return stream
 
     def pick_alternative_if_necessary(
             self, track: Metadata.Track) -> typing.Union[Metadata.Track, None]:
@@ -829,25 +2212,125 @@ class PlayableContentFeeder:
                     licensor=track.licensor)
         return None
 
+    def __get_audio_key(self, gid: bytes, file_id: bytes,
+                        stage_times: typing.Dict[str, int]) -> bytes:
+        start = time.monotonic()
+        key = self.__session.audio_key().get_audio_key(gid, file_id)
+        stage_times["audio_key"] = int((time.monotonic() - start) * 1000)
+        return key
+
     def resolve_storage_interactive(
             self, file_id: bytes,
             preload: bool) -> StorageResolve.StorageResolveResponse:
-        resp = self.__session.api().send(
-            "GET",
-            (self.storage_resolve_interactive_prefetch
-             if preload else self.storage_resolve_interactive).format(
-                 util.bytes_to_hex(file_id)),
-            None,
-            None,
-        )
-        if resp.status_code != 200:
-            raise RuntimeError(resp.status_code)
-        body = resp.content
-        if body is None:
-            raise RuntimeError("Response body is empty!")
-        storage_resolve_response = StorageResolve.StorageResolveResponse()
-        storage_resolve_response.ParseFromString(body)
-        return storage_resolve_response
+        return self.__session.cdn().resolve_storage(file_id, preload)
+
+
+class QueuePrefetcher(Closeable):
+    """
+    Warms up the next items of a play queue: metadata, storage-resolve
+    through the interactive_prefetch endpoint, audio key and the first
+    chunks of the file. Items leaving the prefetch window are cancelled and
+    their streams closed.
+    """
+    chunks: int
+    depth: int
+    logger = logging.getLogger("Librespot:QueuePrefetcher")
+    __audio_quality_picker: AudioQualityPicker
+    __closed = False
+    __executor: concurrent.futures.ThreadPoolExecutor
+    __lock: threading.Lock
+    __pending: typing.Dict[str, concurrent.futures.Future]
+    __session: Session
+
+    def __init__(self,
+                 session: Session,
+                 audio_quality_picker: AudioQualityPicker,
+                 depth: int = 2,
+                 chunks: int = 4,
+                 max_concurrency: int = 2):
+        """
+        Args:
+            session: Session to load with
+            audio_quality_picker: Picks the file to prefetch
+            depth: Number of upcoming items to keep warm
+            chunks: Number of chunks to download for each item
+            max_concurrency: Number of items loaded at the same time
+        """
+        self.__session = session
+        self.__audio_quality_picker = audio_quality_picker
+        self.depth = depth
+        self.chunks = chunks
+        self.__executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency)
+        self.__lock = threading.Lock()
+        self.__pending = {}
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__closed = True
+            for uri in list(self.__pending.keys()):
+                self.__discard(uri)
+        self.__executor.shutdown(wait=False)
+
+    def set_queue(self, playable_ids: typing.Iterable[PlayableId]) -> None:
+        """
+        Update the upcoming items, in play order. The first depth items are
+        prefetched, work for anything else is cancelled.
+        """
+        wanted: typing.Dict[str, PlayableId] = {}
+        for playable_id in playable_ids:
+            if len(wanted) >= self.depth:
+                break
+            wanted.setdefault(playable_id.to_spotify_uri(), playable_id)
+        with self.__lock:
+            if self.__closed:
+                return
+            for uri in list(self.__pending.keys()):
+                if uri not in wanted:
+                    self.__discard(uri)
+            for uri, playable_id in wanted.items():
+                if uri not in self.__pending:
+                    self.__pending[uri] = self.__executor.submit(
+                        self.__load, playable_id)
+
+    def take(self, playable_id: PlayableId) -> typing.Union[LoadedStream, None]:
+        """
+        Hand over a prefetched item, waiting for it if it is still loading
+        Returns:
+            The LoadedStream, or None if the item wasn't prefetched
+        """
+        with self.__lock:
+            future = self.__pending.pop(playable_id.to_spotify_uri(), None)
+        if future is None:
+            return None
+        try:
+            stream = future.result()
+        except Exception as ex:
+            self.logger.warning("Prefetching {} failed: {}".format(
+                playable_id.to_spotify_uri(), ex))
+            return None
+        stream.input_stream.stream().set_priority(
+            ChunkFetchScheduler.READ_AHEAD)
+        return stream
+
+    def __discard(self, uri: str) -> None:
+        future = self.__pending.pop(uri)
+        if not future.cancel():
+            future.add_done_callback(QueuePrefetcher.__close_stream)
+
+    @staticmethod
+    def __close_stream(future: concurrent.futures.Future) -> None:
+        if future.exception() is None:
+            future.result().input_stream.stream().close()
+
+    def __load(self, playable_id: PlayableId) -> LoadedStream:
+        stream = self.__session.content_feeder().load(
+            playable_id, self.__audio_quality_picker, True, None)
+        stream.input_stream.stream().request_all_chunks(
+            ChunkFetchScheduler.PRELOAD, self.chunks)
+        self.logger.debug("Prefetched {}".format(
+            playable_id.to_spotify_uri()))
+        return stream
 
 
 class LoadedStream:
@@ -861,18 +2344,41 @@ class LoadedStream:
         file_id: str
         preloaded_audio_key: bool
         audio_key_time: int
+        stage_times: typing.Dict[str, int]
+        __read_ahead: typing.Union[AbsChunkedInputStream.ReadAhead, None]
 
         def __init__(self, file_id: typing.Union[bytes, None],
-                        preloaded_audio_key: bool, audio_key_time: int):
+                        preloaded_audio_key: bool, audio_key_time: int,
+                        read_ahead: AbsChunkedInputStream.ReadAhead = None,
+                        stage_times: typing.Dict[str, int] = None):
             self.file_id = None if file_id is None else util.bytes_to_hex(
                 file_id)
             self.preloaded_audio_key = preloaded_audio_key
             self.audio_key_time = -1 if preloaded_audio_key else audio_key_time
+            self.stage_times = {} if stage_times is None else stage_times
+            self.__read_ahead = read_ahead
+
+        def stage_time(self, stage: str) -> int:
+            """
+            Milliseconds spent in a loading stage: metadata, storage_resolve,
+            audio_key, first_chunk or total, -1 if unknown. audio_key and
+            first_chunk run concurrently.
+            """
+            return self.stage_times.get(stage, -1)
+
+        def read_ahead_window(self) -> int:
+            return -1 if self.__read_ahead is None \
+                else self.__read_ahead.window()
+
+        def throughput(self) -> float:
+            return -1 if self.__read_ahead is None \
+                else self.__read_ahead.throughput()
 
     def __init__(self, track_or_episode: typing.Union[Metadata.Track, Metadata.Episode],
                     input_stream: GeneralAudioStream,
                     normalization_data: typing.Union[NormalizationData, None],
-                    file_id: str, preloaded_audio_key: bool, audio_key_time: int):
+                    file_id: str, preloaded_audio_key: bool, audio_key_time: int,
+                    stage_times: typing.Dict[str, int] = None):
         if type(track_or_episode) is Metadata.Track:
             self.track = track_or_episode
             self.episode = None
@@ -883,7 +2389,10 @@ class LoadedStream:
             raise TypeError()
         self.input_stream = input_stream
         self.normalization_data = normalization_data
-        self.metrics = self.Metrics(file_id, preloaded_audio_key, audio_key_time)
+        self.metrics = self.Metrics(file_id, preloaded_audio_key,
+                                    audio_key_time,
+                                    input_stream.stream().read_ahead,
+                                    stage_times)
 
 
 class StreamId:
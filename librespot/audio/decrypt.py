@@ -3,8 +3,9 @@ from Cryptodome.Cipher import AES
 from Cryptodome.Util import Counter
 from librespot.audio.storage import ChannelManager
 from librespot.structure import AudioDecrypt
-import io
+import concurrent.futures
 import time
+import typing
 
 
 class AesAudioDecrypt(AudioDecrypt):
@@ -13,32 +14,37 @@ class AesAudioDecrypt(AudioDecrypt):
     decrypt_count = 0
     decrypt_total_time = 0
     iv_int = int.from_bytes(audio_aes_iv, "big")
-    iv_diff = 0x100
-    key: bytes
+    key: typing.Union[bytes, None]
+    __key_future: typing.Union[concurrent.futures.Future, None] = None
 
-    def __init__(self, key: bytes):
-        self.key = key
+    def __init__(self, key: typing.Union[bytes, concurrent.futures.Future]):
+        """
+        Args:
+            key: Audio key, or a future resolving to it. A future is only
+                joined when the first chunk is decrypted.
+        """
+        if isinstance(key, concurrent.futures.Future):
+            self.key = None
+            self.__key_future = key
+        else:
+            self.key = key
 
-    def decrypt_chunk(self, chunk_index: int, buffer: bytes):
-        new_buffer = io.BytesIO()
-        iv = self.iv_int + int(ChannelManager.chunk_size * chunk_index / 16)
+    def decrypt_chunk(self, chunk_index: int, buffer: bytes) -> bytes:
+        if self.key is None:
+            self.key = self.__key_future.result()
+        # The counter advances by one per 16-byte block, so a single CTR
+        # stream positioned at the start of the chunk covers the whole chunk.
+        iv = self.iv_int + ChannelManager.chunk_size * chunk_index // 16
         start = time.time_ns()
-        for i in range(0, len(buffer), 4096):
-            cipher = AES.new(key=self.key,
-                             mode=AES.MODE_CTR,
-                             counter=Counter.new(128, initial_value=iv))
-            count = min(4096, len(buffer) - i)
-            decrypted_buffer = cipher.decrypt(buffer[i:i + count])
-            new_buffer.write(decrypted_buffer)
-            if count != len(decrypted_buffer):
-                raise RuntimeError(
-                    "Couldn't process all data, actual: {}, expected: {}".
-                    format(len(decrypted_buffer), count))
-            iv += self.iv_diff
+        cipher = AES.new(key=self.key,
+                         mode=AES.MODE_CTR,
+                         counter=Counter.new(128, initial_value=iv))
+        # Decrypted chunks are shared by every reader of the stream and the
+        # cache, they are handed out immutable
+        new_buffer = cipher.decrypt(buffer)
         self.decrypt_total_time += time.time_ns() - start
         self.decrypt_count += 1
-        new_buffer.seek(0)
-        return new_buffer.read()
+        return new_buffer
 
     def decrypt_time_ms(self):
         return 0 if self.decrypt_count == 0 else int(
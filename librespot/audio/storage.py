@@ -20,6 +20,7 @@ class ChannelManager(Closeable, PacketsReceiver):
     chunk_size = 128 * 1024
     executor_service = concurrent.futures.ThreadPoolExecutor()
     logger = logging.getLogger("Librespot:ChannelManager")
+    packet_types = (Packet.Type.channel_error, Packet.Type.stream_chunk_res)
     seq_holder = 0
     seq_holder_lock = threading.Condition()
     __session: Session = None
@@ -1,18 +1,910 @@
 from __future__ import annotations
+from librespot import util
+from librespot.audio.storage import ChannelManager
+from librespot.structure import Closeable
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import time
 import typing
 
 if typing.TYPE_CHECKING:
+    from librespot.audio import StreamId
     from librespot.core import Session
 
 
-class CacheManager:
+class AudioKeyCache(Closeable):
+    """
+    Audio keys keyed by (gid, file_id), kept in an in-memory LRU and, when
+    caching is enabled, appended to a file under the cache directory. Like
+    the stored credentials, the keys are kept in plaintext and the file is
+    only readable by its owner. At most max_stored keys are kept on disk, the
+    file is compacted on load and whenever it has grown to twice that. Writes
+    happen on a thread of their own, put is called from the packet receiver.
+    """
+    file_name = "audio_keys"
+    logger = logging.getLogger("Librespot:AudioKeyCache")
+    max_entries = 4096
+    max_stored = 65536
+    __disk: typing.OrderedDict[str, bytes]
+    __entries: typing.OrderedDict[str, bytes]
+    __hits = 0
+    __lines = 0
+    __lock: threading.Lock
+    __misses = 0
+    __path: typing.Union[str, None] = None
+    __writer: typing.Union[concurrent.futures.ThreadPoolExecutor, None] = None
+
+    def __init__(self, parent: typing.Union[str, None]):
+        """
+        Args:
+            parent: Cache directory, None keeps the keys in memory only
+        """
+        self.__disk = collections.OrderedDict()
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        if parent is None:
+            return
+        try:
+            self.__path = os.path.join(parent, self.file_name)
+            self.__load()
+        except OSError as ex:
+            self.logger.warning(
+                "Couldn't open audio key store, keys won't persist: {}".format(
+                    ex))
+            self.__path = None
+            return
+        self.__writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="audio-key-cache")
+
+    def close(self) -> None:
+        if self.__writer is not None:
+            self.__writer.shutdown()
+        with self.__lock:
+            self.__entries.clear()
+            self.__disk.clear()
+
+    def contains(self, gid: bytes, file_id: bytes) -> bool:
+        name = self.__name(gid, file_id)
+        with self.__lock:
+            return name in self.__entries or name in self.__disk
+
+    def get(self, gid: bytes, file_id: bytes) -> typing.Union[bytes, None]:
+        """
+        Look up a key, counting a hit or a miss
+        Args:
+            gid: Track or episode gid
+            file_id: Audio file id
+        Returns:
+            The audio key, or None if it isn't cached
+        """
+        name = self.__name(gid, file_id)
+        with self.__lock:
+            key = self.__entries.get(name)
+            if key is not None:
+                self.__entries.move_to_end(name)
+            elif name in self.__disk:
+                key = self.__disk[name]
+                self.__remember(name, key)
+            if key is None:
+                self.__misses += 1
+            else:
+                self.__hits += 1
+            return key
+
+    def put(self, gid: bytes, file_id: bytes, key: bytes) -> None:
+        name = self.__name(gid, file_id)
+        with self.__lock:
+            self.__remember(name, key)
+            if self.__path is None or name in self.__disk:
+                return
+            self.__disk[name] = key
+            while len(self.__disk) > self.max_stored:
+                self.__disk.popitem(last=False)
+        try:
+            self.__writer.submit(self.__append, name, key)
+        except RuntimeError:
+            # Closed meanwhile
+            pass
+
+    def hit_rate(self) -> float:
+        with self.__lock:
+            total = self.__hits + self.__misses
+            return 0.0 if total == 0 else self.__hits / total
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self.__lock:
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "entries": len(self.__entries),
+                "stored": len(self.__disk),
+            }
+
+    def __append(self, name: str, key: bytes) -> None:
+        try:
+            with self.__open(self.__path, os.O_APPEND) as f:
+                f.write("{} {}\n".format(name, util.bytes_to_hex(key)))
+        except OSError as ex:
+            self.logger.warning("Failed storing audio key: {}".format(ex))
+            with self.__lock:
+                self.__disk.pop(name, None)
+            return
+        self.__lines += 1
+        if self.__lines > 2 * self.max_stored:
+            self.__compact()
+
+    def __compact(self) -> None:
+        # Rewrites the file with the stored keys only, dropping duplicates,
+        # corrupted lines and keys evicted from the store
+        with self.__lock:
+            lines = [
+                "{} {}\n".format(name, util.bytes_to_hex(key))
+                for name, key in self.__disk.items()
+            ]
+        try:
+            with self.__open(self.__path + ".tmp", os.O_TRUNC) as f:
+                f.writelines(lines)
+            os.replace(self.__path + ".tmp", self.__path)
+        except OSError as ex:
+            self.logger.warning(
+                "Failed compacting audio key store: {}".format(ex))
+            return
+        self.__lines = len(lines)
+
+    def __load(self) -> None:
+        # Older versions kept the keys encrypted with a secret stored next to
+        # them, those lines don't hold a plain key and are dropped below
+        secret = self.__path + ".secret"
+        if os.path.exists(secret):
+            os.remove(secret)
+        if not os.path.exists(self.__path):
+            return
+        os.chmod(self.__path, 0o600)
+        with open(self.__path) as f:
+            for line in f:
+                self.__lines += 1
+                parts = line.split()
+                if len(parts) != 2:
+                    continue
+                try:
+                    key = util.hex_to_bytes(parts[1])
+                except ValueError:
+                    continue
+                if len(key) != 16:
+                    continue
+                self.__disk[parts[0]] = key
+                self.__disk.move_to_end(parts[0])
+        while len(self.__disk) > self.max_stored:
+            self.__disk.popitem(last=False)
+        if self.__lines != len(self.__disk):
+            self.__compact()
+
+    @staticmethod
+    def __open(path: str, flags: int) -> typing.TextIO:
+        # Created owner-only, the keys are stored in plaintext
+        return os.fdopen(
+            os.open(path, os.O_WRONLY | os.O_CREAT | flags, 0o600), "w")
+
+    @staticmethod
+    def __name(gid: bytes, file_id: bytes) -> str:
+        return util.bytes_to_hex(gid) + util.bytes_to_hex(file_id)
+
+    def __remember(self, name: str, key: bytes) -> None:
+        self.__entries[name] = key
+        self.__entries.move_to_end(name)
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+
+class EntryStore(Closeable):
+    """
+    Serialized entries with a TTL keyed by name. Recently used entries are
+    kept in a size-bounded in-memory LRU, and when caching is enabled every
+    entry is also stored in its own file under dir_name. Subclasses give the
+    store its keys, see MetadataCache and PlaylistCache.
+    """
+    default_ttl = 86400
+    dir_name: str
+    header = struct.Struct(">qqH")
+    logger = logging.getLogger("Librespot:EntryStore")
+    max_disk_size = 64 * 1024 * 1024
+    max_memory_size = 16 * 1024 * 1024
+    stale_ttl = 7 * 86400
+    __disk: typing.OrderedDict[str, int]
+    __disk_hits = 0
+    __disk_size = 0
+    __entries: typing.OrderedDict[str, Entry]
+    __evictions = 0
+    __lock: threading.Lock
+    __memory_hits = 0
+    __memory_size = 0
+    __misses = 0
+    __path: typing.Union[str, None] = None
+    __stale_hits = 0
+
+    def __init__(self,
+                 parent: typing.Union[str, None],
+                 max_memory_size: typing.Union[int, None] = None,
+                 max_disk_size: typing.Union[int, None] = None):
+        """
+        Args:
+            parent: Cache directory, None keeps the entries in memory only
+            max_memory_size: Overrides max_memory_size
+            max_disk_size: Overrides max_disk_size
+        """
+        if max_memory_size is not None:
+            self.max_memory_size = max_memory_size
+        if max_disk_size is not None:
+            self.max_disk_size = max_disk_size
+        self.__disk = collections.OrderedDict()
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        if parent is None:
+            return
+        try:
+            self.__path = os.path.join(parent, self.dir_name)
+            os.makedirs(self.__path, exist_ok=True)
+            self.__scan()
+        except OSError as ex:
+            self.logger.warning(
+                "Couldn't open {} store, entries won't persist: {}".format(
+                    self.dir_name, ex))
+            self.__path = None
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+            self.__memory_size = 0
+
+    def _get(self, name: str) -> typing.Union[Entry, None]:
+        """
+        Look up an entry in memory, then on disk
+        Args:
+            name: Key of the entry
+        Returns:
+            The entry, possibly expired but still within stale_ttl, or None
+        """
+        now = int(time.time() * 1000)
+        with self.__lock:
+            entry = self.__entries.get(name)
+            if entry is not None:
+                self.__entries.move_to_end(name)
+            stored = entry is None and self.__path is not None \
+                and self.__file_name(name) in self.__disk
+        # The file is read without holding the lock, the lookup only decides
+        # whether there is anything to read
+        if stored:
+            entry = self.__read(name)
+        removed = []
+        with self.__lock:
+            if stored:
+                # A put that raced the read wins over the file content
+                current = self.__entries.get(name)
+                if current is not None:
+                    entry = current
+                    stored = False
+                elif entry is None:
+                    removed = self.__forget(name)
+                elif self.__file_name(name) in self.__disk:
+                    self.__disk.move_to_end(self.__file_name(name))
+            if entry is not None and now > entry.expires + self.stale_ttl * 1000:
+                removed = self.__forget(name)
+                entry = None
+            if entry is None:
+                self.__misses += 1
+            elif stored:
+                self.__disk_hits += 1
+                self.__remember(name, entry)
+            else:
+                self.__memory_hits += 1
+            if entry is not None and entry.is_expired(now):
+                self.__stale_hits += 1
+        self.__remove(removed)
+        return entry
+
+    def _put(self,
+             name: str,
+             data: bytes,
+             ttl: typing.Union[int, None] = None) -> None:
+        """
+        Store an entry in both tiers
+        Args:
+            name: Key of the entry
+            data: Serialized entry
+            ttl: Seconds the entry stays fresh, default_ttl if None
+        """
+        now = int(time.time() * 1000)
+        entry = EntryStore.Entry(
+            data, now, now + (ttl or self.default_ttl) * 1000)
+        with self.__lock:
+            self.__remember(name, entry)
+        if self.__path is None:
+            return
+        size = self.__write(name, entry)
+        if size is None:
+            return
+        file_name = self.__file_name(name)
+        with self.__lock:
+            self.__disk_size += size - self.__disk.pop(file_name, 0)
+            self.__disk[file_name] = size
+            removed = self.__evict_disk()
+        self.__remove(removed)
+
+    def _invalidate(self, name: str) -> None:
+        with self.__lock:
+            removed = self.__forget(name)
+        self.__remove(removed)
+
+    def hit_rate(self) -> float:
+        with self.__lock:
+            hits = self.__memory_hits + self.__disk_hits
+            total = hits + self.__misses
+            return 0.0 if total == 0 else hits / total
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self.__lock:
+            return {
+                "memory_hits": self.__memory_hits,
+                "disk_hits": self.__disk_hits,
+                "stale_hits": self.__stale_hits,
+                "misses": self.__misses,
+                "evictions": self.__evictions,
+                "entries": len(self.__entries),
+                "memory_size": self.__memory_size,
+                "stored": len(self.__disk),
+                "disk_size": self.__disk_size,
+            }
+
+    def __evict_disk(self) -> typing.List[str]:
+        removed = []
+        while self.__disk_size > self.max_disk_size and len(self.__disk) > 1:
+            file_name, size = self.__disk.popitem(last=False)
+            removed.append(file_name)
+            self.__disk_size -= size
+            self.__evictions += 1
+        return removed
+
+    def __file_path(self, file_name: str) -> str:
+        return os.path.join(self.__path, file_name[:2], file_name)
+
+    def __forget(self, name: str) -> typing.List[str]:
+        entry = self.__entries.pop(name, None)
+        if entry is not None:
+            self.__memory_size -= len(entry.data)
+        if self.__path is None:
+            return []
+        file_name = self.__file_name(name)
+        size = self.__disk.pop(file_name, None)
+        if size is None:
+            return []
+        self.__disk_size -= size
+        return [file_name]
+
+    @staticmethod
+    def __file_name(name: str) -> str:
+        return hashlib.sha1(name.encode()).hexdigest()
+
+    def __read(self, name: str) -> typing.Union[Entry, None]:
+        try:
+            with open(self.__file_path(self.__file_name(name)), "rb") as f:
+                content = f.read()
+            stored_at, expires, length = self.header.unpack_from(content)
+            offset = self.header.size + length
+            if content[self.header.size:offset].decode() != name:
+                raise ValueError("Name mismatch")
+        except (OSError, ValueError, struct.error) as ex:
+            self.logger.warning("Discarding {} entry {}: {}".format(
+                self.dir_name, name, ex))
+            return None
+        return EntryStore.Entry(content[offset:], stored_at, expires)
+
+    def __remove(self, file_names: typing.List[str]) -> None:
+        for file_name in file_names:
+            try:
+                os.remove(self.__file_path(file_name))
+            except OSError:
+                pass
+
+    def __remember(self, name: str, entry: Entry) -> None:
+        previous = self.__entries.pop(name, None)
+        if previous is not None:
+            self.__memory_size -= len(previous.data)
+        self.__entries[name] = entry
+        self.__memory_size += len(entry.data)
+        while (self.__memory_size > self.max_memory_size
+               and len(self.__entries) > 1):
+            _, evicted = self.__entries.popitem(last=False)
+            self.__memory_size -= len(evicted.data)
+            self.__evictions += 1
+
+    def __scan(self) -> None:
+        files = []
+        for directory in os.scandir(self.__path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, file_name, size in sorted(files):
+            self.__disk[file_name] = size
+            self.__disk_size += size
+        self.__remove(self.__evict_disk())
+
+    def __write(self, name: str, entry: Entry) -> typing.Union[int, None]:
+        path = self.__file_path(self.__file_name(name))
+        # Writers of the same entry no longer serialize on the lock, so each
+        # one gets its own temporary file
+        temp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        encoded = name.encode()
+        content = self.header.pack(entry.stored_at, entry.expires,
+                                   len(encoded)) + encoded + entry.data
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, "wb") as f:
+                f.write(content)
+            os.replace(temp_path, path)
+        except OSError as ex:
+            self.logger.warning("Failed storing {} entry {}: {}".format(
+                self.dir_name, name, ex))
+            return None
+        return len(content)
+
+    class Entry:
+        __slots__ = ("data", "expires", "stored_at")
+        data: bytes
+        expires: int
+        stored_at: int
+
+        def __init__(self, data: bytes, stored_at: int, expires: int):
+            self.data = data
+            self.expires = expires
+            self.stored_at = stored_at
+
+        def is_expired(self, now: typing.Union[int, None] = None) -> bool:
+            if now is None:
+                now = int(time.time() * 1000)
+            return now > self.expires
+
+
+class MetadataCache(EntryStore):
+    """
+    Raw extended metadata keyed by (uri, extension kind). Entries are stored
+    serialized and parsed by the caller, so a cached catalog costs its wire
+    size.
+    """
+    background_revalidation = True
+    dir_name = "metadata"
+    logger = logging.getLogger("Librespot:MetadataCache")
+
+    def get(self, uri: str,
+            extension_kind: int) -> typing.Union[EntryStore.Entry, None]:
+        """
+        Args:
+            uri: Entity uri
+            extension_kind: ExtensionKind of the data
+        Returns:
+            The entry, possibly expired but still within stale_ttl, or None
+        """
+        return self._get(self.__name(uri, extension_kind))
+
+    def put(self,
+            uri: str,
+            extension_kind: int,
+            data: bytes,
+            ttl: typing.Union[int, None] = None) -> None:
+        """
+        Args:
+            uri: Entity uri
+            extension_kind: ExtensionKind of the data
+            data: Serialized extension data
+            ttl: Seconds the entry stays fresh, default_ttl if None
+        """
+        self._put(self.__name(uri, extension_kind), data, ttl)
+
+    def invalidate(self, uri: str, extension_kind: int) -> None:
+        self._invalidate(self.__name(uri, extension_kind))
+
+    @staticmethod
+    def __name(uri: str, extension_kind: int) -> str:
+        return "{}:{}".format(int(extension_kind), uri)
+
+
+class PlaylistCache(EntryStore):
+    """
+    Serialized playlist contents keyed by playlist uri, see PlaylistSync
+    """
+    default_ttl = 30 * 86400
+    dir_name = "playlists"
+    logger = logging.getLogger("Librespot:PlaylistCache")
+    max_disk_size = 512 * 1024 * 1024
+    max_memory_size = 64 * 1024 * 1024
+
+    def get(self, uri: str) -> typing.Union[EntryStore.Entry, None]:
+        """
+        Args:
+            uri: Playlist uri
+        Returns:
+            The entry, possibly expired but still within stale_ttl, or None
+        """
+        return self._get(uri)
+
+    def put(self,
+            uri: str,
+            data: bytes,
+            ttl: typing.Union[int, None] = None) -> None:
+        """
+        Args:
+            uri: Playlist uri
+            data: Serialized SelectedListContent
+            ttl: Seconds the entry stays fresh, default_ttl if None
+        """
+        self._put(uri, data, ttl)
+
+    def invalidate(self, uri: str) -> None:
+        self._invalidate(uri)
+
+
+class CacheManager(Closeable):
     clean_up_threshold = 604800000
     header_hash = 253
+    header_size = 0x03
     header_timestamp = 254
-    parent: str
+    logger = logging.getLogger("Librespot:CacheManager")
+    parent: typing.Union[str, None]
+    __audio_keys: AudioKeyCache
+    __evicting = False
+    __evictions = 0
+    __evictor: typing.Union[concurrent.futures.ThreadPoolExecutor, None] = None
+    __files: typing.OrderedDict[str, typing.Tuple[int, int]]
+    __handlers: typing.Dict[str, Handler]
+    __hits = 0
+    __lock: threading.Condition
+    __max_size: int
+    __metadata: MetadataCache
+    __playlists: PlaylistCache
+    __misses = 0
+    __size = 0
 
     def __init__(self, session: Session):
+        conf = session.configuration()
+        self.__files = collections.OrderedDict()
+        self.__handlers = {}
+        self.__lock = threading.Condition()
+        self.__max_size = conf.cache_max_size
+        if not conf.cache_enabled:
+            self.parent = None
+            self.__audio_keys = AudioKeyCache(None)
+            self.__metadata = MetadataCache(None)
+            self.__playlists = PlaylistCache(None)
+            return
+        self.parent = conf.cache_dir
+        os.makedirs(self.parent, exist_ok=True)
+        self.__audio_keys = AudioKeyCache(self.parent)
+        self.__metadata = MetadataCache(self.parent)
+        self.__playlists = PlaylistCache(self.parent)
+        # The directory is only scanned here, from then on the LRU of
+        # (last access, size) per file_id is kept up to date in memory
+        for timestamp, file_id in sorted(
+            (self.__timestamp(file_id), file_id)
+                for file_id in self.__entries()):
+            size = self.__data_size(file_id)
+            self.__files[file_id] = (timestamp, size)
+            self.__size += size
+        self.__evictor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="cache-eviction")
+        if conf.do_cache_clean_up:
+            self.clean_up()
+        self.__evict_if_needed()
+
+    def close(self) -> None:
+        with self.__lock:
+            handlers = list(self.__handlers.values())
+            self.__handlers.clear()
+        for handler in handlers:
+            handler.flush()
+        if self.__evictor is not None:
+            self.__evictor.shutdown()
+        self.__audio_keys.close()
+        self.__metadata.close()
+        self.__playlists.close()
+
+    def audio_keys(self) -> AudioKeyCache:
+        return self.__audio_keys
+
+    def metadata(self) -> MetadataCache:
+        return self.__metadata
+
+    def playlists(self) -> PlaylistCache:
+        return self.__playlists
+
+    def clean_up(self) -> None:
+        """
+        Remove every entry that has not been accessed within clean_up_threshold
+        """
+        if self.parent is None:
+            return
+        now = int(time.time() * 1000)
+        with self.__lock:
+            expired = [
+                file_id for file_id, (timestamp, _) in self.__files.items()
+                if now - timestamp * 1000 > self.clean_up_threshold
+                and file_id not in self.__handlers
+            ]
+            for file_id in expired:
+                self.__forget(file_id)
+        for file_id in expired:
+            self.__remove(file_id)
+
+    def get_handler(
+            self,
+            stream_id: typing.Union[StreamId, str]) -> typing.Union[Handler, None]:
         """
-        @Todo Implement function
-        :param session:
+        Get the chunk handler for a stream, None if caching is disabled
+        Args:
+            stream_id: StreamId or hex encoded file_id / episode gid
+        Returns:
+            CacheManager.Handler
         """
+        if self.parent is None:
+            return None
+        if type(stream_id) is str:
+            file_id = stream_id
+        elif stream_id.is_episode():
+            file_id = stream_id.get_episode_gid()
+        else:
+            file_id = stream_id.get_file_id()
+        now = int(time.time())
+        with self.__lock:
+            handler = self.__handlers.get(file_id)
+            if handler is None:
+                handler = CacheManager.Handler(self, file_id)
+                self.__handlers[file_id] = handler
+            handler.retain()
+            _, size = self.__files.pop(file_id, (0, 0))
+            self.__files[file_id] = (now, size)
+        handler.set_header(self.header_timestamp, util.int_to_bytes(now))
+        return handler
+
+    def hit_rate(self) -> float:
+        with self.__lock:
+            total = self.__hits + self.__misses
+            return 0.0 if total == 0 else self.__hits / total
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self.__lock:
+            return {
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "evictions": self.__evictions,
+                "size": self.__size,
+                "max_size": self.__max_size,
+            }
+
+    def path(self, file_id: str) -> str:
+        return os.path.join(self.parent, file_id)
+
+    def _on_hit(self) -> None:
+        with self.__lock:
+            self.__hits += 1
+
+    def _on_miss(self) -> None:
+        with self.__lock:
+            self.__misses += 1
+
+    def _on_write(self, file_id: str, length: int) -> None:
+        with self.__lock:
+            self.__size += length
+            timestamp, size = self.__files.pop(file_id, (int(time.time()), 0))
+            self.__files[file_id] = (timestamp, size + length)
+        self.__evict_if_needed()
+
+    def _release(self, handler: Handler) -> None:
+        with self.__lock:
+            if self.__handlers.get(handler.file_id) is handler:
+                self.__handlers.pop(handler.file_id)
+
+    def __data_size(self, file_id: str) -> int:
+        try:
+            return os.path.getsize(self.path(file_id))
+        except OSError:
+            return 0
+
+    def __entries(self) -> typing.List[str]:
+        entries = []
+        for entry in os.scandir(self.parent):
+            if entry.is_file() and entry.name.endswith(".idx"):
+                entries.append(entry.name[:-4])
+        return entries
+
+    def __evict(self) -> None:
+        # Least recently used entries first, skipping open ones
+        target = int(self.__max_size * 0.9)
+        try:
+            while True:
+                with self.__lock:
+                    if self.__size <= target:
+                        break
+                    file_id = next((file_id for file_id in self.__files
+                                    if file_id not in self.__handlers), None)
+                    if file_id is None:
+                        break
+                    self.__forget(file_id)
+                    self.__evictions += 1
+                self.__remove(file_id)
+        finally:
+            with self.__lock:
+                self.__evicting = False
+
+    def __evict_if_needed(self) -> None:
+        if self.parent is None or self.__max_size <= 0:
+            return
+        with self.__lock:
+            if self.__size <= self.__max_size or self.__evicting:
+                return
+            self.__evicting = True
+        try:
+            self.__evictor.submit(self.__evict)
+        except RuntimeError:
+            # Closed meanwhile
+            with self.__lock:
+                self.__evicting = False
+
+    def __forget(self, file_id: str) -> None:
+        _, size = self.__files.pop(file_id, (0, 0))
+        self.__size -= size
+
+    def __remove(self, file_id: str) -> None:
+        for path in [self.path(file_id), self.path(file_id) + ".idx"]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.logger.debug("Removed cache entry {}".format(file_id))
+
+    def __timestamp(self, file_id: str) -> int:
+        try:
+            with open(self.path(file_id) + ".idx") as f:
+                headers = json.load(f).get("headers", {})
+        except (OSError, ValueError):
+            return 0
+        value = headers.get(str(self.header_timestamp))
+        return 0 if value is None else int.from_bytes(util.hex_to_bytes(value),
+                                                      "big")
+
+    class Handler:
+        file_id: str
+        __cache_manager: CacheManager
+        __chunks: typing.Set[int]
+        __dirty = False
+        __headers: typing.Dict[int, bytes]
+        __lock: threading.Lock
+        __refs = 0
+
+        def __init__(self, cache_manager: CacheManager, file_id: str):
+            self.__cache_manager = cache_manager
+            self.__chunks = set()
+            self.__headers = {}
+            self.__lock = threading.Lock()
+            self.file_id = file_id
+            self.__load_index()
+
+        def retain(self) -> None:
+            with self.__lock:
+                self.__refs += 1
+
+        def close(self) -> None:
+            with self.__lock:
+                self.__refs -= 1
+                if self.__refs > 0:
+                    return
+            self.flush()
+            self.__cache_manager._release(self)
+
+        def flush(self) -> None:
+            with self.__lock:
+                if self.__dirty:
+                    self.__write_index()
+
+        def get_header(self, header_id: int) -> typing.Union[bytes, None]:
+            with self.__lock:
+                return self.__headers.get(header_id)
+
+        def set_header(self, header_id: int, value: bytes) -> None:
+            with self.__lock:
+                if self.__headers.get(header_id) == value:
+                    return
+                self.__headers[header_id] = value
+                self.__dirty = True
+
+        def has_chunk(self, index: int) -> bool:
+            with self.__lock:
+                return index in self.__chunks
+
+        def read_chunk(self, index: int) -> typing.Union[bytes, None]:
+            """
+            Read an (encrypted) chunk from disk
+            Args:
+                index: Chunk index
+            Returns:
+                The chunk, or None if it isn't cached
+            """
+            with self.__lock:
+                buffer = None
+                if index in self.__chunks:
+                    try:
+                        with open(self.__data_path(), "rb") as f:
+                            f.seek(index * ChannelManager.chunk_size)
+                            buffer = f.read(ChannelManager.chunk_size)
+                    except OSError as ex:
+                        self.__cache_manager.logger.warning(
+                            "Failed reading chunk {} of {}: {}".format(
+                                index, self.file_id, ex))
+                    if not buffer:
+                        buffer = None
+                        self.__chunks.discard(index)
+                        self.__write_index()
+            if buffer is None:
+                self.__cache_manager._on_miss()
+            else:
+                self.__cache_manager._on_hit()
+            return buffer
+
+        def write_chunk(self, buffer: bytes, index: int) -> None:
+            """
+            Store an (encrypted) chunk on disk
+            Args:
+                buffer: Chunk content
+                index: Chunk index
+            """
+            with self.__lock:
+                if index in self.__chunks:
+                    return
+                path = self.__data_path()
+                before = os.path.getsize(path) if os.path.exists(path) else 0
+                with open(path, "r+b" if before > 0 else "wb") as f:
+                    f.seek(index * ChannelManager.chunk_size)
+                    f.write(buffer)
+                self.__chunks.add(index)
+                self.__write_index()
+                written = os.path.getsize(path) - before
+            self.__cache_manager._on_write(self.file_id, written)
+
+        def __data_path(self) -> str:
+            return self.__cache_manager.path(self.file_id)
+
+        def __load_index(self) -> None:
+            try:
+                with open(self.__data_path() + ".idx") as f:
+                    index = json.load(f)
+            except FileNotFoundError:
+                return
+            except (OSError, ValueError) as ex:
+                self.__cache_manager.logger.warning(
+                    "Corrupted cache index for {}: {}".format(self.file_id, ex))
+                return
+            self.__chunks = set(index.get("chunks", []))
+            self.__headers = {
+                int(k): util.hex_to_bytes(v)
+                for k, v in index.get("headers", {}).items()
+            }
+
+        def __write_index(self) -> None:
+            path = self.__data_path() + ".idx"
+            with open(path + ".tmp", "w") as f:
+                json.dump(
+                    {
+                        "chunks": sorted(self.__chunks),
+                        "headers": {
+                            str(k): util.bytes_to_hex(v)
+                            for k, v in self.__headers.items()
+                        },
+                    }, f)
+            os.replace(path + ".tmp", path)
+            self.__dirty = False
@@ -19,6 +19,7 @@ import typing
 import urllib.parse
 
 import defusedxml.ElementTree
+import google.protobuf.message
 import requests
 import websocket
 from Cryptodome import Random
@@ -40,6 +41,7 @@ from librespot.cache import CacheManager
 from librespot.crypto import CipherPair
 from librespot.crypto import DiffieHellman
 from librespot.crypto import Packet
+from librespot.crypto import PacketTable
 from librespot.mercury import MercuryClient
 from librespot.mercury import MercuryRequests
 from librespot.mercury import RawMercuryRequest
@@ -48,6 +50,7 @@ from librespot.metadata import ArtistId
 from librespot.metadata import EpisodeId
 from librespot.metadata import PlaylistId
 from librespot.metadata import ShowId
+from librespot.metadata import SpotifyId
 from librespot.metadata import TrackId
 from librespot.oauth import OAuth
 from librespot.proto import Authentication_pb2 as Authentication
@@ -71,13 +74,30 @@ from librespot.structure import SubListener
 class ApiClient(Closeable):
     """ """
     logger = logging.getLogger("Librespot:ApiClient")
+    ext_metadata_batch_size = 500
+    ext_metadata_max_concurrency = 4
+    metadata_kinds = {
+        "album": (ExtensionKind.ALBUM_V4, Metadata.Album),
+        "artist": (ExtensionKind.ARTIST_V4, Metadata.Artist),
+        "episode": (ExtensionKind.EPISODE_V4, Metadata.Episode),
+        "show": (ExtensionKind.SHOW_V4, Metadata.Show),
+        "track": (ExtensionKind.TRACK_V4, Metadata.Track),
+    }
     __base_url: str
+    __lock: threading.Lock
     __client_token_str: str = None
+    __executor_service: typing.Union[concurrent.futures.ThreadPoolExecutor,
+                                     None] = None
+    __revalidating: typing.Set[typing.Tuple[str, ExtensionKind]]
     __session: Session
+    __single_flight: util.SingleFlight
 
     def __init__(self, session: Session):
         self.__session = session
         self.__base_url = "https://{}".format(ApResolver.get_random_spclient())
+        self.__lock = threading.Lock()
+        self.__revalidating = set()
+        self.__single_flight = util.SingleFlight()
 
     def build_request(
         self,
@@ -101,10 +121,12 @@ class ApiClient(Closeable):
 
         """
         if self.__client_token_str is None:
-            resp = self.__client_token()
-            self.__client_token_str = resp.granted_token.token
-            self.logger.debug("Updated client token: {}".format(
-                self.__client_token_str))
+            with self.__lock:
+                if self.__client_token_str is None:
+                    resp = self.__client_token()
+                    self.__client_token_str = resp.granted_token.token
+                    self.logger.debug("Updated client token: {}".format(
+                        self.__client_token_str))
 
         if url is None:
             url = self.__base_url + suffix
@@ -127,6 +149,7 @@ class ApiClient(Closeable):
         suffix: str,
         headers: typing.Union[None, CaseInsensitiveDict[str, str]],
         body: typing.Union[None, bytes],
+        coalesce: bool = False,
     ) -> requests.Response:
         """
 
@@ -137,11 +160,19 @@ class ApiClient(Closeable):
         :param str]]:
         :param body: typing.Union[None:
         :param bytes]:
+        :param coalesce: Share the response with identical requests in
+            flight, the body is read in full and every caller gets a copy
 
         """
-        response = self.__session.client().send(
-            self.build_request(method, suffix, headers, body, None))
-        return response
+        if not coalesce:
+            return self.__session.client().send(
+                self.build_request(method, suffix, headers, body, None))
+        key = (method, suffix, None if headers is None else tuple(
+            sorted((k.lower(), str(v)) for k, v in headers.items())), body)
+        return self.__copy_response(
+            self.__single_flight.do(
+                key, lambda: self.__session.client().send(
+                    self.build_request(method, suffix, headers, body, None))))
 
     def sendToUrl(
         self,
@@ -193,24 +224,110 @@ class ApiClient(Closeable):
                 response.status_code, response.headers))
 
     def get_ext_metadata(self, extension_kind: ExtensionKind, uri: str):
-        headers = CaseInsensitiveDict({"content-type": "application/x-protobuf"})
-        req = EntityRequest(entity_uri=uri, query=[ExtensionQuery(extension_kind=extension_kind),])
-
-        response = self.send("POST", "/extended-metadata/v0/extended-metadata",
-                             headers, BatchedEntityRequest(entity_request=[req,]).SerializeToString())
-        ApiClient.StatusCodeException.check_status(response)
+        results, missing = self.__lookup_ext_metadata([(uri, extension_kind)])
+        if missing:
+            results = self.__send_ext_metadata(missing)
+        value = results[(uri, extension_kind)]
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def get_ext_metadata_batch(
+        self,
+        queries: typing.Iterable[typing.Tuple[str, ExtensionKind]],
+        batch_size: int = None,
+        max_concurrency: int = None,
+    ) -> typing.Dict[typing.Tuple[str, ExtensionKind], typing.Union[
+            bytes, Exception]]:
+        """
+        Fetch extended metadata for many entities, several kinds per entity
+        are sent in the same EntityRequest. Entries found in the metadata
+        cache are not requested again.
 
-        body = response.content
-        if body is None:
-            raise ConnectionError("Extended Metadata request failed: No response body")
+        Args:
+            queries: (entity uri, extension kind) pairs, duplicates are
+                fetched once
+            batch_size: Entities per request, ext_metadata_batch_size by
+                default
+            max_concurrency: Requests in flight at once, the pool is sized
+                per call; ext_metadata_max_concurrency by default
+
+        Returns:
+            The raw extension data keyed by (uri, kind), or the exception
+            for entities that failed
+        """
+        batch_size = batch_size or self.ext_metadata_batch_size
+        max_concurrency = max_concurrency or self.ext_metadata_max_concurrency
+        results, queries = self.__lookup_ext_metadata(
+            list(dict.fromkeys(queries)))
+        batches = []
+        batch_of = {}
+        for query in queries:
+            index = batch_of.get(query[0])
+            if index is None:
+                index = batch_of[query[0]] = len(batch_of) // batch_size
+                if index == len(batches):
+                    batches.append([])
+            batches[index].append(query)
+        if len(batches) <= 1 or max_concurrency <= 1:
+            for batch in batches:
+                results.update(self.__send_ext_metadata(batch))
+            return results
+        # Sized per call so a larger max_concurrency is honoured, the shared
+        # executor only runs background revalidations
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(max_concurrency, len(batches)),
+                thread_name_prefix="ext-metadata-") as executor:
+            futures = [
+                executor.submit(self.__send_ext_metadata, batch)
+                for batch in batches
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                results.update(future.result())
+        return results
+
+    def get_metadata_batch(
+        self,
+        ids: typing.Iterable[typing.Union[SpotifyId, str]],
+        batch_size: int = None,
+        max_concurrency: int = None,
+    ) -> ApiClient.MetadataBatch:
+        """
+        Fetch the metadata of many tracks, episodes, albums, artists and
+        shows in as few requests as possible
 
-        proto = BatchedExtensionResponse()
-        proto.ParseFromString(body)
-        entityextd = proto.extended_metadata.pop().extension_data.pop()
-        if entityextd.header.status_code != 200:
-            raise ConnectionError("Extended Metadata request failed: Status code {}".format(entityextd.header.status_code))
-        mdb: bytes = entityextd.extension_data.value
-        return mdb
+        Args:
+            ids: Ids or spotify uris of mixed kinds
+            batch_size: Entities per request
+            max_concurrency: Requests in flight at once
+
+        Returns:
+            Parsed Metadata protos keyed by uri, and per uri errors
+        """
+        queries = []
+        for _id in ids:
+            uri = _id if isinstance(_id, str) else _id.to_spotify_uri()
+            kind = ApiClient.metadata_kinds.get(uri.split(":")[1]
+                                                if uri.count(":") == 2 else
+                                                None)
+            if kind is None:
+                raise TypeError("Unsupported metadata uri: {}".format(uri))
+            queries.append((uri, kind[0]))
+        batch = ApiClient.MetadataBatch()
+        results = self.get_ext_metadata_batch(queries, batch_size,
+                                              max_concurrency)
+        for (uri, extension_kind), value in results.items():
+            if isinstance(value, Exception):
+                batch.errors[uri] = value
+                continue
+            md = ApiClient.metadata_kinds[uri.split(":")[1]][1]()
+            try:
+                md.ParseFromString(value)
+            except Exception as ex:
+                batch.errors[uri] = ex
+                continue
+            batch.metadata[uri] = md
+        return batch
 
     def get_metadata_4_track(self, track: TrackId) -> Metadata.Track:
         """
@@ -275,8 +392,39 @@ class ApiClient(Closeable):
 
         """
         response = self.send("GET",
-                             "/playlist/v2/playlist/{}".format(_id.id()), None,
-                             None)
+                             "/playlist/v2/playlist/{}".format(_id.id()),
+                             None,
+                             None,
+                             coalesce=True)
+        ApiClient.StatusCodeException.check_status(response)
+        body = response.content
+        if body is None:
+            raise IOError()
+        proto = Playlist4External.SelectedListContent()
+        proto.ParseFromString(body)
+        return proto
+
+    def coalescing_stats(self) -> typing.Dict[str, int]:
+        return self.__single_flight.stats()
+
+    def close(self) -> None:
+        if self.__executor_service is not None:
+            self.__executor_service.shutdown(wait=False, cancel_futures=True)
+            self.__executor_service = None
+
+    def get_playlist_diff(
+            self, _id: PlaylistId,
+            revision: bytes) -> Playlist4External.SelectedListContent:
+        """
+        Request the changes of a playlist since a revision
+
+        :param _id: PlaylistId:
+        :param revision: bytes: Revision the caller has
+
+        """
+        response = self.send(
+            "GET", "/playlist/v2/playlist/{}/diff?revision={}&handlesContent=".
+            format(_id.id(), self.__format_revision(revision)), None, None)
         ApiClient.StatusCodeException.check_status(response)
         body = response.content
         if body is None:
@@ -293,6 +441,129 @@ class ApiClient(Closeable):
         """
         self.__client_token_str = client_token
 
+    def __executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        if self.__executor_service is None:
+            with self.__lock:
+                if self.__executor_service is None:
+                    self.__executor_service = \
+                        concurrent.futures.ThreadPoolExecutor(
+                            max_workers=self.ext_metadata_max_concurrency,
+                            thread_name_prefix="ext-metadata-revalidate-")
+        return self.__executor_service
+
+    @staticmethod
+    def __copy_response(response: requests.Response) -> requests.Response:
+        # Reading the state consumes the body, the copy owns its headers
+        copied = requests.Response()
+        copied.__setstate__(response.__getstate__())
+        copied.headers = CaseInsensitiveDict(response.headers)
+        return copied
+
+    @staticmethod
+    def __format_revision(revision: bytes) -> str:
+        # Revisions are a 32 bit counter followed by a hash
+        if len(revision) > 4:
+            return "{},{}".format(int.from_bytes(revision[:4], "big"),
+                                  util.bytes_to_hex(revision[4:]))
+        return util.bytes_to_hex(revision)
+
+    def __lookup_ext_metadata(
+        self, queries: typing.List[typing.Tuple[str, ExtensionKind]]
+    ) -> typing.Tuple[typing.Dict[typing.Tuple[str, ExtensionKind], bytes],
+                      typing.List[typing.Tuple[str, ExtensionKind]]]:
+        cache = self.__session.cache().metadata()
+        results = {}
+        missing = []
+        stale = []
+        for query in queries:
+            entry = cache.get(query[0], query[1])
+            if entry is None:
+                missing.append(query)
+                continue
+            results[query] = entry.data
+            if entry.is_expired():
+                stale.append(query)
+        if stale:
+            if cache.background_revalidation:
+                self.__revalidate(stale)
+            else:
+                for query in stale:
+                    del results[query]
+                missing.extend(stale)
+        return results, missing
+
+    def __revalidate(
+            self, queries: typing.List[typing.Tuple[str,
+                                                    ExtensionKind]]) -> None:
+        with self.__lock:
+            queries = [
+                query for query in queries if query not in self.__revalidating
+            ]
+            self.__revalidating.update(queries)
+        if not queries:
+            return
+
+        def revalidate():
+            try:
+                self.__send_ext_metadata(queries)
+            finally:
+                with self.__lock:
+                    self.__revalidating.difference_update(queries)
+
+        self.logger.debug("Revalidating {} metadata entries".format(
+            len(queries)))
+        self.__executor().submit(revalidate)
+
+    def __send_ext_metadata(
+        self, queries: typing.List[typing.Tuple[str, ExtensionKind]]
+    ) -> typing.Dict[typing.Tuple[str, ExtensionKind], typing.Union[
+            bytes, Exception]]:
+        entity_requests = {}
+        for uri, extension_kind in queries:
+            if uri not in entity_requests:
+                entity_requests[uri] = EntityRequest(entity_uri=uri)
+            entity_requests[uri].query.append(
+                ExtensionQuery(extension_kind=extension_kind))
+        try:
+            response = self.send(
+                "POST", "/extended-metadata/v0/extended-metadata",
+                CaseInsensitiveDict(
+                    {"content-type": "application/x-protobuf"}),
+                BatchedEntityRequest(entity_request=entity_requests.values()).
+                SerializeToString(),
+                coalesce=True)
+            ApiClient.StatusCodeException.check_status(response)
+            body = response.content
+            if body is None:
+                raise ConnectionError(
+                    "Extended Metadata request failed: No response body")
+            proto = BatchedExtensionResponse()
+            proto.ParseFromString(body)
+        except Exception as ex:
+            self.logger.warning(
+                "Extended Metadata batch of {} entities failed: {}".format(
+                    len(entity_requests), ex))
+            return {query: ex for query in queries}
+        cache = self.__session.cache().metadata()
+        results = {}
+        for array in proto.extended_metadata:
+            for data in array.extension_data:
+                key = (data.entity_uri, array.extension_kind)
+                if data.header.status_code != 200:
+                    results[key] = ApiClient.EntityException(
+                        data.entity_uri, array.extension_kind,
+                        data.header.status_code)
+                else:
+                    results[key] = data.extension_data.value
+                    cache.put(data.entity_uri, array.extension_kind,
+                              results[key],
+                              data.header.cache_ttl_in_seconds or None)
+        for query in queries:
+            if query not in results:
+                results[query] = ApiClient.EntityException(
+                    query[0], query[1], 404)
+        return results
+
     def __client_token(self):
         proto_req = ClientToken.ClientTokenRequest(
             request_type=ClientToken.ClientTokenRequestType.
@@ -331,6 +602,42 @@ class ApiClient(Closeable):
         proto_resp.ParseFromString(resp.content)
         return proto_resp
 
+    class EntityException(ConnectionError):
+        """ """
+        code: int
+        extension_kind: ExtensionKind
+        uri: str
+
+        def __init__(self, uri: str, extension_kind: ExtensionKind,
+                     code: int):
+            super().__init__(
+                "Extended Metadata request failed: Status code {} for {}".
+                format(code, uri))
+            self.code = code
+            self.extension_kind = extension_kind
+            self.uri = uri
+
+    class MetadataBatch:
+        """ """
+        errors: typing.Dict[str, Exception]
+        metadata: typing.Dict[str, typing.Any]
+
+        def __init__(self):
+            self.errors = {}
+            self.metadata = {}
+
+        def __contains__(self, uri: str) -> bool:
+            return uri in self.metadata
+
+        def __getitem__(self, uri: str):
+            return self.metadata[uri]
+
+        def __len__(self) -> int:
+            return len(self.metadata)
+
+        def get(self, uri: str, default=None):
+            return self.metadata.get(uri, default)
+
     class StatusCodeException(IOError):
         """ """
         code: int
@@ -421,15 +728,23 @@ class DealerClient(Closeable):
     logger = logging.getLogger("Librespot:DealerClient")
     __connection: typing.Union[ConnectionHolder, None]
     __last_scheduled_reconnection: typing.Union[sched.Event, None]
-    __message_listeners: typing.Dict[MessageListener, typing.List[str]] = {}
-    __message_listeners_lock = threading.Condition()
-    __request_listeners: typing.Dict[str, RequestListener] = {}
-    __request_listeners_lock = threading.Condition()
+    __message_listeners: typing.Dict[MessageListener, typing.List[str]]
+    __message_listeners_lock: threading.Condition
+    __message_routes: util.PrefixTrie
+    __request_listeners: typing.Dict[str, RequestListener]
+    __request_listeners_lock: threading.Condition
+    __request_routes: util.PrefixTrie
     __scheduler = sched.scheduler()
     __session: Session
     __worker = concurrent.futures.ThreadPoolExecutor()
 
     def __init__(self, session: Session):
+        self.__message_listeners = {}
+        self.__message_listeners_lock = threading.Condition()
+        self.__message_routes = util.PrefixTrie()
+        self.__request_listeners = {}
+        self.__request_listeners_lock = threading.Condition()
+        self.__request_routes = util.PrefixTrie()
         self.__session = session
 
     def add_message_listener(self, listener: MessageListener,
@@ -445,6 +760,7 @@ class DealerClient(Closeable):
                 raise TypeError(
                     "A listener for {} has already been added.".format(uris))
             self.__message_listeners[listener] = uris
+            self.__message_routes.add_many((uri, listener) for uri in uris)
             self.__message_listeners_lock.notify_all()
 
     def add_request_listener(self, listener: RequestListener, uri: str):
@@ -459,6 +775,7 @@ class DealerClient(Closeable):
                 raise TypeError(
                     "A listener for '{}' has already been added.".format(uri))
             self.__request_listeners[uri] = listener
+            self.__request_routes.add(uri, listener)
             self.__request_listeners_lock.notify_all()
 
     def close(self) -> None:
@@ -510,22 +827,12 @@ class DealerClient(Closeable):
                     decoded_payloads = gzip.decompress(decoded_payloads)
         else:
             decoded_payloads = b""
-        interesting = False
-        with self.__message_listeners_lock:
-            for listener in self.__message_listeners:
-                dispatched = False
-                keys = self.__message_listeners.get(listener)
-                for key in keys:
-                    if uri.startswith(key) and not dispatched:
-                        interesting = True
-
-                        def anonymous():
-                            """ """
-                            listener.on_message(uri, headers, decoded_payloads)
-
-                        self.__worker.submit(anonymous)
-                        dispatched = True
-        if not interesting:
+        # A listener registered for several matching uris gets the message once
+        listeners = dict.fromkeys(self.__message_routes.match(uri))
+        for listener in listeners:
+            self.__worker.submit(listener.on_message, uri, headers,
+                                 decoded_payloads)
+        if not listeners:
             self.logger.debug("Couldn't dispatch message: {}".format(uri))
 
     def handle_request(self, obj: typing.Any) -> None:
@@ -547,24 +854,19 @@ class DealerClient(Closeable):
         self.logger.debug(
             "Received request. [mid: {}, key: {}, pid: {}, sender: {}, command: {}]"
             .format(mid, key, pid, sender, command))
-        interesting = False
-        with self.__request_listeners_lock:
-            for mid_prefix in self.__request_listeners:
-                if mid.startswith(mid_prefix):
-                    listener = self.__request_listeners.get(mid_prefix)
-                    interesting = True
-
-                    def anonymous():
-                        """ """
-                        result = listener.on_request(mid, pid, sender, command)
-                        if self.__connection is not None:
-                            self.__connection.send_reply(key, result)
-                        self.logger.warning(
-                            "Handled request. [key: {}, result: {}]".format(
-                                key, result))
-
-                    self.__worker.submit(anonymous)
-        if not interesting:
+
+        def anonymous(listener: RequestListener):
+            """ """
+            result = listener.on_request(mid, pid, sender, command)
+            if self.__connection is not None:
+                self.__connection.send_reply(key, result)
+            self.logger.warning(
+                "Handled request. [key: {}, result: {}]".format(key, result))
+
+        listeners = self.__request_routes.match(mid)
+        for listener in listeners:
+            self.__worker.submit(anonymous, listener)
+        if not listeners:
             self.logger.debug("Couldn't dispatch request: {}".format(mid))
 
     def remove_message_listener(self, listener: MessageListener) -> None:
@@ -574,7 +876,8 @@ class DealerClient(Closeable):
 
         """
         with self.__message_listeners_lock:
-            self.__message_listeners.pop(listener)
+            for uri in self.__message_listeners.pop(listener):
+                self.__message_routes.remove(uri, listener)
 
     def remove_request_listener(self, listener: RequestListener) -> None:
         """
@@ -587,6 +890,8 @@ class DealerClient(Closeable):
             for key, value in self.__request_listeners.items():
                 if value != listener:
                     request_listeners[key] = value
+                else:
+                    self.__request_routes.remove(key, value)
             self.__request_listeners = request_listeners
 
     def wait_for_listener(self) -> None:
@@ -879,6 +1184,206 @@ class MessageType(enum.Enum):
         raise TypeError("Unknown MessageType: {}".format(_typ))
 
 
+class PlaylistSync:
+    """
+    Keeps playlist contents together with their revision and brings them
+    up to date with the diff since that revision, falling back to a full
+    fetch when the diff can't be requested or applied
+    """
+    logger = logging.getLogger("Librespot:PlaylistSync")
+    ttl = 30 * 86400
+    __lock: threading.Lock
+    __session: Session
+    __stats: typing.Dict[str, int]
+
+    def __init__(self, session: Session):
+        self.__lock = threading.Lock()
+        self.__session = session
+        self.__stats = {
+            "full_fetches": 0,
+            "diffs": 0,
+            "up_to_date": 0,
+            "fallbacks": 0,
+            "bytes_received": 0,
+        }
+
+    def cached(
+        self, _id: PlaylistId
+    ) -> typing.Union[Playlist4External.SelectedListContent, None]:
+        """
+        Returns:
+            The stored contents without contacting the server, None if the
+            playlist was never synced
+        """
+        entry = self.__session.cache().playlists().get(_id.to_spotify_uri())
+        if entry is None:
+            return None
+        try:
+            return Playlist4External.SelectedListContent.FromString(entry.data)
+        except google.protobuf.message.DecodeError as ex:
+            self.logger.warning("Discarding stored {}: {}".format(
+                _id.to_spotify_uri(), ex))
+            self.__session.cache().playlists().invalidate(
+                _id.to_spotify_uri())
+            return None
+
+    def sync(self, _id: PlaylistId) -> Playlist4External.SelectedListContent:
+        """
+        Bring a playlist up to date, only requesting the diff since the
+        stored revision when there is one
+
+        :param _id: PlaylistId:
+
+        """
+        entry = self.__session.cache().playlists().get(_id.to_spotify_uri())
+        if entry is not None:
+            try:
+                current = Playlist4External.SelectedListContent.FromString(
+                    entry.data)
+                response = self.__session.api().get_playlist_diff(
+                    _id, current.revision)
+                self.__count("bytes_received", response.ByteSize())
+                if self.__is_up_to_date(current, response):
+                    self.__count("up_to_date")
+                    if entry.is_expired():
+                        self.__store(_id, current)
+                    return current
+                updated = self.__apply(current, response)
+            except (IOError, ValueError, IndexError,
+                    google.protobuf.message.DecodeError) as ex:
+                self.logger.debug("Couldn't sync {} from its diff: {}".format(
+                    _id.to_spotify_uri(), ex))
+                updated = None
+            if updated is not None:
+                self.__count("diffs")
+                self.__store(_id, updated)
+                return updated
+            self.__count("fallbacks")
+        proto = self.__session.api().get_playlist(_id)
+        self.__count("full_fetches")
+        self.__count("bytes_received", proto.ByteSize())
+        self.__store(_id, proto)
+        return proto
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self.__lock:
+            return dict(self.__stats)
+
+    def __apply(
+        self, current: Playlist4External.SelectedListContent,
+        response: Playlist4External.SelectedListContent
+    ) -> typing.Union[Playlist4External.SelectedListContent, None]:
+        if not response.HasField("diff"):
+            return None
+        diff = response.diff
+        if diff.from_revision != current.revision:
+            return None
+        items = []
+        for item in current.contents.items:
+            copy = Playlist4External.Item()
+            copy.CopyFrom(item)
+            items.append(copy)
+        for op in diff.ops:
+            self.__apply_op(current, items, op)
+        del current.contents.items[:]
+        current.contents.items.extend(items)
+        current.contents.pos = 0
+        current.contents.truncated = False
+        current.length = len(items)
+        current.revision = diff.to_revision
+        return current
+
+    def __apply_op(self, current: Playlist4External.SelectedListContent,
+                   items: typing.List[Playlist4External.Item],
+                   op: Playlist4External.Op) -> None:
+        if op.kind == Playlist4External.Op.ADD:
+            if op.add.add_last:
+                index = len(items)
+            elif op.add.add_first:
+                index = 0
+            else:
+                index = op.add.from_index
+            if index > len(items):
+                raise IndexError("ADD at {} of {}".format(index, len(items)))
+            items[index:index] = list(op.add.items)
+        elif op.kind == Playlist4External.Op.REM:
+            start = op.rem.from_index
+            end = start + op.rem.length
+            if end > len(items):
+                raise IndexError("REM {}-{} of {}".format(
+                    start, end, len(items)))
+            for item, removed in zip(items[start:end], op.rem.items):
+                if item.uri != removed.uri:
+                    raise ValueError("REM of {} at a position holding {}".format(
+                        removed.uri, item.uri))
+            del items[start:end]
+        elif op.kind == Playlist4External.Op.MOV:
+            start = op.mov.from_index
+            end = start + op.mov.length
+            if end > len(items) or op.mov.to_index > len(items):
+                raise IndexError("MOV {}-{} to {} of {}".format(
+                    start, end, op.mov.to_index, len(items)))
+            moved = items[start:end]
+            del items[start:end]
+            # to_index points into the list before the items were taken out
+            index = op.mov.to_index
+            if index > start:
+                index -= op.mov.length
+            items[index:index] = moved
+        elif op.kind == Playlist4External.Op.UPDATE_ITEM_ATTRIBUTES:
+            index = op.update_item_attributes.index
+            if index >= len(items):
+                raise IndexError("UPDATE_ITEM_ATTRIBUTES at {} of {}".format(
+                    index, len(items)))
+            self.__merge(items[index].attributes,
+                         op.update_item_attributes.new_attributes)
+        elif op.kind == Playlist4External.Op.UPDATE_LIST_ATTRIBUTES:
+            self.__merge(current.attributes,
+                         op.update_list_attributes.new_attributes)
+        else:
+            raise ValueError("Unknown op kind: {}".format(op.kind))
+
+    @staticmethod
+    def __is_up_to_date(
+            current: Playlist4External.SelectedListContent,
+            response: Playlist4External.SelectedListContent) -> bool:
+        if response.up_to_date:
+            return True
+        if response.HasField("diff"):
+            return (len(response.diff.ops) == 0 and
+                    response.diff.to_revision == current.revision)
+        return response.revision == current.revision
+
+    @staticmethod
+    def __merge(target, partial_state) -> None:
+        # Attribute kinds share their numbers with the attribute fields
+        for field, value in partial_state.values.ListFields():
+            if field.label == field.LABEL_REPEATED:
+                target.ClearField(field.name)
+                getattr(target, field.name).extend(value)
+            elif field.message_type is not None:
+                getattr(target, field.name).CopyFrom(value)
+            else:
+                setattr(target, field.name, value)
+        for kind in partial_state.no_value:
+            field = target.DESCRIPTOR.fields_by_number.get(kind)
+            if field is not None:
+                target.ClearField(field.name)
+
+    def __count(self, name: str, amount: int = 1) -> None:
+        with self.__lock:
+            self.__stats[name] += amount
+
+    def __store(self, _id: PlaylistId,
+                proto: Playlist4External.SelectedListContent) -> None:
+        if proto.contents.truncated or proto.contents.pos != 0:
+            # Diffs can't be applied to a partial list
+            return
+        self.__session.cache().playlists().put(_id.to_spotify_uri(),
+                                               proto.SerializeToString(),
+                                               self.ttl)
+
+
 class Session(Closeable, MessageListener, SubListener):
     """ """
     cipher_pair: typing.Union[CipherPair, None]
@@ -887,12 +1392,12 @@ class Session(Closeable, MessageListener, SubListener):
     logger = logging.getLogger("Librespot:Session")
     scheduled_reconnect: typing.Union[sched.Event, None] = None
     scheduler = sched.scheduler(time.time)
-    __api: ApiClient
+    __api: typing.Union[ApiClient, None] = None
     __ap_welcome: Authentication.APWelcome
     __audio_key_manager: typing.Union[AudioKeyManager, None] = None
     __auth_lock = threading.Condition()
     __auth_lock_bool = False
-    __cache_manager: typing.Union[CacheManager, None]
+    __cache_manager: typing.Union[CacheManager, None] = None
     __cdn_manager: typing.Union[CdnManager, None]
     __channel_manager: typing.Union[ChannelManager, None] = None
     __client: typing.Union[requests.Session, None]
@@ -903,6 +1408,8 @@ class Session(Closeable, MessageListener, SubListener):
     __event_service: typing.Union[EventService, None] = None
     __keys: DiffieHellman
     __mercury_client: MercuryClient
+    __packets: PacketTable
+    __playlists: typing.Union[PlaylistSync, None] = None
     __receiver: typing.Union[Receiver, None] = None
     __search: typing.Union[SearchManager, None]
     __server_key = (b"\xac\xe0F\x0b\xff\xc20\xaf\xf4k\xfe\xc3\xbf\xbf\x86="
@@ -929,6 +1436,18 @@ class Session(Closeable, MessageListener, SubListener):
         self.connection = Session.ConnectionHolder.create(address, None)
         self.__inner = inner
         self.__keys = DiffieHellman()
+        self.__packets = PacketTable()
+        self.__packets.register([Packet.Type.ping], self.__on_ping)
+        self.__packets.register([Packet.Type.pong_ack], lambda packet: None)
+        self.__packets.register([Packet.Type.country_code],
+                                self.__on_country_code)
+        self.__packets.register([Packet.Type.license_version],
+                                self.__on_license_version)
+        self.__packets.register([Packet.Type.unknown_0x10],
+                                self.__on_unknown_0x10)
+        self.__packets.register(
+            [Packet.Type.product_info],
+            lambda packet: self.parse_product_info(packet.payload))
         self.logger.info("Created new session! device_id: {}, ap: {}".format(
             inner.device_id, address))
 
@@ -973,7 +1492,13 @@ class Session(Closeable, MessageListener, SubListener):
             self.__cache_manager = CacheManager(self)
             self.__dealer_client = DealerClient(self)
             self.__search = SearchManager(self)
+            self.__playlists = PlaylistSync(self)
             self.__event_service = EventService(self)
+            for receiver in [
+                    self.__mercury_client, self.__audio_key_manager,
+                    self.__channel_manager
+            ]:
+                self.__packets.register_receiver(receiver)
             self.__auth_lock_bool = False
             self.__auth_lock.notify_all()
         self.dealer().connect()
@@ -1016,7 +1541,10 @@ class Session(Closeable, MessageListener, SubListener):
         if self.__dealer_client is not None:
             self.__dealer_client.close()
             self.__dealer_client = None
+        if self.__api is not None:
+            self.__api.close()
         if self.__audio_key_manager is not None:
+            self.__audio_key_manager.close()
             self.__audio_key_manager = None
         if self.__channel_manager is not None:
             self.__channel_manager.close()
@@ -1024,6 +1552,9 @@ class Session(Closeable, MessageListener, SubListener):
         if self.__event_service is not None:
             self.__event_service.close()
             self.__event_service = None
+        if self.__cache_manager is not None:
+            self.__cache_manager.close()
+            self.__cache_manager = None
         if self.__receiver is not None:
             self.__receiver.stop()
             self.__receiver = None
@@ -1040,6 +1571,10 @@ class Session(Closeable, MessageListener, SubListener):
         self.logger.info("Closed session. device_id: {}".format(
             self.__inner.device_id))
 
+    def configuration(self) -> Session.Configuration:
+        """ """
+        return self.__inner.conf
+
     def connect(self) -> None:
         """Connect to the Spotify Server"""
         acc = Session.Accumulator()
@@ -1067,8 +1602,8 @@ class Session(Closeable, MessageListener, SubListener):
         # Read APResponseMessage
         ap_response_message_length = self.connection.read_int()
         acc.write_int(ap_response_message_length)
-        ap_response_message_bytes = self.connection.read(
-            ap_response_message_length - 4)
+        ap_response_message_bytes = bytes(
+            self.connection.read(ap_response_message_length - 4))
         acc.write(ap_response_message_bytes)
         ap_response_message_proto = Keyexchange.APResponseMessage()
         ap_response_message_proto.ParseFromString(ap_response_message_bytes)
@@ -1115,8 +1650,8 @@ class Session(Closeable, MessageListener, SubListener):
             self.connection.set_timeout(1)
             scrap = self.connection.read(4)
             if len(scrap) == 4:
-                payload = self.connection.read(
-                    struct.unpack(">i", scrap)[0] - 4)
+                payload = bytes(
+                    self.connection.read(struct.unpack(">i", scrap)[0] - 4))
                 failed = Keyexchange.APResponseMessage()
                 failed.ParseFromString(payload)
                 raise RuntimeError(failed)
@@ -1130,6 +1665,14 @@ class Session(Closeable, MessageListener, SubListener):
             self.__auth_lock_bool = True
         self.logger.info("Connection successfully!")
 
+    def connection_stats(self) -> typing.Dict[str, float]:
+        """Socket reads of the current AP connection per received packet"""
+        stats = self.connection.stats()
+        packets = self.cipher_pair.received_packets()
+        stats["packets"] = packets
+        stats["reads_per_packet"] = stats["reads"] / max(1, packets)
+        return stats
+
     def content_feeder(self) -> PlayableContentFeeder:
         """ """
         self.__wait_auth_lock()
@@ -1217,6 +1760,10 @@ class Session(Closeable, MessageListener, SubListener):
         if uri == "hm://connect-state/v1/connect/logout":
             self.close()
 
+    def packets(self) -> PacketTable:
+        """Command table dispatching the packets received from the AP"""
+        return self.__packets
+
     def parse_product_info(self, data) -> None:
         """Parse product information
 
@@ -1261,6 +1808,13 @@ class Session(Closeable, MessageListener, SubListener):
         """ """
         return not self.__closing and not self.__closed and self.connection is None
 
+    def playlists(self) -> PlaylistSync:
+        """ """
+        self.__wait_auth_lock()
+        if self.__playlists is None:
+            raise RuntimeError("Session isn't authenticated!")
+        return self.__playlists
+
     def search(self) -> SearchManager:
         """ """
         self.__wait_auth_lock()
@@ -1302,6 +1856,38 @@ class Session(Closeable, MessageListener, SubListener):
         """ """
         return self.__stored_str
 
+    def __on_country_code(self, packet: Packet) -> None:
+        self.country_code = packet.payload.decode()
+        self.logger.info("Received country_code: {}".format(
+            self.country_code))
+
+    def __on_license_version(self, packet: Packet) -> None:
+        license_version = io.BytesIO(packet.payload)
+        license_id = struct.unpack(">h", license_version.read(2))[0]
+        if license_id != 0:
+            buffer = license_version.read()
+            self.logger.info("Received license_version: {}, {}".format(
+                license_id, buffer.decode()))
+        else:
+            self.logger.info("Received license_version: {}".format(license_id))
+
+    def __on_ping(self, packet: Packet) -> None:
+        if self.scheduled_reconnect is not None:
+            self.scheduler.cancel(self.scheduled_reconnect)
+
+        def anonymous():
+            """ """
+            self.logger.warning("Socket timed out. Reconnecting...")
+            self.reconnect()
+
+        self.scheduled_reconnect = self.scheduler.enter(2 * 60 + 5, 1,
+                                                        anonymous)
+        self.send(Packet.Type.pong, packet.payload)
+
+    def __on_unknown_0x10(self, packet: Packet) -> None:
+        self.logger.debug("Received 0x10: {}".format(
+            util.bytes_to_hex(packet.payload)))
+
     def __authenticate_partial(self,
                                credential: Authentication.LoginCredentials,
                                remove_lock: bool) -> None:
@@ -1695,6 +2281,7 @@ class Session(Closeable, MessageListener, SubListener):
         cache_enabled: bool
         cache_dir: str
         do_cache_clean_up: bool
+        cache_max_size: int
 
         # Stored credentials
         store_credentials: bool
@@ -1702,6 +2289,7 @@ class Session(Closeable, MessageListener, SubListener):
 
         # Fetching
         retry_on_chunk_error: bool
+        fast_start: bool
 
         def __init__(
             self,
@@ -1718,6 +2306,8 @@ class Session(Closeable, MessageListener, SubListener):
             store_credentials: bool,
             stored_credentials_file: str,
             retry_on_chunk_error: bool,
+            cache_max_size: int = 1024 * 1024 * 1024,
+            fast_start: bool = False,
         ):
             # self.proxyEnabled = proxy_enabled
             # self.proxyType = proxy_type
@@ -1732,6 +2322,8 @@ class Session(Closeable, MessageListener, SubListener):
             self.store_credentials = store_credentials
             self.stored_credentials_file = stored_credentials_file
             self.retry_on_chunk_error = retry_on_chunk_error
+            self.cache_max_size = cache_max_size
+            self.fast_start = fast_start
 
         class Builder:
             """ """
@@ -1748,6 +2340,7 @@ class Session(Closeable, MessageListener, SubListener):
             cache_enabled: bool = True
             cache_dir: str = os.path.join(os.getcwd(), "cache")
             do_cache_clean_up: bool = True
+            cache_max_size: int = 1024 * 1024 * 1024
 
             # Stored credentials
             store_credentials: bool = True
@@ -1756,6 +2349,7 @@ class Session(Closeable, MessageListener, SubListener):
 
             # Fetching
             retry_on_chunk_error: bool = True
+            fast_start: bool = False
 
             # def set_proxy_enabled(
             #         self,
@@ -1826,6 +2420,19 @@ class Session(Closeable, MessageListener, SubListener):
                 self.do_cache_clean_up = do_cache_clean_up
                 return self
 
+            def set_cache_max_size(
+                    self,
+                    cache_max_size: int) -> Session.Configuration.Builder:
+                """Set cache_max_size, 1 GiB by default, 0 lets the audio
+                cache grow without limit
+
+                :param cache_max_size: int: Maximum cache size in bytes
+                :returns: Builder
+
+                """
+                self.cache_max_size = cache_max_size
+                return self
+
             def set_store_credentials(
                     self,
                     store_credentials: bool) -> Session.Configuration.Builder:
@@ -1862,6 +2469,18 @@ class Session(Closeable, MessageListener, SubListener):
                 self.retry_on_chunk_error = retry_on_chunk_error
                 return self
 
+            def set_fast_start(
+                    self, fast_start: bool) -> Session.Configuration.Builder:
+                """Set fast_start, only fetch the head of the first chunk before
+                returning a stream and fill the rest in the background
+
+                :param fast_start: bool:
+                :returns: Builder
+
+                """
+                self.fast_start = fast_start
+                return self
+
             def build(self) -> Session.Configuration:
                 """Build Configuration instance
 
@@ -1883,15 +2502,32 @@ class Session(Closeable, MessageListener, SubListener):
                     self.store_credentials,
                     self.stored_credentials_file,
                     self.retry_on_chunk_error,
+                    self.cache_max_size,
+                    self.fast_start,
                 )
 
     class ConnectionHolder:
-        """ """
+        """
+        AP socket. Writes are buffered until flush, reads are served from a
+        reusable buffer filled with recv_into, as much as the socket has
+        available per call.
+        """
+        read_buffer_size = 65536
         __buffer: io.BytesIO
+        __read_buffer: bytearray
+        __read_bytes: int
+        __read_end: int
+        __read_start: int
+        __reads: int
         __socket: socket.socket
 
         def __init__(self, sock: socket.socket):
             self.__buffer = io.BytesIO()
+            self.__read_buffer = bytearray(self.read_buffer_size)
+            self.__read_bytes = 0
+            self.__read_end = 0
+            self.__read_start = 0
+            self.__reads = 0
             self.__socket = sock
 
         @staticmethod
@@ -1923,14 +2559,19 @@ class Session(Closeable, MessageListener, SubListener):
             except BrokenPipeError:
                 pass
 
-        def read(self, length: int) -> bytes:
-            """Read data from socket
+        def read(self, length: int) -> memoryview:
+            """Read exactly length bytes from socket
 
             :param length: int:
-            :returns: Bytes data from socket
+            :returns: View of the bytes in the read buffer, only valid until
+                the next read
 
             """
-            return self.__socket.recv(length)
+            if self.__read_end - self.__read_start < length:
+                self.__fill(length)
+            start = self.__read_start
+            self.__read_start += length
+            return memoryview(self.__read_buffer)[start:start + length]
 
         def read_int(self) -> int:
             """Read integer from socket
@@ -1950,6 +2591,14 @@ class Session(Closeable, MessageListener, SubListener):
             """
             return struct.unpack(">h", self.read(2))[0]
 
+        def stats(self) -> typing.Dict[str, float]:
+            """Read syscalls made on the socket and bytes they returned"""
+            return {
+                "reads": self.__reads,
+                "bytes": self.__read_bytes,
+                "bytes_per_read": self.__read_bytes / max(1, self.__reads),
+            }
+
         def set_timeout(self, seconds: float) -> None:
             """Set socket's timeout
 
@@ -1986,6 +2635,32 @@ class Session(Closeable, MessageListener, SubListener):
             """
             self.write(struct.pack(">h", data))
 
+        def __fill(self, length: int) -> None:
+            # Makes room for length bytes past the read position, then
+            # receives until they are all buffered. Views handed out
+            # earlier keep the buffer from being resized, so a buffer too
+            # small is replaced instead
+            buffer = self.__read_buffer
+            start = self.__read_start
+            end = self.__read_end
+            if start == end:
+                start = end = self.__read_start = self.__read_end = 0
+            if len(buffer) - start < length:
+                if len(buffer) < length:
+                    buffer = bytearray(max(length, self.read_buffer_size))
+                buffer[:end - start] = self.__read_buffer[start:end]
+                self.__read_buffer = buffer
+                self.__read_start = 0
+                self.__read_end = end - start
+            while self.__read_end - self.__read_start < length:
+                received = self.__socket.recv_into(
+                    memoryview(buffer)[self.__read_end:])
+                self.__reads += 1
+                if received == 0:
+                    raise ConnectionResetError("Connection closed by the AP")
+                self.__read_bytes += received
+                self.__read_end += received
+
     class Inner:
         """ """
         device_type: Connect.DeviceType = None
@@ -2031,17 +2706,9 @@ class Session(Closeable, MessageListener, SubListener):
             self.__session.logger.info("Session.Receiver started")
             while self.__running:
                 packet: Packet
-                cmd: bytes
                 try:
                     packet = self.__session.cipher_pair.receive_encoded(
                         self.__session.connection)
-                    cmd = Packet.Type.parse(packet.cmd)
-                    if cmd is None:
-                        self.__session.logger.info(
-                            "Skipping unknown command cmd: 0x{}, payload: {}".
-                            format(util.bytes_to_hex(packet.cmd),
-                                   packet.payload))
-                        continue
                 except (RuntimeError, ConnectionResetError) as ex:
                     if self.__running:
                         self.__session.logger.fatal(
@@ -2050,60 +2717,12 @@ class Session(Closeable, MessageListener, SubListener):
                     break
                 if not self.__running:
                     break
-                if cmd == Packet.Type.ping:
-                    if self.__session.scheduled_reconnect is not None:
-                        self.__session.scheduler.cancel(
-                            self.__session.scheduled_reconnect)
-
-                    def anonymous():
-                        """ """
-                        self.__session.logger.warning(
-                            "Socket timed out. Reconnecting...")
-                        self.__session.reconnect()
-
-                    self.__session.scheduled_reconnect = self.__session.scheduler.enter(
-                        2 * 60 + 5, 1, anonymous)
-                    self.__session.send(Packet.Type.pong, packet.payload)
-                elif cmd == Packet.Type.pong_ack:
-                    continue
-                elif cmd == Packet.Type.country_code:
-                    self.__session.__country_code = packet.payload.decode()
+                if not self.__session.packets().dispatch(packet):
                     self.__session.logger.info(
-                        "Received country_code: {}".format(
-                            self.__session.__country_code))
-                elif cmd == Packet.Type.license_version:
-                    license_version = io.BytesIO(packet.payload)
-                    license_id = struct.unpack(">h",
-                                               license_version.read(2))[0]
-                    if license_id != 0:
-                        buffer = license_version.read()
-                        self.__session.logger.info(
-                            "Received license_version: {}, {}".format(
-                                license_id, buffer.decode()))
-                    else:
-                        self.__session.logger.info(
-                            "Received license_version: {}".format(license_id))
-                elif cmd == Packet.Type.unknown_0x10:
-                    self.__session.logger.debug("Received 0x10: {}".format(
-                        util.bytes_to_hex(packet.payload)))
-                elif cmd in [
-                        Packet.Type.mercury_sub,
-                        Packet.Type.mercury_unsub,
-                        Packet.Type.mercury_event,
-                        Packet.Type.mercury_req,
-                ]:
-                    self.__session.mercury().dispatch(packet)
-                elif cmd in [Packet.Type.aes_key, Packet.Type.aes_key_error]:
-                    self.__session.audio_key().dispatch(packet)
-                elif cmd in [
-                        Packet.Type.channel_error, Packet.Type.stream_chunk_res
-                ]:
-                    self.__session.channel().dispatch(packet)
-                elif cmd == Packet.Type.product_info:
-                    self.__session.parse_product_info(packet.payload)
-                else:
-                    self.__session.logger.info("Skipping {}".format(
-                        util.bytes_to_hex(cmd)))
+                        "Skipping {} cmd: 0x{}, payload: {}".format(
+                            "unknown" if Packet.Type.parse(packet.cmd) is None
+                            else "unhandled", util.bytes_to_hex(packet.cmd),
+                            packet.payload))
 
     class SpotifyAuthenticationException(Exception):
         """ """
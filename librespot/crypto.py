@@ -1,9 +1,12 @@
 from __future__ import annotations
 from Cryptodome import Random
 from librespot import util
+from librespot.structure import PacketsReceiver
+import array
 import io
-import re
+import itertools
 import struct
+import sys
 import typing
 
 if typing.TYPE_CHECKING:
@@ -60,14 +63,17 @@ class CipherPair:
             payload_length = (header_bytes[1] << 8) | (header_bytes[2] & 0xff)
             payload_bytes = self.__receive_cipher.decrypt(
                 connection.read(payload_length))
-            mac = connection.read(4)
             expected_mac = self.__receive_cipher.finish(4)
+            mac = connection.read(4)
             if mac != expected_mac:
                 raise RuntimeError()
             return Packet(cmd, payload_bytes)
         except (IndexError, OSError):
             raise RuntimeError("Failed to receive packet")
 
+    def received_packets(self) -> int:
+        return self.__receive_nonce
+
 
 class DiffieHellman:
     """
@@ -165,16 +171,14 @@ class Packet:
         unknown_0x0f = b"\x0f"
         unknown_0x10 = b"\x10"
 
+        @staticmethod
+        def name(cmd: bytes) -> str:
+            name = Packet.Type.names.get(cmd)
+            return "0x" + util.bytes_to_hex(cmd) if name is None else name
+
         @staticmethod
         def parse(val: typing.Union[bytes, None]) -> typing.Union[bytes, None]:
-            for cmd in [
-                    Packet.Type.__dict__[attr] for attr in Packet.Type.__dict__
-                    if re.search("__.+?__", attr) is None
-                    and type(Packet.Type.__dict__[attr]) is bytes
-            ]:
-                if cmd == val:
-                    return cmd
-            return None
+            return val if val in Packet.Type.names else None
 
         @staticmethod
         def for_method(method: str) -> bytes:
@@ -185,13 +189,95 @@ class Packet:
             return Packet.Type.mercury_req
 
 
+Packet.Type.names = {
+    value: name
+    for name, value in vars(Packet.Type).items() if type(value) is bytes
+}
+
+
+class PacketTable:
+    """
+    256-entry table mapping a command byte to the handler of its packets,
+    with packet and byte counters per command. Dispatching is one index
+    into a list, the receiver thread handles every packet from the AP.
+    """
+    __bytes: typing.List[int]
+    __handlers: typing.List[typing.Union[typing.Callable[[Packet], None],
+                                         None]]
+    __packets: typing.List[int]
+
+    def __init__(self):
+        self.__bytes = [0] * 256
+        self.__handlers = [None] * 256
+        self.__packets = [0] * 256
+
+    def dispatch(self, packet: Packet) -> bool:
+        """
+        Count the packet and hand it to the handler of its command
+        Returns:
+            False if no handler is registered for the command
+        """
+        cmd = packet.cmd[0]
+        self.__packets[cmd] += 1
+        self.__bytes[cmd] += len(packet.payload)
+        handler = self.__handlers[cmd]
+        if handler is None:
+            return False
+        handler(packet)
+        return True
+
+    def register(self, cmds: typing.Iterable[bytes],
+                 handler: typing.Callable[[Packet], None]) -> None:
+        for cmd in cmds:
+            self.__handlers[cmd[0]] = handler
+
+    def register_receiver(self, receiver: PacketsReceiver) -> None:
+        """
+        Route the packet types a receiver declares to its dispatch
+        """
+        self.register(receiver.packet_types, receiver.dispatch)
+
+    def stats(self) -> typing.Dict[str, typing.Dict[str, int]]:
+        """
+        Returns:
+            Packets and payload bytes received per command name, commands
+            never received are left out
+        """
+        return {
+            Packet.Type.name(bytes([cmd])): {
+                "packets": self.__packets[cmd],
+                "bytes": self.__bytes[cmd],
+            }
+            for cmd in range(256) if self.__packets[cmd] > 0
+        }
+
+    def unregister(self, cmds: typing.Iterable[bytes]) -> None:
+        for cmd in cmds:
+            self.__handlers[cmd[0]] = None
+
+
 class Shannon:
+    """
+    Shannon stream cipher with MAC. The register and the CRC are rings of
+    16 words addressed through a moving start index, a cycle overwrites the
+    oldest word instead of shifting the other fifteen. Buffers are processed
+    as little-endian 32-bit words, only an unaligned head and tail go
+    through the byte path.
+    """
     n = 16
     fold = n
     initkonst = 0x6996c53a
     keyp = 13
+    mask = 0xffffffff
+    __big_endian = sys.byteorder == "big"
+    __steps = [
+        tuple((start + k) & 15 for k in [0, 1, 2, 3, 9, 12, 13, 14, 15])
+        for start in range(16)
+    ]
     r: list
+    r_start: int
     crc: list
+    crc_start: int
     init_r: list
     konst: int
     sbuf: int
@@ -199,12 +285,18 @@ class Shannon:
     nbuf: int
 
     def __init__(self):
-        self.r = [0 for _ in range(self.n)]
-        self.crc = [0 for _ in range(self.n)]
-        self.init_r = [0 for _ in range(self.n)]
+        self.r = [0] * self.n
+        self.r_start = 0
+        self.crc = [0] * self.n
+        self.crc_start = 0
+        self.init_r = [0] * self.n
+        self.konst = 0
+        self.sbuf = 0
+        self.mbuf = 0
+        self.nbuf = 0
 
     def rotl(self, i: int, distance: int) -> int:
-        return ((i << distance) | (i >> (32 - distance))) & 0xffffffff
+        return ((i << distance) | (i >> (32 - distance))) & self.mask
 
     def sbox(self, i: int) -> int:
         i ^= self.rotl(i, 5) | self.rotl(i, 7)
@@ -217,28 +309,36 @@ class Shannon:
         return i
 
     def cycle(self) -> None:
-        t: int
-        t = self.r[12] ^ self.r[13] ^ self.konst
-        t = self.sbox(t) ^ self.rotl(self.r[0], 1)
-        for i in range(1, self.n):
-            self.r[i - 1] = self.r[i]
-        self.r[self.n - 1] = t
-        t = self.sbox2(self.r[2] ^ self.r[15])
-        self.r[0] ^= t
-        self.sbuf = t ^ self.r[8] ^ self.r[12]
+        # Same steps as the word loop in __crypt_words, with the sboxes
+        # and rotations written out
+        r = self.r
+        start = self.r_start
+        t = r[(start + 12) & 15] ^ r[(start + 13) & 15] ^ self.konst
+        t ^= ((t << 5 | t >> 27) | (t << 7 | t >> 25)) & 0xffffffff
+        t ^= ((t << 19 | t >> 13) | (t << 22 | t >> 10)) & 0xffffffff
+        u = r[start]
+        t ^= (u << 1 | u >> 31) & 0xffffffff
+        r[start] = t
+        start = (start + 1) & 15
+        t ^= r[(start + 2) & 15]
+        t ^= ((t << 7 | t >> 25) | (t << 22 | t >> 10)) & 0xffffffff
+        t ^= ((t << 5 | t >> 27) | (t << 19 | t >> 13)) & 0xffffffff
+        r[start] ^= t
+        self.sbuf = t ^ r[(start + 8) & 15] ^ r[(start + 12) & 15]
+        self.r_start = start
 
     def crc_func(self, i: int) -> None:
-        t: int
-        t = self.crc[0] ^ self.crc[2] ^ self.crc[15] ^ i
-        for j in range(1, self.n):
-            self.crc[j - 1] = self.crc[j]
-        self.crc[self.n - 1] = t
+        crc = self.crc
+        start = self.crc_start
+        crc[start] ^= crc[(start + 2) & 15] ^ crc[(start + 15) & 15] ^ i
+        self.crc_start = (start + 1) & 15
 
     def mac_func(self, i: int) -> None:
         self.crc_func(i)
-        self.r[self.keyp] ^= i
+        self.r[(self.r_start + self.keyp) & 15] ^= i
 
     def init_state(self) -> None:
+        self.r_start = 0
         self.r[0] = 1
         self.r[1] = 1
         for i in range(2, self.n):
@@ -246,39 +346,35 @@ class Shannon:
         self.konst = self.initkonst
 
     def save_state(self) -> None:
-        for i in range(self.n):
-            self.init_r[i] = self.r[i]
+        self.init_r = self.__registers()
 
     def reload_state(self) -> None:
-        for i in range(self.n):
-            self.r[i] = self.init_r[i]
+        self.r = list(self.init_r)
+        self.r_start = 0
 
     def gen_konst(self) -> None:
-        self.konst = self.r[0]
+        self.konst = self.r[self.r_start]
 
     def add_key(self, k: int) -> None:
-        self.r[self.keyp] ^= k
+        self.r[(self.r_start + self.keyp) & 15] ^= k
 
     def diffuse(self) -> None:
         for _ in range(self.fold):
             self.cycle()
 
     def load_key(self, key: bytes) -> None:
-        i: int
-        j: int
-        t: int
         padding_size = int((len(key) + 3) / 4) * 4 - len(key)
         key = key + (b"\x00" * padding_size) + struct.pack("<I", len(key))
-        for i in range(0, len(key), 4):
-            self.r[self.keyp] = \
-                self.r[self.keyp] ^ \
-                struct.unpack("<I", key[i: i + 4])[0]
+        for (word, ) in struct.iter_unpack("<I", key):
+            self.add_key(word)
             self.cycle()
-        for i in range(self.n):
-            self.crc[i] = self.r[i]
+        self.crc = self.__registers()
+        self.crc_start = 0
         self.diffuse()
-        for i in range(self.n):
-            self.r[i] ^= self.crc[i]
+        self.r = [
+            word ^ crc for word, crc in zip(self.__registers(), self.crc)
+        ]
+        self.r_start = 0
 
     def key(self, key: bytes) -> None:
         self.init_state()
@@ -297,92 +393,10 @@ class Shannon:
         self.nbuf = 0
 
     def encrypt(self, buffer: bytes, n: int = None) -> bytes:
-        if n is None:
-            return self.encrypt(buffer, len(buffer))
-        buffer = bytearray(buffer)
-        i = 0
-        j: int
-        t: int
-        if self.nbuf != 0:
-            while self.nbuf != 0 and n != 0:
-                self.mbuf ^= (buffer[i] & 0xff) << (32 - self.nbuf)
-                buffer[i] ^= (self.sbuf >> (32 - self.nbuf)) & 0xff
-                i += 1
-                self.nbuf -= 8
-                n -= 1
-            if self.nbuf != 0:
-                return b""
-            self.mac_func(self.mbuf)
-        j = n & ~0x03
-        while i < j:
-            self.cycle()
-            t = ((buffer[i + 3] & 0xFF) << 24) | \
-                ((buffer[i + 2] & 0xFF) << 16) | \
-                ((buffer[i + 1] & 0xFF) << 8) | \
-                (buffer[i] & 0xFF)
-            self.mac_func(t)
-            t ^= self.sbuf
-            buffer[i + 3] = (t >> 24) & 0xFF
-            buffer[i + 2] = (t >> 16) & 0xFF
-            buffer[i + 1] = (t >> 8) & 0xFF
-            buffer[i] = t & 0xFF
-            i += 4
-        n &= 0x03
-        if n != 0:
-            self.cycle()
-            self.mbuf = 0
-            self.nbuf = 32
-            while self.nbuf != 0 and n != 0:
-                self.mbuf ^= (buffer[i] & 0xff) << (32 - self.nbuf)
-                buffer[i] ^= (self.sbuf >> (32 - self.nbuf)) & 0xff
-                i += 1
-                self.nbuf -= 8
-                n -= 1
-        return bytes(buffer)
+        return self.__crypt(buffer, len(buffer) if n is None else n, False)
 
     def decrypt(self, buffer: bytes, n: int = None) -> bytes:
-        if n is None:
-            return self.decrypt(buffer, len(buffer))
-        buffer = bytearray(buffer)
-        i = 0
-        j: int
-        t: int
-        if self.nbuf != 0:
-            while self.nbuf != 0 and n != 0:
-                buffer[i] ^= (self.sbuf >> (32 - self.nbuf)) & 0xff
-                self.mbuf ^= (buffer[i] & 0xff) << (32 - self.nbuf)
-                i += 1
-                self.nbuf -= 8
-                n -= 1
-            if self.nbuf != 0:
-                return b""
-            self.mac_func(self.mbuf)
-        j = n & ~0x03
-        while i < j:
-            self.cycle()
-            t = ((buffer[i + 3] & 0xFF) << 24) | \
-                ((buffer[i + 2] & 0xFF) << 16) | \
-                ((buffer[i + 1] & 0xFF) << 8) | \
-                (buffer[i] & 0xFF)
-            t ^= self.sbuf
-            self.mac_func(t)
-            buffer[i + 3] = (t >> 24) & 0xFF
-            buffer[i + 2] = (t >> 16) & 0xFF
-            buffer[i + 1] = (t >> 8) & 0xFF
-            buffer[i] = t & 0xFF
-            i += 4
-        n &= 0x03
-        if n != 0:
-            self.cycle()
-            self.mbuf = 0
-            self.nbuf = 32
-            while self.nbuf != 0 and n != 0:
-                buffer[i] ^= (self.sbuf >> (32 - self.nbuf)) & 0xff
-                self.mbuf ^= (buffer[i] & 0xff) << (32 - self.nbuf)
-                i += 1
-                self.nbuf -= 8
-                n -= 1
-        return bytes(buffer)
+        return self.__crypt(buffer, len(buffer) if n is None else n, True)
 
     def finish(self, n: int) -> bytes:
         buffer = bytearray(4)
@@ -393,16 +407,16 @@ class Shannon:
         self.cycle()
         self.add_key(self.initkonst ^ (self.nbuf << 3))
         self.nbuf = 0
-        for j in range(self.n):
-            self.r[j] ^= self.crc[j]
+        self.r = [
+            word ^ crc
+            for word, crc in zip(self.__registers(), self.__crc_words())
+        ]
+        self.r_start = 0
         self.diffuse()
         while n > 0:
             self.cycle()
             if n >= 4:
-                buffer[i + 3] = (self.sbuf >> 24) & 0xff
-                buffer[i + 2] = (self.sbuf >> 16) & 0xff
-                buffer[i + 1] = (self.sbuf >> 8) & 0xff
-                buffer[i] = self.sbuf & 0xff
+                struct.pack_into("<I", buffer, i, self.sbuf)
                 n -= 4
                 i += 4
             else:
@@ -410,3 +424,93 @@ class Shannon:
                     buffer[i + j] = (self.sbuf >> (i * 8)) & 0xff
                 break
         return bytes(buffer)
+
+    def __crypt(self, buffer: bytes, n: int, decrypt: bool) -> bytes:
+        buffer = bytearray(buffer)
+        i = 0
+        if self.nbuf != 0:
+            i = self.__crypt_bytes(buffer, 0, n, decrypt)
+            n -= i
+            if self.nbuf != 0:
+                return bytes(buffer)
+            self.mac_func(self.mbuf)
+        j = i + (n & ~0x03)
+        if i < j:
+            words = array.array("I")
+            words.frombytes(memoryview(buffer)[i:j])
+            if Shannon.__big_endian:
+                words.byteswap()
+            self.__crypt_words(words, decrypt)
+            if Shannon.__big_endian:
+                words.byteswap()
+            buffer[i:j] = words
+        n &= 0x03
+        if n != 0:
+            self.cycle()
+            self.mbuf = 0
+            self.nbuf = 32
+            self.__crypt_bytes(buffer, j, n, decrypt)
+        return bytes(buffer)
+
+    def __crypt_bytes(self, buffer: bytearray, i: int, n: int,
+                      decrypt: bool) -> int:
+        # Byte path for the part of a word left over by the previous call
+        # or at the end of the buffer, returns the number of bytes consumed
+        count = 0
+        while self.nbuf != 0 and count < n:
+            shift = 32 - self.nbuf
+            if decrypt:
+                buffer[i] ^= (self.sbuf >> shift) & 0xff
+                self.mbuf ^= buffer[i] << shift
+            else:
+                self.mbuf ^= buffer[i] << shift
+                buffer[i] ^= (self.sbuf >> shift) & 0xff
+            i += 1
+            count += 1
+            self.nbuf -= 8
+        return count
+
+    def __crypt_words(self, words: array.array, decrypt: bool) -> None:
+        # One cycle and one MAC update per word. The CRC ring is rotated to
+        # start where the register does, both then advance together and
+        # every ring index of a word comes from one precomputed tuple
+        r = self.r
+        start = self.r_start
+        crc = self.__crc_words()
+        crc = crc[self.n - start:] + crc[:self.n - start]
+        konst = self.konst
+        sbuf = self.sbuf
+        steps = itertools.cycle(Shannon.__steps[start:] +
+                                Shannon.__steps[:start])
+        for index, word in enumerate(words):
+            s0, s1, s2, s3, s9, s12, s13, s14, s15 = next(steps)
+            t = r[s12] ^ r[s13] ^ konst
+            t ^= ((t << 5 | t >> 27) | (t << 7 | t >> 25)) & 0xffffffff
+            t ^= ((t << 19 | t >> 13) | (t << 22 | t >> 10)) & 0xffffffff
+            u = r[s0]
+            t ^= (u << 1 | u >> 31) & 0xffffffff
+            r[s0] = t
+            t ^= r[s3]
+            t ^= ((t << 7 | t >> 25) | (t << 22 | t >> 10)) & 0xffffffff
+            t ^= ((t << 5 | t >> 27) | (t << 19 | t >> 13)) & 0xffffffff
+            r[s1] ^= t
+            sbuf = t ^ r[s9] ^ r[s13]
+            if decrypt:
+                word ^= sbuf
+                words[index] = word
+            else:
+                words[index] = word ^ sbuf
+            crc[s0] ^= crc[s2] ^ crc[s15] ^ word
+            r[s14] ^= word
+        self.r_start = (start + len(words)) & 15
+        self.crc = crc
+        self.crc_start = self.r_start
+        self.sbuf = sbuf
+
+    def __crc_words(self) -> list:
+        start = self.crc_start
+        return self.crc[start:] + self.crc[:start]
+
+    def __registers(self) -> list:
+        start = self.r_start
+        return self.r[start:] + self.r[:start]
@@ -4,12 +4,15 @@ from librespot.crypto import Packet
 from librespot.proto import Mercury_pb2 as Mercury, Pubsub_pb2 as Pubsub
 from librespot.structure import Closeable, PacketsReceiver, SubListener
 from requests.structures import CaseInsensitiveDict
+import asyncio
+import concurrent.futures
+import heapq
 import io
 import json
 import logging
-import queue
 import struct
 import threading
+import time
 import typing
 
 if typing.TYPE_CHECKING:
@@ -26,32 +29,53 @@ class JsonMercuryRequest:
 class MercuryClient(Closeable, PacketsReceiver):
     logger = logging.getLogger("Librespot:MercuryClient")
     mercury_request_timeout = 3
-    __callbacks: typing.Dict[int, Callback] = {}
-    __remove_callback_lock = threading.Condition()
-    __partials: typing.Dict[int, typing.List[bytes]] = {}
+    packet_types = (
+        Packet.Type.mercury_event,
+        Packet.Type.mercury_req,
+        Packet.Type.mercury_sub,
+        Packet.Type.mercury_unsub,
+    )
+    __callbacks: typing.Dict[int, Callback]
+    __closed = False
+    __deadlines: typing.List[typing.Tuple[float, int]]
+    __lock: threading.Condition
+    __partials: typing.Dict[int, typing.Tuple[float, typing.List[bytes]]]
+    __reaper: typing.Union[threading.Thread, None] = None
     __seq_holder = 0
-    __seq_holder_lock = threading.Condition()
     __session: Session
-    __subscriptions: typing.List[InternalSubListener] = []
-    __subscriptions_lock = threading.Condition()
+    __single_flight: util.SingleFlight
+    __subscriptions: util.PrefixTrie
 
     def __init__(self, session: Session):
+        self.__callbacks = {}
+        self.__deadlines = []
+        self.__lock = threading.Condition()
+        self.__partials = {}
         self.__session = session
+        self.__single_flight = util.SingleFlight()
+        self.__subscriptions = util.PrefixTrie()
 
     def close(self) -> None:
         """
         Close the MercuryClient instance
         """
-        if len(self.__subscriptions) != 0:
-            for listener in self.__subscriptions:
-                if listener.is_sub:
-                    self.unsubscribe(listener.uri)
-                else:
-                    self.not_interested_in(listener.listener)
-        if len(self.__callbacks) != 0:
-            with self.__remove_callback_lock:
-                self.__remove_callback_lock.wait(self.mercury_request_timeout)
-        self.__callbacks.clear()
+        for _, listener in self.__subscriptions.items():
+            if listener.is_sub:
+                self.unsubscribe(listener.uri)
+            else:
+                self.not_interested_in(listener.listener)
+        with self.__lock:
+            self.__closed = True
+            callbacks = list(self.__callbacks.values())
+            self.__callbacks.clear()
+            self.__partials.clear()
+            self.__deadlines.clear()
+            self.__lock.notify_all()
+        for callback in callbacks:
+            callback.error(IOError("MercuryClient closed"))
+
+    def coalescing_stats(self) -> typing.Dict[str, int]:
+        return self.__single_flight.stats()
 
     def dispatch(self, packet: Packet) -> None:
         payload = io.BytesIO(packet.payload)
@@ -66,81 +90,95 @@ class MercuryClient(Closeable, PacketsReceiver):
             raise RuntimeError("Unknown seq length: {}".format(seq_length))
         flags = payload.read(1)
         parts = struct.unpack(">H", payload.read(2))[0]
-        partial = self.__partials.get(seq)
-        if partial is None or flags == 0:
-            partial = []
-            self.__partials[seq] = partial
+        with self.__lock:
+            partial = self.__partials.get(seq)
+            if partial is None:
+                partial = (time.monotonic(), [])
+                self.__partials[seq] = partial
         self.logger.debug(
             "Handling packet, cmd: 0x{}, seq: {}, flags: {}, parts: {}".format(
                 util.bytes_to_hex(packet.cmd), seq, flags, parts))
         for _ in range(parts):
             size = struct.unpack(">H", payload.read(2))[0]
-            buffer = payload.read(size)
-            partial.append(buffer)
-            self.__partials[seq] = partial
+            partial[1].append(payload.read(size))
         if flags != b"\x01":
             return
-        self.__partials.pop(seq)
+        with self.__lock:
+            self.__partials.pop(seq, None)
         header = Mercury.Header()
-        header.ParseFromString(partial[0])
-        response = MercuryClient.Response(header, partial)
+        header.ParseFromString(partial[1][0])
+        response = MercuryClient.Response(header, partial[1])
         if packet.is_cmd(Packet.Type.mercury_event):
-            dispatched = False
-            with self.__subscriptions_lock:
-                for sub in self.__subscriptions:
-                    if sub.matches(header.uri):
-                        sub.dispatch(response)
-                        dispatched = True
-            if not dispatched:
+            subscriptions = self.__subscriptions.match(header.uri)
+            for sub in subscriptions:
+                sub.dispatch(response)
+            if not subscriptions:
                 self.logger.debug(
                     "Couldn't dispatch Mercury event seq: {}, uri: {}, code: {}, payload: {}"
                     .format(seq, header.uri, header.status_code,
                             response.payload))
         elif (packet.is_cmd(Packet.Type.mercury_req)
               or packet.is_cmd(Packet.Type.mercury_sub)
-              or packet.is_cmd(Packet.Type.mercury_sub)):
-            callback = self.__callbacks.get(seq)
-            self.__callbacks.pop(seq)
+              or packet.is_cmd(Packet.Type.mercury_unsub)):
+            with self.__lock:
+                callback = self.__callbacks.pop(seq, None)
             if callback is not None:
                 callback.response(response)
             else:
                 self.logger.warning(
                     "Skipped Mercury response, seq: {}, uri: {}, code: {}".
                     format(seq, response.uri, response.status_code))
-            with self.__remove_callback_lock:
-                self.__remove_callback_lock.notify_all()
         else:
             self.logger.warning(
                 "Couldn't handle packet, seq: {}, uri: {}, code: {}".format(
                     seq, header.uri, header.status_code))
 
     def interested_in(self, uri: str, listener: SubListener) -> None:
-        self.__subscriptions.append(
-            MercuryClient.InternalSubListener(uri, listener, False))
+        self.__subscriptions.add(
+            uri, MercuryClient.InternalSubListener(uri, listener, False))
 
     def not_interested_in(self, listener: SubListener) -> None:
-        try:
-            for subscription in self.__subscriptions:
-                if subscription.listener is listener:
-                    self.__subscriptions.remove(subscription)
-                    break
-        except ValueError:
-            pass
-
-    def send(self, request: RawMercuryRequest, callback) -> int:
+        for uri, subscription in self.__subscriptions.items():
+            if subscription.listener is listener:
+                self.__subscriptions.remove(uri, subscription)
+                break
+
+    def pending(self) -> int:
+        """
+        Returns:
+            Number of requests waiting for their response
+        """
+        with self.__lock:
+            return len(self.__callbacks)
+
+    def send(self,
+             request: RawMercuryRequest,
+             callback: Callback,
+             timeout: typing.Union[float, None] = None) -> int:
         """
         Send the Mercury request
         Args:
             request: RawMercuryRequest
-            callback: Callback function
+            callback: Callback receiving the response
+            timeout: Seconds after which the callback gets a timeout error,
+                None waits forever
         Returns:
-            MercuryClient.Response
+            The sequence number of the request
         """
         buffer = io.BytesIO()
-        seq: int
-        with self.__seq_holder_lock:
+        with self.__lock:
+            if self.__closed:
+                raise IOError("MercuryClient closed")
             seq = self.__seq_holder
             self.__seq_holder += 1
+            # Registered before sending, the response may arrive before
+            # send returns
+            self.__callbacks[seq] = callback
+            if timeout is not None:
+                heapq.heappush(self.__deadlines,
+                               (time.monotonic() + timeout, seq))
+                self.__start_reaper()
+                self.__lock.notify_all()
         self.logger.debug(
             "Send Mercury request, seq: {}, uri: {}, method: {}".format(
                 seq, request.header.uri, request.header.method))
@@ -156,29 +194,118 @@ class MercuryClient(Closeable, PacketsReceiver):
             buffer.write(part)
         buffer.seek(0)
         cmd = Packet.Type.for_method(request.header.method)
-        self.__session.send(cmd, buffer.read())
-        self.__callbacks[seq] = callback
+        try:
+            self.__session.send(cmd, buffer.read())
+        except Exception:
+            self.__forget(seq)
+            raise
         return seq
 
-    def send_sync(self, request: RawMercuryRequest) -> Response:
+    def send_future(
+            self,
+            request: RawMercuryRequest,
+            timeout: typing.Union[float, None] = -1
+    ) -> concurrent.futures.Future:
         """
-        Send the Mercury request
+        Send the Mercury request without waiting for the response, identical
+        GET requests in flight share one future
+        Args:
+            request: RawMercuryRequest
+            timeout: Seconds after which the future fails with an IOError,
+                mercury_request_timeout if -1, None waits forever
+        Returns:
+            A future resolving to the MercuryClient.Response, cancelling it
+            forgets the request once no other caller shares it
+        """
+        if timeout == -1:
+            timeout = self.mercury_request_timeout
+        if request.header.method == "GET":
+            key = (request.header.SerializeToString(), tuple(request.payload),
+                   timeout)
+            return self.__single_flight.share(
+                key, lambda: self.__send_future(request, timeout))
+        return self.__send_future(request, timeout)
+
+    async def send_async(
+            self,
+            request: RawMercuryRequest,
+            timeout: typing.Union[float, None] = -1) -> Response:
+        """
+        Awaitable variant of send_future for asyncio callers
+        """
+        return await asyncio.wrap_future(self.send_future(request, timeout))
+
+    def send_sync(self,
+                  request: RawMercuryRequest,
+                  timeout: typing.Union[float, None] = -1) -> Response:
+        """
+        Send the Mercury request and wait for the response, identical GET
+        requests in flight share one response
         Args:
             request: RawMercuryRequest
+            timeout: Seconds to wait, mercury_request_timeout if -1
         Returns:
             MercuryClient.Response
         """
-        callback = MercuryClient.SyncCallback()
-        seq = self.send(request, callback)
+        future = self.send_future(request, timeout)
         try:
-            response = callback.wait_response()
-            if response is None:
-                raise IOError(
-                    "Request timeout out, {} passed, yet no response. seq: {}".
-                    format(self.mercury_request_timeout, seq))
-            return response
-        except queue.Empty as e:
-            raise IOError(e)
+            return future.result()
+        except concurrent.futures.CancelledError as ex:
+            raise IOError("Mercury request cancelled, uri: {}".format(
+                request.header.uri)) from ex
+
+    def __forget(self, seq: int) -> None:
+        with self.__lock:
+            self.__callbacks.pop(seq, None)
+            self.__partials.pop(seq, None)
+
+    def __reap(self) -> None:
+        with self.__lock:
+            while not self.__closed:
+                now = time.monotonic()
+                expired = []
+                while self.__deadlines and self.__deadlines[0][0] <= now:
+                    _, seq = heapq.heappop(self.__deadlines)
+                    callback = self.__callbacks.pop(seq, None)
+                    if callback is not None:
+                        expired.append((seq, callback))
+                for seq, (started, _) in list(self.__partials.items()):
+                    if (seq not in self.__callbacks and now - started >
+                            self.mercury_request_timeout * 10):
+                        # Responses and events that never got their last part
+                        del self.__partials[seq]
+                if expired:
+                    for seq, _ in expired:
+                        self.__partials.pop(seq, None)
+                    self.__lock.release()
+                    try:
+                        for seq, callback in expired:
+                            callback.error(
+                                IOError("Request timeout out, no response. "
+                                        "seq: {}".format(seq)))
+                    finally:
+                        self.__lock.acquire()
+                    continue
+                wait = self.mercury_request_timeout * 10
+                if self.__deadlines:
+                    wait = min(wait, self.__deadlines[0][0] - now)
+                self.__lock.wait(wait)
+
+    def __send_future(
+            self, request: RawMercuryRequest,
+            timeout: typing.Union[float, None]) -> concurrent.futures.Future:
+        callback = MercuryClient.FutureCallback()
+        seq = self.send(request, callback, timeout)
+        callback.future.add_done_callback(
+            lambda future: self.__forget(seq) if future.cancelled() else None)
+        return callback.future
+
+    def __start_reaper(self) -> None:
+        if self.__reaper is None or not self.__reaper.is_alive():
+            self.__reaper = threading.Thread(target=self.__reap,
+                                             name="mercury-reaper",
+                                             daemon=True)
+            self.__reaper.start()
 
     def send_sync_json(self, request: JsonMercuryRequest) -> typing.Any:
         response = self.send_sync(request.request)
@@ -196,15 +323,19 @@ class MercuryClient(Closeable, PacketsReceiver):
         response = self.send_sync(RawMercuryRequest.sub(uri))
         if response.status_code != 200:
             raise RuntimeError(response)
-        if len(response.payload) > 0:
-            for payload in response.payload:
+        if len(response.parts) > 0:
+            subscriptions = []
+            for part in response.parts:
                 sub = Pubsub.Subscription()
-                sub.ParseFromString(payload)
-                self.__subscriptions.append(
-                    MercuryClient.InternalSubListener(sub.uri, listener, True))
+                sub.ParseFromString(part)
+                subscriptions.append(
+                    (sub.uri,
+                     MercuryClient.InternalSubListener(sub.uri, listener,
+                                                       True)))
+            self.__subscriptions.add_many(subscriptions)
         else:
-            self.__subscriptions.append(
-                MercuryClient.InternalSubListener(uri, listener, True))
+            self.__subscriptions.add(
+                uri, MercuryClient.InternalSubListener(uri, listener, True))
         self.logger.debug("Subscribed successfully to {}!".format(uri))
 
     def unsubscribe(self, uri) -> None:
@@ -216,16 +347,38 @@ class MercuryClient(Closeable, PacketsReceiver):
         response = self.send_sync(RawMercuryRequest.unsub(uri))
         if response.status_code != 200:
             raise RuntimeError(response)
-        for subscription in self.__subscriptions:
-            if subscription.matches(uri):
-                self.__subscriptions.remove(subscription)
-                break
+        for subscription in self.__subscriptions.match(uri):
+            self.__subscriptions.remove(subscription.uri, subscription)
+            break
         self.logger.debug("Unsubscribed successfully from {}!".format(uri))
 
     class Callback:
         def response(self, response: MercuryClient.Response) -> None:
             raise NotImplementedError
 
+        def error(self, ex: Exception) -> None:
+            self.response(None)
+
+    class FutureCallback(Callback):
+        future: concurrent.futures.Future
+
+        def __init__(self):
+            self.future = concurrent.futures.Future()
+
+        def response(self, response: MercuryClient.Response) -> None:
+            if not self.future.done():
+                try:
+                    self.future.set_result(response)
+                except concurrent.futures.InvalidStateError:
+                    pass
+
+        def error(self, ex: Exception) -> None:
+            if not self.future.done():
+                try:
+                    self.future.set_exception(ex)
+                except concurrent.futures.InvalidStateError:
+                    pass
+
     class InternalSubListener:
         uri: str
         listener: SubListener
@@ -266,29 +419,15 @@ class MercuryClient(Closeable, PacketsReceiver):
 
     class Response:
         uri: str
+        parts: typing.List[bytes]
         payload: bytes
         status_code: int
 
         def __init__(self, header: Mercury.Header, payload: list[bytes]):
             self.uri = header.uri
             self.status_code = header.status_code
-            self.payload = b"".join(payload[1:])
-
-    class SyncCallback(Callback):
-        __reference = queue.Queue()
-
-        def response(self, response: MercuryClient.Response) -> None:
-            """
-            Set the response
-            :param response:
-            :return:
-            """
-            self.__reference.put(response)
-            self.__reference.task_done()
-
-        def wait_response(self) -> typing.Any:
-            return self.__reference.get(
-                timeout=MercuryClient.mercury_request_timeout)
+            self.parts = payload[1:]
+            self.payload = b"".join(self.parts)
 
 
 class MercuryRequests:
@@ -3,12 +3,54 @@ from librespot import util
 from librespot.proto.ContextTrack_pb2 import ContextTrack
 from librespot.util import Base62
 import re
+import typing
+import weakref
 
 
 class SpotifyId:
+    """
+    Immutable id backed by the 16 byte gid and nothing else, the hex,
+    base62 and uri renderings are computed when asked for. Ids compare and
+    hash by type and gid.
+    """
     STATIC_FROM_URI = "fromUri"
     STATIC_FROM_BASE62 = "fromBase62"
     STATIC_FROM_HEX = "fromHex"
+    __slots__ = ("__gid", "__weakref__")
+    __interned = weakref.WeakValueDictionary()
+    base62 = Base62.create_instance_with_inverted_character_set()
+    kind: str = None
+
+    def __init__(self, hex_id: str):
+        try:
+            gid = util.hex_to_bytes(hex_id)
+        except ValueError as ex:
+            raise SpotifyId.SpotifyIdParsingException(
+                "Invalid hex id: {}".format(hex_id)) from ex
+        if len(gid) != 16:
+            raise SpotifyId.SpotifyIdParsingException(
+                "Invalid hex id length: {}".format(hex_id))
+        self.__init(gid)
+
+    @classmethod
+    def from_gid(cls, gid: bytes):
+        """
+        Create an id straight from its gid, without a hex round trip
+        """
+        instance = cls.__new__(cls)
+        instance.__init(bytes(gid))
+        return instance
+
+    @classmethod
+    def from_gids(cls, gids: typing.Iterable[bytes]) -> list:
+        return [cls.from_gid(gid) for gid in gids]
+
+    @classmethod
+    def from_base62s(cls, base62s: typing.Iterable[str]) -> list:
+        """
+        Convert many base62 ids at once
+        """
+        return cls.from_gids(SpotifyId.base62.decode_all(base62s, 16))
 
     @staticmethod
     def from_base62(base62: str):
@@ -22,15 +64,60 @@ class SpotifyId:
     def from_uri(uri: str):
         raise NotImplementedError
 
+    def intern(self):
+        """
+        Returns:
+            The canonical instance for this id, equal ids interned while it
+            is alive share the same object
+        """
+        return SpotifyId.__interned.setdefault((type(self), self.__gid),
+                                               self)
+
+    def get_gid(self) -> bytes:
+        return self.__gid
+
+    def hex_id(self) -> str:
+        return util.bytes_to_hex(self.__gid)
+
+    def base62_id(self) -> str:
+        return self.base62.encode(self.__gid, 22).decode()
+
+    def to_mercury_uri(self) -> str:
+        return "hm://metadata/4/{}/{}".format(self.kind, self.hex_id())
+
     def to_spotify_uri(self) -> str:
-        raise NotImplementedError
+        return "spotify:{}:{}".format(self.kind, self.base62_id())
+
+    def __init(self, gid: bytes) -> None:
+        object.__setattr__(self, "_SpotifyId__gid", gid)
+
+    def __eq__(self, other) -> bool:
+        if self is other:
+            return True
+        return type(other) is type(self) and other.__gid == self.__gid
+
+    def __hash__(self) -> int:
+        return hash(self.__gid)
+
+    def __reduce__(self):
+        return type(self).from_gid, (self.__gid, )
+
+    def __repr__(self) -> str:
+        return "{}({})".format(type(self).__name__, self.to_spotify_uri())
+
+    def __setattr__(self, key, value):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def __delattr__(self, key):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
 
     class SpotifyIdParsingException(Exception):
         pass
 
 
 class PlayableId:
-    base62 = Base62.create_instance_with_inverted_character_set()
+    __slots__ = ()
+    base62 = SpotifyId.base62
 
     @staticmethod
     def from_uri(uri: str) -> PlayableId:
@@ -63,12 +150,17 @@ class PlayableId:
 
 
 class PlaylistId(SpotifyId):
-    base62 = Base62.create_instance_with_inverted_character_set()
+    """
+    Playlist ids are kept as the base62 string they come in, they aren't
+    guaranteed to decode to a 16 byte gid. The gid based accessors of
+    SpotifyId raise TypeError.
+    """
+    __slots__ = ("__id", )
     pattern = re.compile(r"spotify:playlist:(.{22})")
-    __id: str
+    kind = "playlist"
 
     def __init__(self, _id: str):
-        self.__id = _id
+        object.__setattr__(self, "_PlaylistId__id", _id)
 
     @staticmethod
     def from_uri(uri: str) -> PlaylistId:
@@ -81,11 +173,36 @@ class PlaylistId(SpotifyId):
     def id(self) -> str:
         return self.__id
 
+    def base62_id(self) -> str:
+        return self.__id
+
+    def get_gid(self) -> bytes:
+        raise TypeError()
+
+    def hex_id(self) -> str:
+        raise TypeError()
+
+    def to_mercury_uri(self) -> str:
+        raise TypeError()
+
     def to_spotify_uri(self) -> str:
         return "spotify:playlist:" + self.__id
 
+    def __eq__(self, other) -> bool:
+        return type(other) is PlaylistId and other.__id == self.__id
+
+    def __hash__(self) -> int:
+        return hash(self.__id)
+
+    def __reduce__(self):
+        return PlaylistId, (self.__id, )
+
+    def intern(self) -> PlaylistId:
+        return self
+
 
 class UnsupportedId(PlayableId):
+    __slots__ = ("uri", )
     uri: str
 
     def __init__(self, uri: str):
@@ -102,182 +219,106 @@ class UnsupportedId(PlayableId):
 
 
 class AlbumId(SpotifyId):
-    base62 = Base62.create_instance_with_inverted_character_set()
+    __slots__ = ()
     pattern = re.compile(r"spotify:album:(.{22})")
-    __hex_id: str
-
-    def __init__(self, hex_id: str):
-        self.__hex_id = hex_id.lower()
+    kind = "album"
 
     @staticmethod
     def from_uri(uri: str) -> AlbumId:
         matcher = AlbumId.pattern.search(uri)
         if matcher is not None:
-            album_id = matcher.group(1)
-            return AlbumId(util.bytes_to_hex(AlbumId.base62.decode(album_id.encode(), 16)))
+            return AlbumId.from_base62(matcher.group(1))
         raise TypeError("Not a Spotify album ID: {}.".format(uri))
 
     @staticmethod
     def from_base62(base62: str) -> AlbumId:
-        return AlbumId(util.bytes_to_hex(AlbumId.base62.decode(base62.encode(), 16)))
+        return AlbumId.from_gid(AlbumId.base62.decode(base62.encode(), 16))
 
     @staticmethod
     def from_hex(hex_str: str) -> AlbumId:
         return AlbumId(hex_str)
 
-    def to_mercury_uri(self) -> str:
-        return "hm://metadata/4/album/{}".format(self.__hex_id)
-
-    def hex_id(self) -> str:
-        return self.__hex_id
-
-    def to_spotify_uri(self) -> str:
-        return "spotify:album:{}".format(
-            AlbumId.base62.encode(util.hex_to_bytes(self.__hex_id)).decode())
-
 
 class ArtistId(SpotifyId):
-    base62 = Base62.create_instance_with_inverted_character_set()
+    __slots__ = ()
     pattern = re.compile("spotify:artist:(.{22})")
-    __hex_id: str
-
-    def __init__(self, hex_id: str):
-        self.__hex_id = hex_id.lower()
+    kind = "artist"
 
     @staticmethod
     def from_uri(uri: str) -> ArtistId:
         matcher = ArtistId.pattern.search(uri)
         if matcher is not None:
-            artist_id = matcher.group(1)
-            return ArtistId(
-                util.bytes_to_hex(ArtistId.base62.decode(artist_id.encode(), 16)))
+            return ArtistId.from_base62(matcher.group(1))
         raise TypeError("Not a Spotify artist ID: {}".format(uri))
 
     @staticmethod
     def from_base62(base62: str) -> ArtistId:
-        return ArtistId(util.bytes_to_hex(ArtistId.base62.decode(base62.encode(), 16)))
+        return ArtistId.from_gid(ArtistId.base62.decode(base62.encode(), 16))
 
     @staticmethod
     def from_hex(hex_str: str) -> ArtistId:
         return ArtistId(hex_str)
 
-    def to_mercury_uri(self) -> str:
-        return "hm://metadata/4/artist/{}".format(self.__hex_id)
-
-    def to_spotify_uri(self) -> str:
-        return "spotify:artist:{}".format(
-            ArtistId.base62.encode(util.hex_to_bytes(self.__hex_id)).decode())
-
-    def hex_id(self) -> str:
-        return self.__hex_id
-
 
 class EpisodeId(SpotifyId, PlayableId):
+    __slots__ = ()
     pattern = re.compile(r"spotify:episode:(.{22})")
-    __hex_id: str
-
-    def __init__(self, hex_id: str):
-        self.__hex_id = hex_id.lower()
+    kind = "episode"
 
     @staticmethod
     def from_uri(uri: str) -> EpisodeId:
         matcher = EpisodeId.pattern.search(uri)
         if matcher is not None:
-            episode_id = matcher.group(1)
-            return EpisodeId(
-                util.bytes_to_hex(PlayableId.base62.decode(episode_id.encode(), 16)))
+            return EpisodeId.from_base62(matcher.group(1))
         raise TypeError("Not a Spotify episode ID: {}".format(uri))
 
     @staticmethod
     def from_base62(base62: str) -> EpisodeId:
-        return EpisodeId(
-            util.bytes_to_hex(PlayableId.base62.decode(base62.encode(), 16)))
+        return EpisodeId.from_gid(
+            PlayableId.base62.decode(base62.encode(), 16))
 
     @staticmethod
     def from_hex(hex_str: str) -> EpisodeId:
         return EpisodeId(hex_str)
 
-    def to_mercury_uri(self) -> str:
-        return "hm://metadata/4/episode/{}".format(self.__hex_id)
-
-    def to_spotify_uri(self) -> str:
-        return "Spotify:episode:{}".format(
-            PlayableId.base62.encode(util.hex_to_bytes(self.__hex_id)).decode())
-
-    def hex_id(self) -> str:
-        return self.__hex_id
-
-    def get_gid(self) -> bytes:
-        return util.hex_to_bytes(self.__hex_id)
-
 
 class ShowId(SpotifyId):
-    base62 = Base62.create_instance_with_inverted_character_set()
+    __slots__ = ()
     pattern = re.compile("spotify:show:(.{22})")
-    __hex_id: str
-
-    def __init__(self, hex_id: str):
-        self.__hex_id = hex_id
+    kind = "show"
 
     @staticmethod
     def from_uri(uri: str) -> ShowId:
         matcher = ShowId.pattern.search(uri)
         if matcher is not None:
-            show_id = matcher.group(1)
-            return ShowId(util.bytes_to_hex(ShowId.base62.decode(show_id.encode(), 16)))
+            return ShowId.from_base62(matcher.group(1))
         raise TypeError("Not a Spotify show ID: {}".format(uri))
 
     @staticmethod
     def from_base62(base62: str) -> ShowId:
-        return ShowId(util.bytes_to_hex(ShowId.base62.decode(base62.encode(), 16)))
+        return ShowId.from_gid(ShowId.base62.decode(base62.encode(), 16))
 
     @staticmethod
     def from_hex(hex_str: str) -> ShowId:
         return ShowId(hex_str)
 
-    def to_mercury_uri(self) -> str:
-        return "hm://metadata/4/show/{}".format(self.__hex_id)
-
-    def to_spotify_uri(self) -> str:
-        return "spotify:show:{}".format(
-            ShowId.base62.encode(util.hex_to_bytes(self.__hex_id)).decode())
-
-    def hex_id(self) -> str:
-        return self.__hex_id
-
 
-class TrackId(PlayableId, SpotifyId):
+class TrackId(SpotifyId, PlayableId):
+    __slots__ = ()
     pattern = re.compile("spotify:track:(.{22})")
-    __hex_id: str
-
-    def __init__(self, hex_id: str):
-        self.__hex_id = hex_id.lower()
+    kind = "track"
 
     @staticmethod
     def from_uri(uri: str) -> TrackId:
         search = TrackId.pattern.search(uri)
         if search is not None:
-            track_id = search.group(1)
-            return TrackId(
-                util.bytes_to_hex(PlayableId.base62.decode(track_id.encode(), 16)))
+            return TrackId.from_base62(search.group(1))
         raise RuntimeError("Not a Spotify track ID: {}".format(uri))
 
     @staticmethod
     def from_base62(base62: str) -> TrackId:
-        return TrackId(util.bytes_to_hex(PlayableId.base62.decode(base62.encode(), 16)))
+        return TrackId.from_gid(PlayableId.base62.decode(base62.encode(), 16))
 
     @staticmethod
     def from_hex(hex_str: str) -> TrackId:
         return TrackId(hex_str)
-
-    def to_mercury_uri(self) -> str:
-        return "hm://metadata/4/track/{}".format(self.__hex_id)
-
-    def to_spotify_uri(self) -> str:
-        return "spotify:track:{}".format(TrackId.base62.encode(util.hex_to_bytes(self.__hex_id)).decode())
-
-    def hex_id(self) -> str:
-        return self.__hex_id
-
-    def get_gid(self) -> bytes:
-        return util.hex_to_bytes(self.__hex_id)
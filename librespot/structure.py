@@ -76,6 +76,8 @@ class NoopAudioDecrypt(AudioDecrypt):
 
 
 class PacketsReceiver:
+    packet_types: typing.Tuple[bytes, ...] = ()
+
     def dispatch(self, packet: Packet):
         raise NotImplementedError
 
@@ -1,6 +1,10 @@
+from __future__ import annotations
 from Cryptodome import Random
 import binascii
+import concurrent.futures
 import math
+import threading
+import typing
 
 
 def bytes_to_hex(buffer: bytes) -> str:
@@ -52,47 +56,70 @@ class Base62:
         return Base62(Base62.CharacterSets.inverted)
 
     def encode(self, message: bytes, length: int = -1):
-        indices = self.convert(message, self.standard_base, self.target_base,
-                               length)
-        return self.translate(indices, self.alphabet)
+        if length == -1:
+            length = self.estimate_output_length(len(message),
+                                                 self.standard_base,
+                                                 self.target_base)
+        return self.__encode_int(int.from_bytes(message, "big"), length)
 
     def decode(self, encoded: bytes, length: int = -1):
-        prepared = self.translate(encoded, self.lookup)
-        return self.convert(prepared, self.target_base, self.standard_base,
-                            length)
+        if length == -1:
+            length = self.estimate_output_length(len(encoded),
+                                                 self.target_base,
+                                                 self.standard_base)
+        return self.__decode_int(encoded, length)
+
+    def encode_all(self,
+                   messages: typing.Iterable[bytes],
+                   length: int = -1) -> typing.List[bytearray]:
+        """
+        Encode many messages, e.g. a list of gids
+        Args:
+            messages: Messages to encode
+            length: Output length, estimated per message if -1
+        Returns:
+            The encoded messages in the same order
+        """
+        encode_int = self.__encode_int
+        if length == -1:
+            return [self.encode(message) for message in messages]
+        return [
+            encode_int(int.from_bytes(message, "big"), length)
+            for message in messages
+        ]
+
+    def decode_all(self,
+                   encoded: typing.Iterable[typing.Union[bytes, str]],
+                   length: int = -1) -> typing.List[bytes]:
+        """
+        Decode many base62 strings, e.g. ids of a playlist to gids
+        Args:
+            encoded: Strings or bytes to decode
+            length: Output length, estimated per item if -1
+        Returns:
+            The decoded bytes in the same order
+        """
+        return [
+            self.decode(item.encode() if type(item) is str else item, length)
+            for item in encoded
+        ]
 
     def translate(self, indices: bytes, dictionary: bytes):
-        translation = bytearray(len(indices))
-        for i in range(len(indices)):
-            translation[i] = dictionary[int.from_bytes(bytes([indices[i]]), "big")]
-        return translation
+        if len(dictionary) == 256:
+            return bytearray(bytes(indices).translate(dictionary))
+        return bytearray(dictionary[i] for i in indices)
 
     def convert(self, message: bytes, source_base: int, target_base: int,
                 length: int):
         estimated_length = self.estimate_output_length(
             len(message), source_base, target_base) if length == -1 else length
-        out = b""
-        source = message
-        while len(source) > 0:
-            quotient = b""
-            remainder = 0
-            for b in source:
-                accumulator = int(b & 0xff) + remainder * source_base
-                digit = int(
-                    (accumulator - (accumulator % target_base)) / target_base)
-                remainder = int(accumulator % target_base)
-                if len(quotient) > 0 or digit > 0:
-                    quotient += bytes([digit])
-            out += bytes([remainder])
-            source = quotient
-        if len(out) < estimated_length:
-            size = len(out)
-            for _ in range(estimated_length - size):
-                out += bytes([0])
-            return self.reverse(out)
-        if len(out) > estimated_length:
-            return self.reverse(out[:estimated_length])
-        return self.reverse(out)
+        value = 0
+        for digit in message:
+            value = value * source_base + digit
+        out = bytearray(estimated_length)
+        for i in range(estimated_length - 1, -1, -1):
+            value, out[i] = divmod(value, target_base)
+        return bytes(out)
 
     def estimate_output_length(self, input_length: int, source_base: int,
                                target_base: int):
@@ -101,17 +128,340 @@ class Base62:
                       input_length))
 
     def reverse(self, arr: bytes):
-        length = len(arr)
-        reversed_arr = bytearray(length)
-        for i in range(length):
-            reversed_arr[length - i - 1] = arr[i]
-        return bytes(reversed_arr)
+        return bytes(arr[::-1])
 
     def create_lookup_table(self):
         self.lookup = bytearray(256)
         for i in range(len(self.alphabet)):
             self.lookup[self.alphabet[i]] = i & 0xff
 
+    def __decode_int(self, encoded: bytes, length: int) -> bytes:
+        base = self.target_base
+        lookup = self.lookup
+        value = 0
+        for c in encoded:
+            value = value * base + lookup[c]
+        if value >> (length * 8):
+            value &= (1 << (length * 8)) - 1
+        return value.to_bytes(length, "big")
+
+    def __encode_int(self, value: int, length: int) -> bytearray:
+        alphabet = self.alphabet
+        base = self.target_base
+        out = bytearray(length)
+        for i in range(length - 1, -1, -1):
+            value, digit = divmod(value, base)
+            out[i] = alphabet[digit]
+        return out
+
     class CharacterSets:
         gmp = b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
         inverted = b'0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: the first caller for a key runs
+    the call and callers arriving while it is in flight share its outcome
+    """
+    __calls = 0
+    __deduplicated = 0
+    __in_flight: typing.Dict[typing.Hashable, typing.Union[
+        concurrent.futures.Future, SingleFlight.Call]]
+    __lock: threading.Lock
+
+    def __init__(self):
+        self.__in_flight = {}
+        self.__lock = threading.Lock()
+
+    def do(self, key: typing.Hashable, fn: typing.Callable[[], typing.Any]):
+        """
+        Run fn, or wait for the call already running for key
+        Args:
+            key: Identity of the call
+            fn: The call
+        Returns:
+            The result of fn, exceptions are raised in every caller
+        """
+        with self.__lock:
+            self.__calls += 1
+            shared = self.__in_flight.get(key)
+            if shared is None:
+                future = concurrent.futures.Future()
+                future.set_running_or_notify_cancel()
+                self.__in_flight[key] = future
+            else:
+                self.__deduplicated += 1
+        if shared is not None:
+            return shared.result()
+        try:
+            result = fn()
+        except BaseException as ex:
+            self.__forget(key, future)
+            future.set_exception(ex)
+            raise
+        self.__forget(key, future)
+        future.set_result(result)
+        return result
+
+    def share(
+        self, key: typing.Hashable,
+        factory: typing.Callable[[], concurrent.futures.Future]
+    ) -> concurrent.futures.Future:
+        """
+        Start an asynchronous call, or join the one in flight for key
+        Args:
+            key: Identity of the call
+            factory: Starts the call and returns its future, it runs outside
+                the lock
+        Returns:
+            A future of the caller's own resolving to the outcome of the
+            call. Cancelling it only cancels the call once every caller
+            sharing it has cancelled.
+        """
+        with self.__lock:
+            self.__calls += 1
+            call = self.__in_flight.get(key)
+            if call is None or call.abandoned():
+                call = SingleFlight.Call()
+                self.__in_flight[key] = call
+                started = False
+            else:
+                self.__deduplicated += 1
+                started = True
+            waiter = call.join()
+        if started:
+            return waiter
+        try:
+            future = factory()
+        except BaseException as ex:
+            future = concurrent.futures.Future()
+            future.set_exception(ex)
+        future.add_done_callback(lambda f: self.__forget(key, call))
+        call.start(future)
+        return waiter
+
+    def stats(self) -> typing.Dict[str, int]:
+        with self.__lock:
+            return {
+                "calls": self.__calls,
+                "deduplicated": self.__deduplicated,
+                "in_flight": len(self.__in_flight),
+            }
+
+    def __forget(
+        self, key: typing.Hashable,
+        call: typing.Union[concurrent.futures.Future, SingleFlight.Call]
+    ) -> None:
+        with self.__lock:
+            if self.__in_flight.get(key) is call:
+                del self.__in_flight[key]
+
+    class Call:
+        """
+        A shared asynchronous call and the futures of the callers waiting
+        for it
+        """
+        __cancelled = False
+        __lock: threading.Lock
+        __source: typing.Union[concurrent.futures.Future, None] = None
+        __waiters: typing.List[concurrent.futures.Future]
+
+        def __init__(self):
+            self.__lock = threading.Lock()
+            self.__waiters = []
+
+        def abandoned(self) -> bool:
+            with self.__lock:
+                return self.__cancelled
+
+        def join(self) -> concurrent.futures.Future:
+            waiter = concurrent.futures.Future()
+            with self.__lock:
+                self.__waiters.append(waiter)
+                source = self.__source
+            waiter.add_done_callback(self.__on_waiter_done)
+            if source is not None and source.done():
+                self.__resolve(waiter, source)
+            return waiter
+
+        def start(self, source: concurrent.futures.Future) -> None:
+            with self.__lock:
+                self.__source = source
+                cancelled = self.__cancelled
+            if cancelled:
+                source.cancel()
+            source.add_done_callback(self.__on_source_done)
+
+        def __on_source_done(self, source: concurrent.futures.Future) -> None:
+            with self.__lock:
+                waiters = list(self.__waiters)
+            for waiter in waiters:
+                self.__resolve(waiter, source)
+
+        def __on_waiter_done(self, waiter: concurrent.futures.Future) -> None:
+            if not waiter.cancelled():
+                return
+            with self.__lock:
+                self.__waiters.remove(waiter)
+                if len(self.__waiters) > 0 or self.__cancelled:
+                    return
+                self.__cancelled = True
+                source = self.__source
+            # The last waiter gave up, nobody needs the call anymore
+            if source is not None:
+                source.cancel()
+
+        @staticmethod
+        def __resolve(waiter: concurrent.futures.Future,
+                      source: concurrent.futures.Future) -> None:
+            try:
+                if source.cancelled():
+                    waiter.cancel()
+                elif source.exception() is not None:
+                    waiter.set_exception(source.exception())
+                else:
+                    waiter.set_result(source.result())
+            except concurrent.futures.InvalidStateError:
+                # The waiter was cancelled meanwhile
+                pass
+
+
+class PrefixTrie:
+    """
+    Maps string prefixes to values and finds every value whose prefix
+    starts a given string in O(len(string)). Writers copy the nodes along
+    the path they change and swap the root, so lookups never take the lock.
+    Registering many values goes through add_many, which copies each node
+    once per batch.
+    """
+    __lock: threading.Lock
+    __root: Node
+    __size = 0
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__root = PrefixTrie.Node({}, ())
+
+    def __len__(self) -> int:
+        return self.__size
+
+    def add(self, prefix: str, value: typing.Any) -> None:
+        self.add_many([(prefix, value)])
+
+    def add_many(
+        self, items: typing.Iterable[typing.Tuple[str, typing.Any]]
+    ) -> None:
+        """
+        Register several values and publish them at once
+        Args:
+            items: (prefix, value) pairs
+        """
+        with self.__lock:
+            # Nodes copied by this batch aren't visible to readers yet and
+            # are changed in place
+            copied = set()
+            root = self.__copy(self.__root, copied)
+            count = 0
+            for prefix, value in items:
+                node = root
+                for c in prefix:
+                    child = node.children.get(c)
+                    if child is None:
+                        child = PrefixTrie.Node({}, ())
+                        copied.add(id(child))
+                    elif id(child) not in copied:
+                        child = self.__copy(child, copied)
+                    node.children[c] = child
+                    node = child
+                node.values = node.values + (value, )
+                count += 1
+            self.__root = root
+            self.__size += count
+
+    def match(self, key: str) -> typing.List[typing.Any]:
+        """
+        Args:
+            key: String to route, e.g. an uri
+        Returns:
+            The values of every prefix of key, shortest prefix first
+        """
+        node = self.__root
+        matches = list(node.values)
+        for c in key:
+            node = node.children.get(c)
+            if node is None:
+                break
+            if node.values:
+                matches.extend(node.values)
+        return matches
+
+    def remove(self, prefix: str, value: typing.Any) -> bool:
+        """
+        Remove one registration of value under prefix, values are compared
+        by identity
+        Returns:
+            Whether the value was registered
+        """
+        removed = []
+
+        def without(values: tuple) -> tuple:
+            for i, v in enumerate(values):
+                if v is value:
+                    removed.append(v)
+                    return values[:i] + values[i + 1:]
+            return values
+
+        with self.__lock:
+            root = self.__update(self.__root, prefix, without)
+            if removed:
+                self.__root = root
+                self.__size -= 1
+        return len(removed) > 0
+
+    def items(self) -> typing.List[typing.Tuple[str, typing.Any]]:
+        """
+        Returns:
+            Every (prefix, value) pair
+        """
+        items = []
+        stack = [("", self.__root)]
+        while stack:
+            prefix, node = stack.pop()
+            items.extend((prefix, value) for value in node.values)
+            for c, child in node.children.items():
+                stack.append((prefix + c, child))
+        return items
+
+    @staticmethod
+    def __copy(node: Node, copied: typing.Set[int]) -> Node:
+        copy = PrefixTrie.Node(dict(node.children), node.values)
+        copied.add(id(copy))
+        return copy
+
+    @staticmethod
+    def __update(root: Node, prefix: str,
+                 fn: typing.Callable[[tuple], tuple]) -> Node:
+        path = [root]
+        for c in prefix:
+            child = path[-1].children.get(c)
+            path.append(PrefixTrie.Node({}, ()) if child is None else child)
+        node = PrefixTrie.Node(path[-1].children, fn(path[-1].values))
+        for i in range(len(prefix) - 1, -1, -1):
+            children = dict(path[i].children)
+            if node.values or node.children:
+                children[prefix[i]] = node
+            else:
+                children.pop(prefix[i], None)
+            node = PrefixTrie.Node(children, path[i].values)
+        return node
+
+    class Node:
+        __slots__ = ("children", "values")
+        children: typing.Dict[str, PrefixTrie.Node]
+        values: tuple
+
+        def __init__(self, children: typing.Dict[str, PrefixTrie.Node],
+                     values: tuple):
+            self.children = children
+            self.values = values